@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Batch calls
+    A front end takes an array of request envelopes, enqueues them in one
+    write and answers with an array of their replies in request order.
+    Workers run the items of a batch concurrently.
+
+"""
+
+# builtin modules
+import time
+
+# third party modules
+
+# bluecollar modules
+import bluecollar.worker as bcenv
+from bluecollar import codec
+from bluecollar.replies import Stream, StreamError
+
+
+class Failed(object):
+    """Stands in for a batch item the front end already knows has failed"""
+
+    def __init__(self, response_code, message):
+        self.response_code = response_code
+        self.message = message
+
+
+def error(reply_codec, response_code, message):
+    """An encoded error in place of one item's reply"""
+    return reply_codec.encode({
+        'message' : message,
+        'response_code' : response_code,
+        'error' : True})
+
+def call(replies, items, reply_codec, timeout):
+    """Enqueue a batch of decoded request envelopes and wait up to timeout
+    for all of their replies. Returns the replies encoded as one array."""
+    results = [None] * len(items)
+    # items for each queue go in one envelope
+    batches = {}
+    waiting = []
+    for index, item in enumerate(items):
+        if isinstance(item, Failed):
+            results[index] = error(reply_codec, item.response_code,
+                item.message)
+            continue
+        if (type(item) is not dict or
+                not isinstance(item.get('method'), basestring)):
+            results[index] = error(reply_codec, 400,
+                'Expected a request with a method.')
+            continue
+        item = dict(codec.strip(item), correlation_id=replies.expect())
+        waiting.append((index, item['correlation_id']))
+        batches.setdefault(bcenv.queue_for(item['method']), []).append(item)
+    enqueued = time.time()
+    bcenv.TRANSPORT.push_many([(bcenv.ENVELOPE_CODEC.encode({
+        'batch' : batch,
+        'reply_channel' : replies.channel,
+        'codec' : reply_codec.name,
+        'enqueued' : enqueued,
+        'deadline' : enqueued + timeout,
+        }), queue) for queue, batch in batches.items()])
+    deadline = enqueued + timeout
+    for index, correlation_id in waiting:
+        response = replies.wait(correlation_id,
+            max(0, deadline - time.time()))
+        if response is None:
+            response = error(reply_codec, 504,
+                'Timed out waiting for response.')
+        elif isinstance(response, Stream):
+            # a streamed reply becomes one array in the batch
+            streamed = []
+            try:
+                for chunk in response:
+                    streamed.extend(reply_codec.decode(
+                        reply_codec.frame(chunk)))
+                response = reply_codec.encode(streamed)
+            except StreamError:
+                response = error(reply_codec, 502, 'Streamed reply failed.')
+        results[index] = response
+    return reply_codec.frame(reply_codec.join(results))
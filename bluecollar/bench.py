@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Load test and benchmark
+    Starts a redis-server, workers and the HTTP, REST and WebSocket front
+    ends on free local ports, drives a weighted mix of calls to the example
+    calculator through them and reports throughput and latency
+    percentiles. Results can be saved as a baseline for later runs to be
+    compared against.
+    Use from the command line:
+     python -m bluecollar.bench --duration 30 --save baseline.json
+     python -m bluecollar.bench --mix http.add=1,ws.add=1 --compare \
+baseline.json
+
+"""
+
+# builtin modules
+import os
+import sys
+import json
+import time
+import base64
+import random
+import socket
+import struct
+import httplib
+import logging
+import argparse
+import subprocess
+
+# third party modules
+import gevent
+import gevent.monkey
+gevent.monkey.patch_all()
+import gevent.pool
+
+# bluecollar modules
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_EXAMPLES = os.path.join(_ROOT, 'examples')
+_METHOD = 'calculator.Calculator'
+_DEFAULT_MIX = 'http.add=4,http.batch=1,rest.get=2,ws.add=4'
+# how far a run may move from its baseline before we call it out
+_TOLERANCE = 0.05
+
+def free_port():
+    """A local port nothing is listening on, for now"""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def wait_for(port, timeout=10):
+    """Wait until something accepts connections on a local port"""
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            gevent.sleep(0.1)
+
+
+class Cluster(object):
+    """A redis-server, workers and front ends in subprocesses. Pass the
+    port of a Redis that's already running to use that instead."""
+
+    def __init__(self, workers=1, redis_port=None, env=None):
+        self.workers = workers
+        self.redis_port = redis_port
+        self.ports = {}
+        self.env = dict(os.environ, **(env or {}))
+        self._processes = []
+
+    def _start(self, args, env):
+        self._processes.append(subprocess.Popen(args, env=env,
+            stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT))
+
+    def start(self):
+        if not self.redis_port:
+            self.redis_port = free_port()
+            self._start(['redis-server', '--port', str(self.redis_port),
+                '--save', '', '--appendonly', 'no'], self.env)
+        wait_for(self.redis_port)
+        self.ports = {
+            'http' : free_port(),
+            'rest' : free_port(),
+            'ws' : free_port(),
+            }
+        env = dict(self.env,
+            BC_REDISHOST='127.0.0.1',
+            BC_REDISPORT=str(self.redis_port),
+            BC_HTTP_HOST='127.0.0.1',
+            BC_HTTP_PORT=str(self.ports['http']),
+            BC_REST_HOST='127.0.0.1',
+            BC_REST_PORT=str(self.ports['rest']),
+            BC_WS_HOST='127.0.0.1',
+            BC_WS_PORT=str(self.ports['ws']),
+            PYTHONPATH=os.pathsep.join([_ROOT, _EXAMPLES]))
+        for _ in range(self.workers):
+            self._start([sys.executable, os.path.join(_EXAMPLES,
+                'worker.py')], env)
+        for front_end in ('http', 'rest', 'websocket'):
+            self._start([sys.executable, '-m', 'bluecollar.%s' % front_end],
+                env)
+        for port in self.ports.values():
+            wait_for(port, 30)
+
+    def stop(self):
+        for process in reversed(self._processes):
+            if process.poll() is None:
+                process.terminate()
+        for process in self._processes:
+            process.wait()
+        self._processes = []
+
+
+class HTTPClient(object):
+    """Calls through the HTTP and REST front ends on one connection"""
+
+    def __init__(self, ports):
+        self.ports = ports
+        self._connections = {}
+
+    def request(self, front_end, method, path, body=None, headers=None):
+        connection = self._connections.get(front_end)
+        if connection is None:
+            connection = self._connections[front_end] = \
+                httplib.HTTPConnection('127.0.0.1', self.ports[front_end])
+        try:
+            connection.request(method, path, body, headers or {})
+            response = connection.getresponse()
+            data = response.read()
+        except (httplib.HTTPException, socket.error):
+            # start afresh next time
+            connection.close()
+            del self._connections[front_end]
+            raise
+        if response.status != 200:
+            raise IOError('%d %s' % (response.status, data))
+        return data
+
+
+class WebSocketClient(object):
+    """Just enough of an RFC 6455 client to make tagged calls"""
+
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        key = base64.b64encode(os.urandom(16))
+        self.sock.sendall('\r\n'.join([
+            'GET / HTTP/1.1',
+            'Host: 127.0.0.1:%d' % port,
+            'Upgrade: websocket',
+            'Connection: Upgrade',
+            'Sec-WebSocket-Key: %s' % key,
+            'Sec-WebSocket-Version: 13',
+            '', '']))
+        self.file = self.sock.makefile('rb')
+        status = self.file.readline()
+        if ' 101 ' not in status:
+            raise IOError('WebSocket handshake failed: %s' % status.strip())
+        while self.file.readline() not in ('\r\n', ''):
+            pass
+        self._next = 0
+
+    def send(self, data):
+        mask = os.urandom(4)
+        length = len(data)
+        if length < 126:
+            header = struct.pack('!BB', 0x81, 0x80 | length)
+        elif length < 65536:
+            header = struct.pack('!BBH', 0x81, 0x80 | 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x81, 0x80 | 127, length)
+        masked = ''.join(chr(ord(char) ^ ord(mask[index % 4]))
+            for index, char in enumerate(data))
+        self.sock.sendall(header + mask + masked)
+
+    def receive(self):
+        first, second = struct.unpack('!BB', self.file.read(2))
+        length = second & 0x7f
+        if length == 126:
+            length = struct.unpack('!H', self.file.read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self.file.read(8))[0]
+        return self.file.read(length)
+
+    def call(self, method, args):
+        """Reply to one call, matched by its request ID"""
+        self._next += 1
+        self.send(json.dumps({'id' : self._next, 'method' : method,
+            'args' : args}))
+        while True:
+            reply = json.loads(self.receive())
+            if type(reply) is dict and reply.get('id') == self._next:
+                return reply.get('result')
+
+    def close(self):
+        self.sock.close()
+
+
+class Client(object):
+    """One simulated client, calling each scenario over its own
+    connections"""
+
+    def __init__(self, ports):
+        self.ports = ports
+        self.http = HTTPClient(ports)
+        self._ws = None
+
+    @property
+    def ws(self):
+        if self._ws is None:
+            self._ws = WebSocketClient(self.ports['ws'])
+        return self._ws
+
+    def run(self, scenario):
+        try:
+            SCENARIOS[scenario](self)
+        except (IOError, socket.error, struct.error):
+            if scenario.startswith('ws.'):
+                # reconnect next time
+                self.close()
+                self._ws = None
+            raise
+
+    def close(self):
+        if self._ws:
+            self._ws.close()
+
+SCENARIOS = {
+    'http.add' : lambda client: client.http.request('http', 'GET',
+        '/%s.add/2/3' % _METHOD),
+    'http.post' : lambda client: client.http.request('http', 'POST',
+        '/%s.add' % _METHOD, json.dumps({'args' : [2, 3]}),
+        {'Content-Type' : 'application/json'}),
+    'http.batch' : lambda client: client.http.request('http', 'POST', '/',
+        json.dumps([{'method' : '%s.add' % _METHOD, 'args' : [index, 1]}
+            for index in range(10)]),
+        {'Content-Type' : 'application/json'}),
+    'rest.get' : lambda client: client.http.request('rest', 'GET',
+        '/%s/2/3' % _METHOD.replace('.', '/')),
+    'ws.add' : lambda client: client.ws.call('%s.add' % _METHOD, [2, 3]),
+    }
+
+def parse_mix(mix):
+    """Scenario weights from scenario=weight pairs"""
+    weights = []
+    for pair in mix.split(','):
+        name, _, weight = pair.partition('=')
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise ValueError('Unknown scenario %s, expected one of %s.' % (
+                name, ', '.join(sorted(SCENARIOS))))
+        weights.append((name, float(weight or 1)))
+    return weights
+
+def load(ports, weights, concurrency, duration, warmup=0, seed=0):
+    """Drive the mix with concurrency clients for duration seconds after
+    warmup, returns the latencies and error count of each scenario"""
+    results = dict((name, {'latencies' : [], 'errors' : 0})
+        for name, _ in weights)
+    total = sum(weight for _, weight in weights)
+    measure_from = time.time() + warmup
+    stop_at = measure_from + duration
+
+    def client(number):
+        # each client's choices are repeatable from the seed
+        chooser = random.Random('%s:%d' % (seed, number))
+        caller = Client(ports)
+        try:
+            while time.time() < stop_at:
+                point = chooser.uniform(0, total)
+                for name, weight in weights:
+                    point -= weight
+                    if point <= 0:
+                        break
+                started = time.time()
+                try:
+                    caller.run(name)
+                except Exception, message:
+                    if started >= measure_from:
+                        results[name]['errors'] += 1
+                    logging.debug('%s failed: %s', name, message)
+                    continue
+                if started >= measure_from:
+                    results[name]['latencies'].append(
+                        time.time() - started)
+        finally:
+            caller.close()
+
+    pool = gevent.pool.Pool(concurrency)
+    for number in range(concurrency):
+        pool.spawn(client, number)
+    pool.join()
+    return results
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def summarise(results, duration):
+    """Throughput and latency percentiles, in ms, of each scenario and of
+    them all together"""
+    summary = {}
+    everything = []
+    errors = 0
+    for name, result in results.items():
+        everything.extend(result['latencies'])
+        errors += result['errors']
+        summary[name] = _summary(result['latencies'], result['errors'],
+            duration)
+    summary['all'] = _summary(everything, errors, duration)
+    return summary
+
+def _summary(latencies, errors, duration):
+    ordered = sorted(latencies)
+    summary = {
+        'requests' : len(ordered),
+        'errors' : errors,
+        'throughput' : len(ordered) / float(duration),
+        }
+    for name, fraction in (('p50', 0.5), ('p99', 0.99), ('p999', 0.999)):
+        value = percentile(ordered, fraction)
+        summary[name] = value * 1000 if value is not None else None
+    return summary
+
+def report(summary, baseline=None):
+    """Print a summary, with the change from a baseline's if given"""
+    print '%-12s %9s %7s %10s %9s %9s %9s' % ('scenario', 'requests',
+        'errors', 'req/s', 'p50 ms', 'p99 ms', 'p999 ms')
+    for name in sorted(summary, key=lambda name: (name == 'all', name)):
+        result = summary[name]
+        print '%-12s %9d %7d %10.1f %9s %9s %9s' % (name, result['requests'],
+            result['errors'], result['throughput'], _ms(result['p50']),
+            _ms(result['p99']), _ms(result['p999']))
+        if not baseline or name not in baseline:
+            continue
+        changes = []
+        for metric in ('throughput', 'p50', 'p99', 'p999'):
+            before, after = baseline[name].get(metric), result[metric]
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            # more throughput is better, more latency worse
+            worse = change < -_TOLERANCE if metric == 'throughput' else \
+                change > _TOLERANCE
+            changes.append('%s %+.1f%%%s' % (metric, change * 100,
+                ' !' if worse else ''))
+        print '%-12s %s' % ('', ', '.join(changes))
+
+def _ms(value):
+    return '%.2f' % value if value is not None else '-'
+
+def main():
+    """Run a benchmark from the command line"""
+    parser = argparse.ArgumentParser(description='BlueCollar benchmark')
+    parser.add_argument('--mix', default=_DEFAULT_MIX,
+            help='scenario=weight pairs from %s, default %s' % (
+                ', '.join(sorted(SCENARIOS)), _DEFAULT_MIX))
+    parser.add_argument('--concurrency', type=int, default=20,
+            help='clients calling at once')
+    parser.add_argument('--duration', type=float, default=10,
+            help='seconds to measure for')
+    parser.add_argument('--warmup', type=float, default=2,
+            help='seconds of load before measuring')
+    parser.add_argument('--workers', type=int, default=1,
+            help='worker processes to start')
+    parser.add_argument('--seed', default=0,
+            help='seed for the clients\' choice of scenario')
+    parser.add_argument('--redis-port', type=int,
+            help='use the Redis already on this port instead of starting one')
+    parser.add_argument('--save', metavar='FILE',
+            help='save the results as a baseline')
+    parser.add_argument('--compare', metavar='FILE',
+            help='compare the results with a saved baseline')
+    options = parser.parse_args()
+    try:
+        weights = parse_mix(options.mix)
+    except ValueError, message:
+        parser.error(message)
+    baseline = None
+    if options.compare:
+        with open(options.compare) as saved:
+            baseline = json.load(saved)
+        if baseline['options']['mix'] != options.mix:
+            logging.warning('Baseline ran a different mix: %s',
+                baseline['options']['mix'])
+        baseline = baseline['summary']
+    cluster = Cluster(options.workers, options.redis_port)
+    cluster.start()
+    try:
+        results = load(cluster.ports, weights, options.concurrency,
+            options.duration, options.warmup, options.seed)
+    finally:
+        cluster.stop()
+    summary = summarise(results, options.duration)
+    report(summary, baseline)
+    if options.save:
+        with open(options.save, 'w') as saved:
+            json.dump({
+                'time' : time.time(),
+                'host' : socket.gethostname(),
+                'options' : vars(options),
+                'summary' : summary,
+                }, saved, indent=2, sort_keys=True)
+        print 'Saved to %s' % options.save
+
+if __name__ == '__main__':
+    sys.exit(main())
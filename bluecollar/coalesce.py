@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Request coalescing
+    While a call to a method marked with prototype.coalesce is running,
+    identical calls join it as followers instead of running again, and the
+    leader's reply is sent to every one of them. Within a worker followers
+    are tracked in memory, across workers through a Redis lock and list.
+
+"""
+
+# builtin modules
+import json
+import uuid
+import logging
+
+# third party modules
+import redis
+
+# bluecollar modules
+
+# take the lock and lead, or join the waiting list while the lock is held
+_BOARD_SCRIPT = """
+if redis.call('set', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then
+    return 1
+end
+redis.call('rpush', KEYS[2], ARGV[3])
+redis.call('expire', KEYS[2], ARGV[2])
+return 0
+"""
+
+# hand over the waiting list and release the lock, only if it's still ours
+_LAND_SCRIPT = """
+if redis.call('get', KEYS[1]) ~= ARGV[1] then
+    return {}
+end
+local followers = redis.call('lrange', KEYS[2], 0, -1)
+redis.call('del', KEYS[1], KEYS[2])
+return followers
+"""
+
+
+class Flights(object):
+    """Calls currently being led by this worker, and who is waiting on
+    them. Keys come from memoize.call_key."""
+
+    def __init__(self, connection, owner):
+        self.redis = connection
+        self.owner = owner
+        # key -> list of (reply_to, correlation_id) followers
+        self._flights = {}
+        # key -> what we set the lock of a flight led across workers to
+        self._tokens = {}
+
+    def board(self, key, cluster, ttl, reply_to, correlation_id):
+        """Returns True if the caller should run the call and reply to the
+        followers, False if it has joined a call already running"""
+        follower = (reply_to, correlation_id)
+        if key in self._flights:
+            self._flights[key].append(follower)
+            return False
+        if cluster:
+            token = '%s:%s' % (self.owner, uuid.uuid4().hex)
+            try:
+                leader = self.redis.execute_command('EVAL', _BOARD_SCRIPT,
+                        2, key, '%s:waiting' % key, token, ttl,
+                        json.dumps(follower))
+            except redis.exceptions.ResponseError, message:
+                # no scripting or SET NX EX on this server, run locally
+                logging.error('Unable to coalesce across workers: %s',
+                        message)
+                leader = 1
+            if not leader:
+                return False
+            self._tokens[key] = token
+        self._flights[key] = []
+        return True
+
+    def land(self, key, cluster):
+        """Finish a call, returning its followers. Only the first call for
+        a flight returns anything."""
+        followers = self._flights.pop(key, None)
+        if followers is None:
+            return []
+        token = self._tokens.pop(key, None)
+        if cluster and token is not None:
+            # once the lock has expired, another worker may lead the call
+            # and its followers are no longer ours
+            followers.extend(tuple(json.loads(follower)) for follower in
+                self.redis.execute_command('EVAL', _LAND_SCRIPT, 2, key,
+                    '%s:waiting' % key, token))
+        return followers
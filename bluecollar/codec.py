@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Codecs
+    Encode envelopes and replies as JSON, or as msgpack when it is
+    installed. The envelope codec is chosen per deployment, the reply codec
+    per request through the envelope's codec key.
+    Front ends may instead frame the client's request bytes behind a small
+    JSON header of routing metadata, so they never decode the request
+    themselves; the worker decodes it once.
+
+"""
+
+# builtin modules
+import json
+
+# third party modules
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# bluecollar modules
+
+
+class JSONCodec(object):
+    name = 'json'
+    content_type = 'application/json'
+    binary = False
+
+    def encode(self, data, default=None):
+        return json.dumps(data, default=default)
+
+    def decode(self, data):
+        return json.loads(data)
+
+    def looks_like_map(self, data):
+        """Cheap check that data could be an encoded object"""
+        return data.lstrip()[:1] == '{'
+
+    def mentions(self, data, key):
+        """Cheap check for whether an encoded map might have key"""
+        return '"%s"' % key in data
+
+    def wrap(self, fields, key, payload):
+        """An object of fields with an already encoded payload under key"""
+        head = json.dumps(fields)[:-1]
+        return '%s%s"%s": %s}' % (head, ', ' if fields else '', key,
+            payload)
+
+    def tag(self, request_id, payload):
+        """An encoded reply wrapped with the request ID it answers"""
+        return self.wrap({'id' : request_id}, 'result', payload)
+
+    def join(self, items):
+        """Chunk of a streamed reply from individually encoded items. JSON
+        chunks are array fragments, so the chunks of a stream concatenate
+        into one array."""
+        return ','.join(items)
+
+    def frame(self, chunk):
+        """A chunk as a complete array, for clients that receive chunks
+        separately"""
+        return '[%s]' % chunk
+
+    def body(self, chunks):
+        """Pieces of one response body holding every chunk"""
+        yield '['
+        first = True
+        for chunk in chunks:
+            yield chunk if first else ',' + chunk
+            first = False
+        yield ']'
+
+
+class MsgpackCodec(object):
+    name = 'msgpack'
+    content_type = 'application/msgpack'
+    binary = True
+
+    def encode(self, data, default=None):
+        return msgpack.packb(data, default=default)
+
+    def decode(self, data):
+        try:
+            return msgpack.unpackb(data)
+        except Exception, message:
+            # match json's complaint about bad data
+            raise ValueError(str(message))
+
+    def looks_like_map(self, data):
+        """Cheap check that data could be an encoded map"""
+        return (type(data) is str and data != '' and
+                (0x80 <= ord(data[0]) <= 0x8f or data[0] in '\xde\xdf'))
+
+    def mentions(self, data, key):
+        return type(data) is str and msgpack.packb(key) in data
+
+    def wrap(self, fields, key, payload):
+        packer = msgpack.Packer()
+        return (packer.pack_map_header(len(fields) + 1) +
+            ''.join(packer.pack(name) + packer.pack(value)
+                for name, value in fields.items()) +
+            packer.pack(key) + payload)
+
+    def tag(self, request_id, payload):
+        return self.wrap({'id' : request_id}, 'result', payload)
+
+    def join(self, items):
+        """Chunk of a streamed reply from individually encoded items, each
+        chunk is an array"""
+        packer = msgpack.Packer()
+        return packer.pack_array_header(len(items)) + ''.join(items)
+
+    def frame(self, chunk):
+        return chunk
+
+    def body(self, chunks):
+        """A streamed body is a sequence of arrays, one per chunk"""
+        return chunks
+
+
+JSON = JSONCodec()
+CODECS = {JSON.name : JSON}
+if msgpack is not None:
+    CODECS['msgpack'] = MsgpackCodec()
+
+# media types clients may ask for, to codec name
+_MEDIA_TYPES = {
+    'application/json' : 'json',
+    'application/msgpack' : 'msgpack',
+    'application/x-msgpack' : 'msgpack',
+    }
+
+def get(name):
+    """Codec by name, or JSON if we don't have that one"""
+    return CODECS.get(name, JSON)
+
+def negotiate(header, default=JSON):
+    """Codec for the first type we support in an Accept or Content-Type
+    header, or default"""
+    for media_type in (header or '').split(','):
+        name = _MEDIA_TYPES.get(media_type.split(';')[0].strip().lower())
+        if name in CODECS:
+            return CODECS[name]
+    return default
+
+def sniff(data):
+    """Codec that data appears to be written in. Envelopes and requests
+    are maps or arrays, which msgpack starts with a distinct marker."""
+    if ('msgpack' in CODECS and type(data) is str and data and
+            (0x80 <= ord(data[0]) <= 0x9f or 0xdc <= ord(data[0]) <= 0xdf)):
+        return CODECS['msgpack']
+    return JSON
+
+# framed envelopes start with this, which neither codec starts a map with
+FRAME_MARK = '@'
+# envelope keys only front ends may set
+RESERVED = ('batch', 'correlation_id', 'job_id', 'no_exec', 'reply_channel')
+
+
+class EnvelopeError(ValueError):
+    """A framed payload couldn't be decoded, header holds where to reply"""
+
+    def __init__(self, message, header):
+        super(EnvelopeError, self).__init__(message)
+        self.header = header
+
+
+def strip(request):
+    """A client's decoded request without the keys only front ends may
+    set, so it can't reply to or as someone else"""
+    return dict((key, value) for key, value in request.items()
+        if key not in RESERVED)
+
+def frame(header, payload, payload_codec=JSON):
+    """Envelope carrying routing metadata in header and the client's
+    encoded request as opaque bytes"""
+    header = dict(header, payload=payload_codec.name)
+    if isinstance(payload, unicode):
+        payload = payload.encode('utf-8')
+    return '%s%s\n%s' % (FRAME_MARK, json.dumps(header), payload)
+
+def decode_envelope(data):
+    """Decode an envelope in whichever codec it was written with. The
+    header of a framed envelope is laid over its decoded payload, less any
+    reserved keys, so clients can't set their own routing metadata."""
+    if data[:1] != FRAME_MARK:
+        return sniff(data).decode(data)
+    # JSON escapes newlines, the first one ends the header
+    header, _, payload = data[1:].partition('\n')
+    header = json.loads(header)
+    try:
+        request = get(header.pop('payload', None)).decode(payload)
+    except ValueError, message:
+        raise EnvelopeError(str(message), header)
+    if type(request) is not dict:
+        raise EnvelopeError('Expected a map, received %s' % type(request),
+                header)
+    request = strip(request)
+    request.update(header)
+    return request
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Response compression
+    Negotiates gzip, deflate or identity from Accept-Encoding for the HTTP
+    front ends. Small bodies are sent as they are, and recently compressed
+    bodies may be kept so hot responses are compressed once.
+
+"""
+
+# builtin modules
+import os
+import sys
+import zlib
+import hashlib
+import logging
+import itertools
+import collections
+
+# third party modules
+
+# bluecollar modules
+
+# settings from env, shared by the front ends
+try:
+    # level 0 turns compression off
+    LEVEL = min(9, abs(int(os.environ.get('BC_COMPRESS_LEVEL', 6))))
+    MINIMUM = abs(int(os.environ.get('BC_COMPRESS_MIN', 1024)))
+    # compressed bodies kept by each front end process, none by default
+    CACHE_SIZE = abs(int(os.environ.get('BC_COMPRESS_CACHE', 0)))
+except ValueError, message:
+    logging.error(message)
+    sys.exit(1)
+
+# encodings we can produce, most preferred first
+ENCODINGS = ('gzip', 'deflate')
+# zlib window bits for each encoding, gzip adds 16 for its header
+_WBITS = {
+    'gzip' : 16 + zlib.MAX_WBITS,
+    'deflate' : zlib.MAX_WBITS,
+    }
+
+def negotiate(header):
+    """Best encoding we support in an Accept-Encoding header, or None for
+    identity. Quality values are honoured, ties go to our preference."""
+    accepted = {}
+    for coding in (header or '').split(','):
+        name, _, params = coding.partition(';')
+        name = name.strip().lower()
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name] = quality
+    best = None
+    for encoding in ENCODINGS:
+        quality = accepted.get(encoding, accepted.get('*', 0.0))
+        if quality > 0 and (best is None or quality > best[1]):
+            best = (encoding, quality)
+    return best and best[0]
+
+
+class Compressor(object):
+    """Compresses response bodies at a fixed level once they reach a
+    minimum size"""
+
+    def __init__(self, level=LEVEL, minimum=MINIMUM, cache_size=CACHE_SIZE):
+        self.level = level
+        self.minimum = minimum
+        self.cache_size = cache_size
+        # (encoding, digest of body) -> compressed body, oldest first
+        self._cache = collections.OrderedDict()
+
+    def compress(self, body, encoding):
+        """Body compressed with encoding, from the cache when we can"""
+        if not self.cache_size:
+            return self._compress(body, encoding)
+        key = (encoding, hashlib.sha1(body).digest())
+        compressed = self._cache.pop(key, None)
+        if compressed is None:
+            compressed = self._compress(body, encoding)
+            while len(self._cache) >= self.cache_size:
+                self._cache.popitem(last=False)
+        # most recently used goes to the end
+        self._cache[key] = compressed
+        return compressed
+
+    def _compress(self, body, encoding):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+            _WBITS[encoding])
+        return compressor.compress(body) + compressor.flush()
+
+    def apply(self, body, accept_encoding):
+        """Returns the body to send and the headers describing it"""
+        headers = [('Vary', 'Accept-Encoding')]
+        encoding = negotiate(accept_encoding)
+        if encoding and self.level and len(body) >= self.minimum:
+            body = self.compress(body, encoding)
+            headers.append(('Content-Encoding', encoding))
+        headers.append(('Content-Length', str(len(body))))
+        return body, headers
+
+    def apply_stream(self, pieces, accept_encoding):
+        """Returns an iterator over the pieces of a streamed body to send
+        and the headers describing it. The length isn't known up front, so
+        pieces are read until there are at least minimum bytes, and a
+        stream that ends short of that is sent as it is."""
+        headers = [('Vary', 'Accept-Encoding')]
+        encoding = negotiate(accept_encoding)
+        if not encoding or not self.level:
+            return pieces, headers
+        pieces = iter(pieces)
+        head = []
+        size = 0
+        for piece in pieces:
+            head.append(piece)
+            size += len(piece)
+            if size >= self.minimum:
+                break
+        else:
+            return head, headers
+        headers.append(('Content-Encoding', encoding))
+        return self._compress_stream(itertools.chain(head, pieces),
+            encoding), headers
+
+    def _compress_stream(self, pieces, encoding):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+            _WBITS[encoding])
+        for piece in pieces:
+            # flush each piece so the client sees it without waiting
+            data = compressor.compress(piece) + compressor.flush(
+                zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Adaptive concurrency
+    An AIMD limit on how many requests a worker runs at once, driven by
+    per-method execution latency. Latency inflating beyond each method's
+    baseline shrinks the limit, saturating the limit without inflation
+    grows it, always between the configured bounds.
+
+"""
+
+# builtin modules
+
+# third party modules
+import gevent.event
+
+# bluecollar modules
+
+# weight of the newest sample in the smoothed latency and wait
+_SMOOTHING = 0.2
+# how quickly a method's baseline latency may drift upwards per sample
+_BASELINE_DRIFT = 1.01
+
+
+class AdaptiveLimit(object):
+    """Concurrency limit between minimum and maximum. With equal bounds
+    the limit is static."""
+
+    def __init__(self, minimum, maximum, tolerance=2.0, backoff=0.9):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.limit = float(self.minimum)
+        self.in_flight = 0
+        # smoothed queue wait across all methods
+        self.wait_time = 0.0
+        self._latency = {}
+        self._baseline = {}
+        # completions since the last decrease, so we back off at most
+        # once per window of requests
+        self._since_decrease = 0
+        self._capacity = gevent.event.Event()
+        self._capacity.set()
+
+    def capacity(self):
+        """How many more requests may start now"""
+        return max(0, int(self.limit) - self.in_flight)
+
+    def wait(self, timeout=None):
+        """Wait until a request may start, returns False on timeout"""
+        return self._capacity.wait(timeout)
+
+    def acquire(self):
+        """A request has started"""
+        self.in_flight += 1
+        if not self.capacity():
+            self._capacity.clear()
+
+    def release(self, method, latency, wait=0.0):
+        """A request has finished, adjust the limit from its latency. With
+        latency None it only frees the request's slot."""
+        saturated = self.in_flight >= int(self.limit)
+        self.in_flight -= 1
+        self.wait_time += _SMOOTHING * (wait - self.wait_time)
+        if latency is None:
+            if self.capacity():
+                self._capacity.set()
+            return
+        smoothed = self._latency.get(method, latency)
+        smoothed += _SMOOTHING * (latency - smoothed)
+        self._latency[method] = smoothed
+        baseline = min(smoothed,
+                self._baseline.get(method, smoothed) * _BASELINE_DRIFT)
+        self._baseline[method] = baseline
+        self._since_decrease += 1
+
+        if self.minimum < self.maximum:
+            if (smoothed > baseline * self.tolerance and
+                    self._since_decrease >= self.limit):
+                # latency is inflating, we're past what this worker can run
+                self.limit = max(self.minimum, self.limit * self.backoff)
+                self._since_decrease = 0
+            elif saturated:
+                # we were the bottleneck and latency held, open up a little
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+        if self.capacity():
+            self._capacity.set()
+        else:
+            self._capacity.clear()
+
+    def latencies(self):
+        """Smoothed latency per method"""
+        return dict(self._latency)
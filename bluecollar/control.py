@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Worker control plane
+    Commands are pushed to workers over Redis pub/sub, workers publish a
+    periodic heartbeat with their state and load to the worker registry
+    Use from the command line:
+     python -m bluecollar.control status
+     python -m bluecollar.control release --worker host:1234
+     python -m bluecollar.control profile --set 'methods=myapp.*'
+     python -m bluecollar.control invalidate --set method=myapp.Cls.get
+
+"""
+
+# builtin modules
+import os
+import sys
+import time
+import json
+import logging
+import argparse
+
+# third party modules
+import gevent
+import gevent.event
+import redis
+
+# bluecollar modules
+
+COMMANDS = ('release', 'drain', 'pause', 'resume', 'reconfigure',
+    'forget', 'profile')
+
+
+class WorkerControl(object):
+    """Listens for commands addressed to this worker, or to all workers,
+    and keeps the heartbeat in the registry fresh. The worker loop only
+    reads local state, it never has to ask Redis."""
+
+    def __init__(self, connection, channel, registry, worker_id, interval):
+        self.redis = connection
+        self.channel = channel
+        self.registry = registry
+        self.worker_id = worker_id
+        self.interval = interval
+        # running, paused, draining or released
+        self.state = 'running'
+        # set while the worker may take new work
+        self.resumed = gevent.event.Event()
+        self.resumed.set()
+        # returns a dict of load figures for the heartbeat
+        self.status = dict
+        # called with every heartbeat, to keep other registrations fresh
+        self.refresh = lambda: None
+        self._callbacks = {}
+        self._greenlets = []
+
+    def start(self):
+        self.heartbeat()
+        self._greenlets = [
+                gevent.spawn(self._listen),
+                gevent.spawn(self._beat),
+                ]
+
+    def stop(self):
+        """Stop listening and remove ourselves from the registry"""
+        gevent.killall(self._greenlets)
+        self.redis.hdel(self.registry, self.worker_id)
+
+    def on_command(self, command, callback):
+        """Register a callback taking a command's dict of settings"""
+        self._callbacks.setdefault(command, []).append(callback)
+
+    def on_reconfigure(self, callback):
+        """Register a callback taking a dict of new settings"""
+        self.on_command('reconfigure', callback)
+
+    def heartbeat(self):
+        status = self.status()
+        status.update({
+            'pid' : os.getpid(),
+            'state' : self.state,
+            'time' : time.time(),
+            })
+        self.redis.hset(self.registry, self.worker_id, json.dumps(status))
+        self.refresh()
+
+    def _beat(self):
+        while True:
+            gevent.sleep(self.interval)
+            try:
+                self.heartbeat()
+            except redis.exceptions.RedisError, message:
+                logging.error('Unable to send heartbeat: %s', message)
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub()
+                pubsub.subscribe([self.channel,
+                    '%s_%s' % (self.channel, self.worker_id)])
+                for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    try:
+                        command = json.loads(message['data'])
+                    except ValueError:
+                        logging.error('Invalid control message: %s',
+                                message['data'])
+                        continue
+                    self.handle(command)
+            except redis.exceptions.ConnectionError, message:
+                logging.error('Control channel lost Redis: %s', message)
+                gevent.sleep(self.interval)
+
+    def handle(self, command):
+        """Apply a control command"""
+        if type(command) is not dict or command.get('command') not in COMMANDS:
+            logging.error('Unknown control command: %s', command)
+            return
+        name = command['command']
+        logging.info('Control command: %s', name)
+        if self.state == 'released':
+            return
+        if name == 'release':
+            self.state = 'released'
+            self.resumed.set()
+        elif name == 'drain':
+            self.state = 'draining'
+            self.resumed.set()
+        elif name == 'pause':
+            self.state = 'paused'
+            self.resumed.clear()
+        elif name == 'resume':
+            self.state = 'running'
+            self.resumed.set()
+        for callback in self._callbacks.get(name, []):
+            callback(command.get('settings') or {})
+        self.heartbeat()
+
+
+def send(connection, channel, command, worker=None, settings=None):
+    """Push a command to one worker, or all of them"""
+    if worker:
+        channel = '%s_%s' % (channel, worker)
+    message = {'command' : command}
+    if settings:
+        message['settings'] = settings
+    return connection.publish(channel, json.dumps(message))
+
+def workers(connection, registry):
+    """Heartbeats of all registered workers, keyed by worker ID"""
+    return dict((worker_id, json.loads(status)) for worker_id, status in
+        connection.hgetall(registry).items())
+
+def invalidate(memo, settings):
+    """Invalidate a memoized method's stored results, or one call's when
+    settings has its args or kwargs. Done once, in Redis, the memo cache
+    tells every worker to forget its local copies."""
+    method = settings.get('method')
+    if not method:
+        raise ValueError('Invalidating needs a method')
+    if 'args' in settings or 'kwargs' in settings:
+        memo.invalidate(method, *settings.get('args', []),
+            **settings.get('kwargs', {}))
+    else:
+        memo.invalidate_method(method)
+
+def main():
+    """Command line control of workers"""
+    import bluecollar.worker as bcenv
+    parser = argparse.ArgumentParser(description='BlueCollar worker control')
+    parser.add_argument('command',
+            choices=('status', 'prune', 'invalidate') + COMMANDS)
+    parser.add_argument('--worker', help='worker ID, default all workers')
+    parser.add_argument('--set', action='append', default=[],
+            metavar='KEY=VALUE', help='setting for reconfigure')
+    options = parser.parse_args()
+    now = time.time()
+    if options.command in ('status', 'prune'):
+        for worker_id, status in sorted(
+                workers(bcenv.REDIS, bcenv.WORKER_LIST).items()):
+            age = now - status.get('time', 0)
+            stale = age > bcenv.HEARTBEAT_INTERVAL * 3
+            if options.command == 'prune':
+                if stale:
+                    bcenv.REDIS.hdel(bcenv.WORKER_LIST, worker_id)
+                    print 'Removed %s' % worker_id
+                continue
+            print '%s %s %s last seen %ds ago' % (worker_id,
+                    'STALE' if stale else status.get('state'),
+                    ' '.join('%s=%s' % item for item in sorted(
+                        status.items()) if item[0] not in ('state', 'time')),
+                    age)
+        return
+    settings = {}
+    for setting in options.set:
+        key, _, value = setting.partition('=')
+        try:
+            settings[key] = json.loads(value)
+        except ValueError:
+            settings[key] = value
+    if options.command == 'invalidate':
+        try:
+            invalidate(bcenv.MEMO, settings)
+        except (TypeError, ValueError), message:
+            parser.error('Unable to invalidate: %s' % message)
+        print 'Invalidated %s' % settings['method']
+        return
+    received = send(bcenv.REDIS, bcenv.CONTROL_CHANNEL, options.command,
+            options.worker, settings)
+    print 'Sent %s to %d listeners' % (options.command, received)
+
+if __name__ == '__main__':
+    sys.exit(main())
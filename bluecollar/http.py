@@ -11,10 +11,10 @@
 # builtins
 import os
 import sys
-import json
 import logging
 import urlparse
-import uuid
+import time
+import httplib
 
 # third party modules
 import gevent
@@ -24,6 +24,11 @@ from gevent.pywsgi import WSGIServer
 
 # bluecollar modules
 import bluecollar.worker as bcenv
+from bluecollar import codec
+from bluecollar import batch
+from bluecollar import jobs
+from bluecollar import compress
+from bluecollar.replies import get_listener, Stream
 
 # where shall we bind
 _HTTP_HOST = os.environ.get('BC_HTTP_HOST', '0.0.0.0')
@@ -35,52 +40,164 @@ except ValueError, message:
     sys.exit(1)
 _REQUEST_PREFIX = os.environ.get('BC_HTTP_PREFIX', '/')
 _REPLY_PREFIX = os.environ.get('BC_HTTP_REPLY_PREFIX', 'bc')
+# status of asynchronous jobs is found under here
+_JOB_PREFIX = os.environ.get('BC_HTTP_JOB_PREFIX', '/_jobs/')
+_COMPRESSOR = compress.Compressor()
+
+def status(response, reply_codec):
+    """Status line for a worker's reply, an error reply's response code or
+    200. Only replies that mention a response code are decoded."""
+    if reply_codec.mentions(response, 'response_code'):
+        try:
+            reply = reply_codec.decode(response)
+        except ValueError:
+            reply = None
+        if (type(reply) is dict and reply.get('error') and
+                reply.get('response_code') in httplib.responses):
+            return '%d %s' % (reply['response_code'],
+                    httplib.responses[reply['response_code']])
+    return '200 OK'
+
+def job_status(env, start_response):
+    """Status of an asynchronous job, and its result once it has one. Pass
+    wait to hold the request for up to that many seconds until it does."""
+    job_id = env['PATH_INFO'][len(_JOB_PREFIX):].strip('/')
+    kwargs = urlparse.parse_qs(env['QUERY_STRING'])
+    try:
+        wait = min(_REQUEST_TIMEOUT, abs(float(kwargs.get('wait', [0])[0])))
+    except ValueError:
+        wait = 0
+    if wait:
+        job = bcenv.JOBS.wait(job_id, wait)
+    else:
+        job = bcenv.JOBS.get(job_id)
+    if job is None:
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return ['404: No such job, or it has expired.']
+    job_codec, response = jobs.render(job_id, job)
+    response, headers = _COMPRESSOR.apply(response,
+            env.get('HTTP_ACCEPT_ENCODING'))
+    start_response('200 OK',
+            [('Content-Type', job_codec.content_type)] + headers)
+    return [response]
 
 def application(env, start_response):
     """WSGI application"""
+    if env['PATH_INFO'].startswith(_JOB_PREFIX):
+        return job_status(env, start_response)
     error = None
-    reply_channel = '%s_%s' % (_REPLY_PREFIX, uuid.uuid1().hex)
+    response = None
+    replies = get_listener(bcenv.REDIS, _REPLY_PREFIX)
+    # replies in whichever codec the client accepts
+    reply_codec = codec.negotiate(env.get('HTTP_ACCEPT'))
+    query = urlparse.parse_qs(env['QUERY_STRING'])
+    # asynchronous calls are answered at once with a job to check on
+    job_id = None
+    if (query.pop('async', None) or
+            'respond-async' in env.get('HTTP_PREFER', '')):
+        job_id = jobs.new_id()
+        header = {'job_id' : job_id}
+    else:
+        correlation_id = replies.expect()
+        header = {
+            'reply_channel' : replies.channel,
+            'correlation_id' : correlation_id,
+            # workers drop the request once we've stopped waiting
+            'deadline' : time.time() + _REQUEST_TIMEOUT,
+            }
+    header.update({
+        'enqueued' : time.time(),
+        'codec' : reply_codec.name,
+        })
+
+    def accepted():
+        # jobs are only recorded for requests we enqueue
+        if job_id:
+            bcenv.JOBS.create(reply_codec.name, job_id)
+
     if env['REQUEST_METHOD'] == 'GET':
         # GET requests, work with path and args
         if env['PATH_INFO'].startswith(_REQUEST_PREFIX):
             request = env['PATH_INFO'][len(_REQUEST_PREFIX):].split('/')
-            kwargs = urlparse.parse_qs(env['QUERY_STRING'])
-            bcenv.REDIS.rpush(bcenv.WORKER_QUEUE, json.dumps({
+            header.update({
                 'method' : request[0],
                 'args' : request[1:],
-                'kwargs' : kwargs,
-                'reply_channel' : reply_channel,
-                }))
-            response = bcenv.REDIS.blpop(reply_channel, _REQUEST_TIMEOUT)
-            if not response:
-                error = 'Timed out waiting for response.'
+                'kwargs' : query,
+                })
+            accepted()
+            bcenv.TRANSPORT.push(bcenv.ENVELOPE_CODEC.encode(header),
+                    bcenv.queue_for(request[0]))
         else:
             error = 'Expected prefix %s not found in request path.' % (
                     _REQUEST_PREFIX)
     elif env['REQUEST_METHOD'] == 'POST':
-        # POST requests, expect JSON data we can just pass on with a reply chan
-        try:
-            request = json.loads(env['wsgi.input'].read())
-        except ValueError:
-            error = 'Unable to parse JSON data in POST.'
-        if not error:
-            if type(request) != dict:
+        # POST requests, expect JSON (or msgpack) data we can just pass on
+        # with a reply chan, undecoded where we can
+        body_codec = codec.negotiate(env.get('CONTENT_TYPE'))
+        body = env['wsgi.input'].read()
+        # the method may be named in the path, which saves routing on it
+        method = None
+        if env['PATH_INFO'].startswith(_REQUEST_PREFIX):
+            method = env['PATH_INFO'][len(_REQUEST_PREFIX):].split('/')[0]
+        if not bcenv.forward(header, body, body_codec, method or None,
+                accepted):
+            try:
+                request = body_codec.decode(body)
+            except ValueError:
+                error = 'Unable to parse %s data in POST.' % body_codec.name
+            if not error and type(request) is list:
+                # a batch, answered with an array of replies in order,
+                # never as a job
+                job_id = None
+                response = batch.call(replies, request, reply_codec,
+                        _REQUEST_TIMEOUT)
+            elif not error and type(request) != dict:
                 error = \
                     'Expected dict in POST data, received %s' % type(request)
-            request['reply_channel'] = reply_channel
-            bcenv.REDIS.rpush(bcenv.WORKER_QUEUE, json.dumps(request))
-            response = bcenv.REDIS.blpop(reply_channel, _REQUEST_TIMEOUT)
-            if not response:
-                error = 'Timed out waiting for response.'
+            elif not error:
+                request = codec.strip(request)
+                request.update(header)
+                if method:
+                    request['method'] = method
+                accepted()
+                bcenv.TRANSPORT.push(bcenv.ENVELOPE_CODEC.encode(request),
+                        bcenv.queue_for(request.get('method')))
     else:
+        error = 501
+    if 'correlation_id' in header and (error or response is not None):
+        replies.cancel(header['correlation_id'])
+    if error == 501:
         start_response('501 Not Implemented', [('Content-Type', 'text/plain')])
         return ['501: Method not implemented. Only GET/POST are expected.']
+    if not error and job_id:
+        # accepted, the job's status says where it's up to
+        job_codec, response = jobs.render(job_id, bcenv.JOBS.get(job_id))
+        start_response('202 Accepted', [
+            ('Content-Type', job_codec.content_type),
+            ('Location', '%s%s' % (_JOB_PREFIX, job_id))])
+        return [response]
+    if not error and response is None:
+        response = replies.wait(header['correlation_id'], _REQUEST_TIMEOUT)
+        if response is None:
+            error = 'Timed out waiting for response.'
     if error:
         start_response('500 Internal Server Error', [('Content-Type',
             'text/plain')])
         return ['500: %s' % error]
-    start_response('200 OK', [('Content-Type','application/json')])
-    return [response[1]]
+    if isinstance(response, Stream):
+        # sent with chunked transfer encoding as the worker produces it
+        body, headers = _COMPRESSOR.apply_stream(response.body(reply_codec),
+                env.get('HTTP_ACCEPT_ENCODING'))
+        start_response('200 OK',
+                [('Content-Type', reply_codec.content_type)] + headers)
+        return body
+    response, headers = _COMPRESSOR.apply(response,
+            env.get('HTTP_ACCEPT_ENCODING'))
+    # the worker tells us when the request was bad, say a POST body it
+    # couldn't decode, or for something it couldn't find
+    start_response(status(response, reply_codec),
+            [('Content-Type', reply_codec.content_type)] + headers)
+    return [response]
 
 if __name__ == '__main__':
     logging.info('BlueCollar HTTP Server at %s:%d', _HTTP_HOST, _HTTP_PORT)
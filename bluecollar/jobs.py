@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Asynchronous jobs
+    A call submitted as a job is answered at once with its job ID. The
+    worker keeps the job's status and encoded result in a Redis hash that
+    expires after a TTL, and publishes each change so clients polling or
+    subscribed for the job hear of it without asking Redis again.
+
+"""
+
+# builtin modules
+import time
+import uuid
+import logging
+
+# third party modules
+import gevent.event
+import redis
+
+# bluecollar modules
+from bluecollar import codec
+from bluecollar.pubsub import Subscriber, get_multiplexer
+
+# a job is finished once it reaches one of these
+FINISHED = ('done', 'failed')
+
+# update a job's hash only if it exists, so workers can't be made to write
+# jobs nobody created
+_UPDATE_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('hmset', KEYS[1], unpack(ARGV, 3))
+redis.call('expire', KEYS[1], ARGV[1])
+redis.call('publish', KEYS[2], ARGV[2])
+return 1
+"""
+
+def new_id():
+    """A new job ID, front ends may hand it out before the job is
+    created"""
+    return uuid.uuid1().hex
+
+
+class JobStore(object):
+    """Status and results of jobs, one hash each"""
+
+    def __init__(self, connection, prefix, ttl):
+        self.redis = connection
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def key(self, job_id):
+        return '%s:%s' % (self.prefix, job_id)
+
+    def channel(self, job_id):
+        """Where changes to a job are published"""
+        return '%s_%s' % (self.prefix, job_id)
+
+    def create(self, codec_name, job_id=None):
+        """Record a new queued job, returns its ID"""
+        job_id = job_id or new_id()
+        fields = {
+            'status' : 'queued',
+            'codec' : codec_name,
+            'submitted' : time.time(),
+            }
+        key = self.key(job_id)
+        try:
+            pipe = self.redis.pipeline(transaction=True)
+            pipe.hmset(key, fields)
+            pipe.expire(key, self.ttl)
+            pipe.publish(self.channel(job_id), fields['status'])
+            pipe.execute()
+        except redis.exceptions.ConnectionError, message:
+            logging.error('Unable to create job %s: %s', job_id, message)
+        return job_id
+
+    def start(self, job_id):
+        self._update(job_id, {
+            'status' : 'running',
+            'started' : time.time(),
+            })
+
+    def finish(self, job_id, payload, failed=False):
+        """Store a job's encoded result, or error"""
+        self._update(job_id, {
+            'status' : 'failed' if failed else 'done',
+            'result' : payload,
+            'finished' : time.time(),
+            })
+
+    def _update(self, job_id, fields):
+        """Update a job that has been created"""
+        args = []
+        for item in fields.items():
+            args.extend(item)
+        try:
+            if not self.redis.execute_command('EVAL', _UPDATE_SCRIPT, 2,
+                    self.key(job_id), self.channel(job_id), self.ttl,
+                    fields['status'], *args):
+                logging.error('No job %s to update', job_id)
+        except redis.exceptions.RedisError, message:
+            logging.error('Unable to update job %s: %s', job_id, message)
+
+    def get(self, job_id):
+        """A job's fields, or None if there's no such job"""
+        return self.redis.hgetall(self.key(job_id)) or None
+
+    def wait(self, job_id, timeout):
+        """A job's fields once it has finished, or as they are after
+        timeout seconds. None if there's no such job."""
+        finished = gevent.event.Event()
+        subscriber = Subscriber(lambda frame: finished.set(), backlog=0)
+        multiplexer = get_multiplexer(self.redis)
+        # subscribe before looking, so we can't miss the job finishing
+        multiplexer.subscribe(subscriber, [self.channel(job_id)],
+            confirm=False)
+        try:
+            deadline = time.time() + timeout
+            while True:
+                finished.clear()
+                job = self.get(job_id)
+                remaining = deadline - time.time()
+                if (not job or job.get('status') in FINISHED or
+                        remaining <= 0):
+                    return job
+                finished.wait(remaining)
+        finally:
+            multiplexer.close(subscriber)
+
+
+def render(job_id, job):
+    """A job's status encoded in the job's codec, its result included as
+    stored. Returns the codec and the encoded status."""
+    job_codec = codec.get(job.get('codec'))
+    fields = {'job' : job_id, 'status' : job.get('status')}
+    for name in ('submitted', 'started', 'finished'):
+        if name in job:
+            fields[name] = float(job[name])
+    if 'result' in job:
+        return job_codec, job_codec.wrap(fields, 'result', job['result'])
+    return job_codec, job_codec.encode(fields)
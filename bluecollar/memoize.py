@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Result memoization
+    Encoded results of methods marked with prototype.memoize are kept in a
+    per-process LRU and, when shared, in Redis for every worker to use.
+    A hit sends the stored reply without running the method.
+
+"""
+
+# builtin modules
+import time
+import json
+import hashlib
+import logging
+import collections
+
+# third party modules
+import redis
+
+# bluecollar modules
+from bluecollar import codec
+
+
+def call_key(prefix, method, args, kwargs):
+    """Key identifying a call by method and arguments"""
+    digest = hashlib.sha1(json.dumps([args, kwargs],
+        sort_keys=True)).hexdigest()
+    return '%s:%s:%s' % (prefix, method, digest)
+
+
+class MemoCache(object):
+    """Two tier cache of encoded results keyed by method and arguments"""
+
+    def __init__(self, connection, prefix, size):
+        self.redis = connection
+        self.prefix = prefix
+        self.size = size
+        # key -> (expiry time, encoded result), oldest first
+        self._local = collections.OrderedDict()
+        # called with the keys, or method, of every invalidation so other
+        # processes can drop their local copies
+        self.broadcast = None
+        # method -> generation, invalidating a method starts a new one
+        self._generations = {}
+
+    def key(self, method, args, kwargs, codec_name='json'):
+        """Results are cached in the codec they were encoded with, under
+        the method's current generation"""
+        return '%s:%s' % (call_key('%s:%s' % (self.prefix, codec_name),
+            method, args, kwargs), self._generation(method))
+
+    def _generation(self, method):
+        generation = self._generations.get(method)
+        if generation is None:
+            try:
+                generation = self.redis.get(self._counter(method)) or '0'
+            except redis.exceptions.ConnectionError, message:
+                logging.error('Memo cache unavailable: %s', message)
+                return '0'
+            self._generations[method] = generation
+        return generation
+
+    def _keys(self, method, args, kwargs):
+        """Keys of a call in every codec"""
+        return [self.key(method, args, kwargs, name) for name in
+            codec.CODECS]
+
+    def _counter(self, method):
+        return '%s:generation:%s' % (self.prefix, method)
+
+    def get(self, key, shared=True):
+        """Encoded result for key, or None"""
+        entry = self._local.pop(key, None)
+        if entry is not None:
+            if entry[0] > time.time():
+                # most recently used goes to the end
+                self._local[key] = entry
+                return entry[1]
+        if not shared:
+            return None
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.get(key)
+            pipe.ttl(key)
+            payload, ttl = pipe.execute()
+        except redis.exceptions.ConnectionError, message:
+            logging.error('Memo cache unavailable: %s', message)
+            return None
+        if payload is not None and ttl > 0:
+            self._store_local(key, payload, ttl)
+        return payload
+
+    def _store_local(self, key, payload, ttl):
+        if not self.size:
+            return
+        self._local[key] = (time.time() + ttl, payload)
+        while len(self._local) > self.size:
+            self._local.popitem(last=False)
+
+    def set(self, method, key, payload, ttl, shared=True):
+        """Keep an encoded result for ttl seconds"""
+        self._store_local(key, payload, ttl)
+        if not shared:
+            return
+        try:
+            self.redis.setex(key, ttl, payload)
+        except redis.exceptions.ConnectionError, message:
+            logging.error('Memo cache unavailable: %s', message)
+
+    def forget(self, keys=None, method=None):
+        """Drop local copies of keys, or of everything for method"""
+        if method:
+            # its generation has moved on
+            self._generations.pop(method, None)
+            prefixes = tuple('%s:%s:%s:' % (self.prefix, name, method)
+                for name in codec.CODECS)
+            keys = [key for key in self._local if key.startswith(prefixes)]
+        for key in keys or []:
+            self._local.pop(key, None)
+
+    def invalidate(self, method, *args, **kwargs):
+        """Invalidate the result of one call"""
+        keys = self._keys(method, list(args), kwargs)
+        self.forget(keys)
+        self.redis.delete(*keys)
+        if self.broadcast:
+            self.broadcast({'keys' : keys})
+
+    def invalidate_method(self, method):
+        """Invalidate every stored result for method by starting a new
+        generation of its keys, the old ones are left to expire"""
+        self.redis.incr(self._counter(method))
+        self.forget(method=method)
+        if self.broadcast:
+            self.broadcast({'method' : method})
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Per-method metrics
+    Workers keep histograms of each method's execution time, queue wait,
+    reply encode time and reply size in mmstats, one file per method, so
+    recording is a bucket lookup and a counter bump with no locks.
+    Use from the command line to total every process on this host:
+     python -m bluecollar.metrics
+     python -m bluecollar.metrics --method 'myapp.*'
+
+"""
+
+# builtin modules
+import os
+import sys
+import glob
+import bisect
+import fnmatch
+import tempfile
+import argparse
+
+# third party modules
+import mmstats
+
+# bluecollar modules
+
+# name, unit, scale from what's recorded to the unit, upper bounds of
+# the buckets in the unit, there's always one more for anything above
+HISTOGRAMS = (
+    ('exec', 'ms', 1000,
+        (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)),
+    ('wait', 'ms', 1000,
+        (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)),
+    ('encode', 'ms', 1000, (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)),
+    ('size', 'bytes', 1,
+        (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)),
+    )
+# methods beyond the limit share the histograms of this one
+OTHER = '_other'
+# mmstats writes its files here unless told otherwise
+DEFAULT_PATH = os.environ.get('MMSTATS_PATH', tempfile.gettempdir())
+
+def _stats_class():
+    """mmstats with a counter for every bucket and a sum of every
+    histogram, labelled name_unit.le_bound and name_unit.sum"""
+    fields = {}
+    for name, unit, scale, bounds in HISTOGRAMS:
+        for index, bound in enumerate(bounds + ('inf',)):
+            fields['%s_%d' % (name, index)] = mmstats.CounterField(
+                label='%s_%s.le_%s' % (name, unit, bound))
+        fields['%s_sum' % name] = mmstats.DoubleField(
+            label='%s_%s.sum' % (name, unit))
+    return type('MethodStats', (mmstats.MmStats,), fields)
+_MethodStats = _stats_class()
+
+
+class Histograms(object):
+    """Histograms of one method"""
+
+    def __init__(self, label_prefix, filename):
+        self.stats = _MethodStats(label_prefix=label_prefix,
+            filename=filename)
+        # field names of each histogram's buckets, worked out once
+        self._fields = dict((name, (scale, bounds, ['%s_%d' % (name, index)
+            for index in range(len(bounds) + 1)], '%s_sum' % name))
+            for name, unit, scale, bounds in HISTOGRAMS)
+        self._sums = dict((name, 0.0) for name in self._fields)
+
+    def record(self, name, value):
+        """Add a value, in seconds or bytes, to a histogram"""
+        scale, bounds, buckets, total = self._fields[name]
+        value *= scale
+        getattr(self.stats, buckets[bisect.bisect_left(bounds, value)]).inc()
+        self._sums[name] += value
+        setattr(self.stats, total, self._sums[name])
+
+
+class MethodMetrics(object):
+    """Histograms of each method this process runs, created the first time
+    a method is seen. Once limit methods have them, the rest share one."""
+
+    def __init__(self, label_prefix, limit=200):
+        self.label_prefix = label_prefix
+        self.limit = limit
+        self._methods = {}
+
+    def get(self, method):
+        """The histograms for a method, or None if metrics are off"""
+        histograms = self._methods.get(method)
+        if histograms is None and self.limit:
+            if len(self._methods) >= self.limit:
+                method = OTHER
+                histograms = self._methods.get(method)
+            if histograms is None:
+                histograms = self._methods[method] = Histograms(
+                    '%smethod.%s.' % (self.label_prefix, method),
+                    'mmstats-%%PID%%-%%TID%%-method%d' % len(self._methods))
+        return histograms
+
+
+def read(path=DEFAULT_PATH, live=True):
+    """Every stat in the mmstats files under path, as (label, value). Only
+    files of running processes are read if live."""
+    from mmstats.reader import MmStatsReader
+    for filename in glob.glob(os.path.join(path, 'mmstats-*')):
+        if live:
+            try:
+                os.kill(int(os.path.basename(filename).split('-')[1]), 0)
+            except (ValueError, IndexError):
+                pass
+            except OSError:
+                continue
+        try:
+            for label, value in MmStatsReader.from_mmap(filename):
+                yield label, value
+        except Exception, message:
+            print >> sys.stderr, 'Unable to read %s: %s' % (filename,
+                message)
+
+def aggregate(stats):
+    """Totals of each label across processes. Counters and sums are added,
+    other measurements averaged."""
+    totals, counts = {}, {}
+    for label, value in stats:
+        if not isinstance(value, (int, long, float)):
+            continue
+        totals[label] = totals.get(label, 0) + value
+        counts[label] = counts.get(label, 0) + 1
+    for label, value in totals.items():
+        if isinstance(value, float) and not label.endswith('.sum'):
+            totals[label] = value / counts[label]
+    return totals
+
+def percentile(buckets, fraction):
+    """The upper bound of the bucket the fraction of values falls in, from
+    (bound, count) in order"""
+    wanted = sum(count for _, count in buckets) * fraction
+    seen = 0
+    for bound, count in buckets:
+        seen += count
+        if count and seen >= wanted:
+            return bound
+    return None
+
+def histograms(totals, label_prefix):
+    """Method histograms from aggregated stats, keyed by method then
+    name_unit, each (count, sum, [(bound, count), ...])"""
+    prefix = '%smethod.' % label_prefix
+    found = {}
+    for label, value in totals.items():
+        if not label.startswith(prefix):
+            continue
+        try:
+            method, name, field = label[len(prefix):].rsplit('.', 2)
+        except ValueError:
+            continue
+        histogram = found.setdefault(method, {}).setdefault(name,
+            {'buckets' : [], 'sum' : 0.0})
+        if field == 'sum':
+            histogram['sum'] = value
+        elif field.startswith('le_'):
+            bound = field[3:]
+            histogram['buckets'].append(
+                (float(bound) if bound != 'inf' else float('inf'), value))
+    for method in found.values():
+        for name, histogram in method.items():
+            buckets = sorted(histogram['buckets'])
+            method[name] = (sum(count for _, count in buckets),
+                histogram['sum'], buckets)
+    return found
+
+def main():
+    """Print the per-method histograms of every process on this host"""
+    parser = argparse.ArgumentParser(description='BlueCollar metrics')
+    parser.add_argument('--path', default=DEFAULT_PATH,
+            help='where mmstats files are, default %s' % DEFAULT_PATH)
+    parser.add_argument('--prefix', default=os.environ.get(
+            'BC_WORKER_STATSLABEL', 'me.s-n.bluecollar.worker.'),
+            help='label prefix of the workers')
+    parser.add_argument('--method', default='*',
+            help='only methods matching this pattern')
+    parser.add_argument('--all', action='store_true',
+            help='include files of processes that have exited')
+    parser.add_argument('--raw', action='store_true',
+            help='print every aggregated stat instead')
+    options = parser.parse_args()
+    totals = aggregate(read(options.path, not options.all))
+    if options.raw:
+        for label, value in sorted(totals.items()):
+            print '%s %s' % (label, value)
+        return
+    for method, found in sorted(histograms(totals, options.prefix).items()):
+        if not fnmatch.fnmatchcase(method, options.method):
+            continue
+        print method
+        for name in sorted(found):
+            count, total, buckets = found[name]
+            if not count:
+                continue
+            print '  %-12s n=%d mean=%.1f p50=%s p90=%s p99=%s' % (name,
+                count, total / count, percentile(buckets, 0.5),
+                percentile(buckets, 0.9), percentile(buckets, 0.99))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Process pool
+    Pre-forked subprocesses that run CPU-bound methods outside the worker's
+    gevent hub. Calls and results cross the process boundary as
+    length-prefixed pickles over unix sockets, and the calling greenlet
+    waits cooperatively for the reply.
+
+"""
+
+# builtin modules
+import os
+import errno
+import signal
+import socket
+import struct
+import _socket
+import logging
+import cPickle
+import tempfile
+
+# third party modules
+import gevent
+import gevent.queue
+import gevent.socket
+
+# bluecollar modules
+
+_HEADER = struct.Struct('!I')
+
+
+class OffloadError(Exception):
+    """A method failed in, or could not be sent to, a subprocess"""
+    pass
+
+
+def _write(fd, data, cooperative):
+    while data:
+        if cooperative:
+            gevent.socket.wait_write(fd)
+        try:
+            written = os.write(fd, data)
+        except OSError, err:
+            if err.errno == errno.EAGAIN:
+                continue
+            raise
+        data = data[written:]
+
+def _read(fd, size, cooperative):
+    chunks = []
+    while size:
+        if cooperative:
+            gevent.socket.wait_read(fd)
+        try:
+            chunk = os.read(fd, size)
+        except OSError, err:
+            if err.errno == errno.EAGAIN:
+                continue
+            raise
+        if not chunk:
+            raise EOFError()
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+def _pack(message):
+    data = cPickle.dumps(message, cPickle.HIGHEST_PROTOCOL)
+    return _HEADER.pack(len(data)) + data
+
+def send_message(fd, message, cooperative=True):
+    _write(fd, _pack(message), cooperative)
+
+def receive_message(fd, cooperative=True):
+    size = _HEADER.unpack(_read(fd, _HEADER.size, cooperative))[0]
+    return cPickle.loads(_read(fd, size, cooperative))
+
+
+def _serve(resolve, fd):
+    """Pool member main loop, never returns"""
+    status = 0
+    try:
+        while True:
+            try:
+                method, args, kwargs = receive_message(fd, False)
+            except EOFError:
+                # the worker has gone, so should we
+                break
+            func = resolve(method)
+            if func is None:
+                result = (False, 'Failed to find class or function at %s'
+                        % method)
+            else:
+                try:
+                    result = (True, func(*args, **kwargs))
+                except Exception, message:
+                    result = (False, str(message))
+            try:
+                data = _pack(result)
+            except Exception, message:
+                # generators and the like can't be sent back
+                data = _pack((False, 'Unable to return result: %s' %
+                    message))
+            _write(fd, data, False)
+    except Exception, message:
+        logging.error('Process pool member failed: %s', message)
+        status = 1
+    finally:
+        os._exit(status)
+
+
+class _Zygote(object):
+    """A process forked before the worker has started any greenlets or
+    opened any connections, which forks pool members when asked. Members
+    connect back to the worker over a unix socket, so none of them ever
+    holds a copy of the worker's running state."""
+
+    def __init__(self, resolve):
+        self.path = os.path.join(tempfile.mkdtemp(prefix='bluecollar-'),
+            'pool')
+        self.listener = gevent.socket.socket(socket.AF_UNIX,
+            socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen(16)
+        request_read, self.request_fd = os.pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            os.close(self.request_fd)
+            self.listener.close()
+            self._run(resolve, request_read)
+        os.close(request_read)
+
+    def _run(self, resolve, request_fd):
+        """Zygote main loop, forks a member for each byte read, never
+        returns"""
+        # the worker handles signals and cleanup, members reap themselves
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        status = 0
+        try:
+            while os.read(request_fd, 1):
+                if os.fork() == 0:
+                    os.close(request_fd)
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    gevent.reinit()
+                    # a plain blocking socket, not gevent's
+                    member = _socket.socket(_socket.AF_UNIX,
+                        _socket.SOCK_STREAM)
+                    member.connect(self.path)
+                    send_message(member.fileno(), os.getpid(), False)
+                    _serve(resolve, member.fileno())
+        except Exception, message:
+            logging.error('Process pool zygote failed: %s', message)
+            status = 1
+        finally:
+            os._exit(status)
+
+    def fork(self):
+        """A new member, returns its pid and the socket to talk to it"""
+        os.write(self.request_fd, 'f')
+        with gevent.Timeout(10, OffloadError('Pool member did not start')):
+            connection, _ = self.listener.accept()
+            return receive_message(connection.fileno()), connection
+
+    def close(self):
+        os.close(self.request_fd)
+        self.listener.close()
+        try:
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+        os.unlink(self.path)
+        os.rmdir(os.path.dirname(self.path))
+
+
+class _Subprocess(object):
+    """One pool member and the socket to talk to it"""
+
+    def __init__(self, zygote):
+        self.pid, self.connection = zygote.fork()
+        self.fd = self.connection.fileno()
+
+    def call(self, data):
+        """Send a packed call, returns the packed reply"""
+        _write(self.fd, data, True)
+        size = _read(self.fd, _HEADER.size, True)
+        return _read(self.fd, _HEADER.unpack(size)[0], True)
+
+    def close(self):
+        # the member exits once it reads the end of the connection
+        self.connection.close()
+
+
+class ProcessPool(object):
+    """Pool of subprocesses, each running one call at a time. resolve
+    takes a method path and returns the callable to run. Start it before
+    anything else, members are forked from a copy of the worker as it
+    is then."""
+
+    def __init__(self, size, resolve):
+        self.size = size
+        self.resolve = resolve
+        self._idle = gevent.queue.Queue()
+        self._members = []
+        self._zygote = None
+
+    def start(self):
+        self._zygote = _Zygote(self.resolve)
+        for _ in range(self.size):
+            self._add()
+        logging.info('Started %d process pool members', self.size)
+
+    def _add(self):
+        member = _Subprocess(self._zygote)
+        self._members.append(member)
+        self._idle.put(member)
+
+    def _replace(self, member):
+        self._members.remove(member)
+        member.close()
+        self._add()
+
+    def apply(self, method, *args, **kwargs):
+        """Run method in a subprocess, waiting cooperatively for the result"""
+        try:
+            call = _pack((method, args, kwargs))
+        except Exception, message:
+            # nothing was sent, the member is still good
+            raise OffloadError('Unable to send call: %s' % message)
+        member = self._idle.get()
+        healthy = False
+        try:
+            reply = member.call(call)
+            healthy = True
+        except (EOFError, OSError), message:
+            logging.error('Process pool member %d failed: %s',
+                    member.pid, message)
+            raise OffloadError('Process pool call failed: %s' % message)
+        finally:
+            if healthy:
+                self._idle.put(member)
+            else:
+                # the member died, or we were interrupted with a reply
+                # outstanding, so it can't be reused
+                self._replace(member)
+        try:
+            success, result = cPickle.loads(reply)
+        except Exception, message:
+            raise OffloadError('Unable to read result: %s' % message)
+        if not success:
+            raise OffloadError(result)
+        return result
+
+    def stop(self):
+        for member in self._members:
+            member.close()
+        self._members = []
+        if self._zygote:
+            self._zygote.close()
+            self._zygote = None
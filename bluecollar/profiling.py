@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Method profiling
+    Switched on for a while at runtime, by control command or signal, for
+    methods matching some patterns. Matching calls are run under cProfile,
+    only while their own greenlet is running where greenlet can trace
+    switches, and time spent switched out is counted per method. When the
+    window closes, the aggregated pstats and switch timings are written to
+    disk. Calls pay for one attribute check while it's off.
+
+"""
+
+# builtin modules
+import os
+import time
+import random
+import fnmatch
+import logging
+import cProfile
+import pstats
+
+# third party modules
+import gevent
+import greenlet
+
+# bluecollar modules
+
+# greenlet only traces switches from 0.4, without it one call is profiled
+# at a time so others don't show up in its profile
+_TRACING = hasattr(greenlet, 'settrace')
+
+
+class Profiler(object):
+    """Profiles calls to matching methods within a window"""
+
+    def __init__(self, path, name, max_duration=300):
+        self.path = path
+        self.name = name
+        self.max_duration = max_duration
+        # checked for every call, so kept as a plain attribute
+        self.active = False
+        self._patterns = ()
+        self._sample = 1.0
+        self._timer = None
+        # greenlet -> (method, profile), for the calls being profiled
+        self._running = {}
+        # greenlet -> when it was switched out
+        self._parked = {}
+        # greenlet -> [switches, seconds switched out]
+        self._switches = {}
+        self._previous_trace = None
+        self._stats = None
+        # method -> [calls, switches, seconds switched out, seconds]
+        self._methods = {}
+
+    def start(self, patterns=('*',), duration=60, sample=1.0):
+        """Profile methods matching patterns for duration seconds, sampling
+        that fraction of their calls"""
+        if self.active:
+            self.stop()
+        self._patterns = tuple(patterns)
+        self._sample = sample
+        self._stats = None
+        self._methods = {}
+        if _TRACING:
+            self._previous_trace = greenlet.settrace(self._trace)
+        duration = min(duration, self.max_duration)
+        self._timer = gevent.spawn_later(duration, self.stop)
+        self.active = True
+        logging.info('Profiling %s for %ds', ', '.join(self._patterns),
+            duration)
+
+    def stop(self):
+        """Close the window, returns the files written if anything was
+        profiled"""
+        if not self.active:
+            return None
+        self.active = False
+        # the timer may be what's stopping us
+        if self._timer not in (None, gevent.getcurrent()):
+            self._timer.kill(block=False)
+        self._timer = None
+        if _TRACING:
+            greenlet.settrace(self._previous_trace)
+            self._previous_trace = None
+        return self.write()
+
+    def wants(self, method):
+        """Whether to profile this call of a method"""
+        if _TRACING or not self._running:
+            return ((self._sample >= 1 or random.random() < self._sample)
+                and any(fnmatch.fnmatchcase(method, pattern)
+                    for pattern in self._patterns))
+        return False
+
+    def call(self, method, func, args, kwargs):
+        """Run a call under the profiler"""
+        current = greenlet.getcurrent()
+        profile = cProfile.Profile()
+        self._running[current] = (method, profile)
+        switches = self._switches[current] = [0, 0.0]
+        started = time.time()
+        profile.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            self._running.pop(current, None)
+            self._switches.pop(current, None)
+            self._parked.pop(current, None)
+            if self.active:
+                self._add(method, profile, switches, time.time() - started)
+
+    def _trace(self, event, args):
+        if event in ('switch', 'throw'):
+            origin, target = args
+            now = time.time()
+            if origin in self._running:
+                self._running[origin][1].disable()
+                self._parked[origin] = now
+            if target in self._running:
+                parked = self._parked.pop(target, None)
+                if parked is not None:
+                    switches = self._switches[target]
+                    switches[0] += 1
+                    switches[1] += now - parked
+                self._running[target][1].enable()
+        if self._previous_trace is not None:
+            self._previous_trace(event, args)
+
+    def _add(self, method, profile, switches, seconds):
+        profile.create_stats()
+        if self._stats is None:
+            self._stats = pstats.Stats(profile)
+        else:
+            self._stats.add(profile)
+        totals = self._methods.setdefault(method, [0, 0, 0.0, 0.0])
+        totals[0] += 1
+        totals[1] += switches[0]
+        totals[2] += switches[1]
+        totals[3] += seconds
+
+    def write(self):
+        """Write what's been profiled, returns the files written"""
+        if self._stats is None:
+            logging.info('Profiling finished, no calls were profiled')
+            return None
+        base = os.path.join(self.path, 'bluecollar-%s-%d' % (
+            self.name.replace(':', '-'), time.time()))
+        self._stats.dump_stats('%s.pstats' % base)
+        with open('%s.switches' % base, 'w') as timings:
+            timings.write('# method calls switches switched_out_s total_s\n')
+            for method, (calls, switches, parked, seconds) in sorted(
+                    self._methods.items()):
+                timings.write('%s %d %d %.6f %.6f\n' % (method, calls,
+                    switches, parked, seconds))
+        logging.info('Profiling finished, wrote %s.pstats', base)
+        self._stats = None
+        self._methods = {}
+        return ['%s.pstats' % base, '%s.switches' % base]
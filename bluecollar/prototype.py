@@ -12,3 +12,63 @@
 class Cacheable(object):
     """Prototype class for a cacheable class"""
     pass
+
+
+class ProcessBound(object):
+    """Prototype class whose methods run in the worker's process pool"""
+    pass
+
+
+def process_bound(fn):
+    """Mark a method or function to run in the worker's process pool"""
+    fn.process_bound = True
+    return fn
+
+
+class ThreadBound(object):
+    """Prototype class whose methods run on the worker's native threads.
+    Set thread_limit to cap how many calls to each method run at once."""
+    thread_limit = 0
+
+
+class thread_bound(object):
+    """Mark a method or function to run on the worker's native threads,
+    at most limit calls at once when given"""
+
+    def __init__(self, limit=0):
+        self._limit = limit
+
+    def __call__(self, fn):
+        fn.thread_bound = True
+        fn.thread_limit = self._limit
+        return fn
+
+
+class memoize(object):
+    """Mark a pure method or function whose encoded results the worker may
+    reuse for ttl seconds. Results are shared with other workers through
+    Redis unless shared is False."""
+
+    def __init__(self, ttl=60, shared=True):
+        self._ttl = ttl
+        self._shared = shared
+
+    def __call__(self, fn):
+        fn.memoize_ttl = self._ttl
+        fn.memoize_shared = self._shared
+        return fn
+
+
+class coalesce(object):
+    """Mark a method or function whose identical concurrent calls share one
+    execution. With cluster set, calls are shared across workers through
+    a Redis lock held for at most ttl seconds."""
+
+    def __init__(self, cluster=False, ttl=300):
+        self._cluster = cluster
+        self._ttl = ttl
+
+    def __call__(self, fn):
+        fn.coalesce = 'cluster' if self._cluster else 'local'
+        fn.coalesce_ttl = self._ttl
+        return fn
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Pub/sub multiplexer
+    Each front end process holds one Redis subscription for all of its
+    clients. Channels and patterns are subscribed while at least one client
+    wants them, and every message is encoded once per codec in use, the
+    same frame going to each subscriber.
+    Clients that poll rather than hold a socket get a mailbox buffering
+    their messages between polls. Mailboxes are kept in Redis, so any
+    front end process can answer a poll.
+
+"""
+
+# builtin modules
+import os
+import time
+import uuid
+import logging
+
+# third party modules
+import gevent
+import gevent.coros
+import gevent.event
+import gevent.queue
+import redis
+
+# bluecollar modules
+from bluecollar import codec
+
+# add a frame to a mailbox that hasn't expired, numbering it, and wake
+# anyone polling
+_PUT_SCRIPT = """
+if redis.call('exists', KEYS[2]) == 0 then
+    return 0
+end
+redis.call('rpush', KEYS[1], ARGV[1])
+if tonumber(ARGV[2]) > 0 then
+    redis.call('ltrim', KEYS[1], -tonumber(ARGV[2]), -1)
+end
+redis.call('incr', KEYS[2])
+local ttl = redis.call('ttl', KEYS[2])
+if ttl > 0 then
+    redis.call('expire', KEYS[1], ttl)
+end
+redis.call('publish', KEYS[3], '')
+return 1
+"""
+
+# keep a mailbox alive for another ttl, let go of frames before the
+# cursor and return the next frame number with the frames that are left,
+# or nil if the mailbox has expired
+_POLL_SCRIPT = """
+local next = redis.call('get', KEYS[2])
+if not next then
+    return nil
+end
+next = tonumber(next)
+redis.call('expire', KEYS[1], ARGV[2])
+redis.call('expire', KEYS[2], ARGV[2])
+local cursor = tonumber(ARGV[1])
+if cursor < 0 or cursor > next then
+    cursor = next
+end
+local first = next - redis.call('llen', KEYS[1])
+if cursor > first then
+    redis.call('ltrim', KEYS[1], cursor - first, -1)
+end
+return {next, redis.call('lrange', KEYS[1], 0, -1)}
+"""
+
+
+class Subscriber(object):
+    """One client's feed of messages. Frames are sent from the subscriber's
+    own greenlet, so a slow client can't hold up the others; once backlog
+    frames are waiting, newer ones are dropped for that client."""
+
+    def __init__(self, send, frame_codec=codec.JSON, backlog=1000):
+        self.codec = frame_codec
+        self.channels = set()
+        self.patterns = set()
+        self._queue = gevent.queue.Queue(backlog or None)
+        self._greenlet = gevent.spawn(self._run, send)
+
+    def put(self, frame):
+        try:
+            self._queue.put_nowait(frame)
+        except gevent.queue.Full:
+            logging.error('Subscriber backlog full, dropping message')
+
+    def _run(self, send):
+        while True:
+            send(self._queue.get())
+
+    def stop(self):
+        self._greenlet.kill()
+
+
+class Mailbox(Subscriber):
+    """The subscriptions feeding a polling client's mailbox, held by the
+    process that opened it. Frames are put in the mailbox from its own
+    greenlet."""
+
+    def __init__(self, mailboxes, frame_codec=codec.JSON, backlog=1000):
+        self.id = uuid.uuid1().hex
+        super(Mailbox, self).__init__(
+            lambda frame: mailboxes.put(self.id, frame), frame_codec,
+            backlog)
+
+
+class Mailboxes(object):
+    """Polling clients' mailboxes. Frames are numbered and kept in a Redis
+    list of up to backlog of them, each poll passes the number it wants
+    next as its cursor and gets every frame since, and older frames are let
+    go. A mailbox nobody has polled for ttl seconds expires, and the process
+    that opened it drops its subscriptions."""
+
+    def __init__(self, multiplexer, prefix, ttl=60, backlog=1000):
+        self.multiplexer = multiplexer
+        self.redis = multiplexer.redis
+        self.prefix = prefix
+        self.ttl = ttl
+        self.backlog = backlog
+        # the mailboxes this process opened and feeds
+        self._mailboxes = {}
+        self._greenlet = gevent.spawn(self._expire)
+
+    def _keys(self, mailbox_id):
+        """The list of frames, the next frame's number and the channel
+        pollers are woken on"""
+        key = '%s:%s' % (self.prefix, mailbox_id)
+        return key, '%s:next' % key, '%s_%s' % (self.prefix, mailbox_id)
+
+    def open(self, channels=(), patterns=()):
+        """A new mailbox subscribed to channels and patterns"""
+        mailbox = Mailbox(self, codec.JSON, self.backlog)
+        counter = self._keys(mailbox.id)[1]
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.set(counter, 0)
+        pipe.expire(counter, self.ttl)
+        pipe.execute()
+        self._mailboxes[mailbox.id] = mailbox
+        self.multiplexer.subscribe(mailbox, channels, patterns,
+            confirm=False)
+        return mailbox
+
+    def put(self, mailbox_id, frame):
+        """Add a frame to a mailbox we opened"""
+        try:
+            if not self.redis.execute_command('EVAL', _PUT_SCRIPT, 3,
+                    *(self._keys(mailbox_id) + (frame, self.backlog))):
+                # not polled for a while, stop feeding it from outside
+                # the mailbox's own greenlet
+                logging.debug('Mailbox %s expired', mailbox_id)
+                gevent.spawn(self.close, mailbox_id)
+        except redis.exceptions.RedisError, message:
+            logging.error('Unable to put in mailbox %s: %s', mailbox_id,
+                message)
+
+    def poll(self, mailbox_id, cursor, timeout):
+        """Frames numbered cursor onwards, waiting up to timeout for one
+        if there are none yet. Returns the frames and the next cursor, or
+        None if there's no such mailbox or it has expired."""
+        key, counter, channel = self._keys(mailbox_id)
+        arrived = gevent.event.Event()
+        subscriber = Subscriber(lambda frame: arrived.set(), backlog=0)
+        # subscribe before looking, so we can't miss a frame arriving
+        self.multiplexer.subscribe(subscriber, [channel], confirm=False)
+        try:
+            deadline = time.time() + timeout
+            while True:
+                arrived.clear()
+                polled = self.redis.execute_command('EVAL', _POLL_SCRIPT,
+                    2, key, counter, -1 if cursor is None else cursor,
+                    self.ttl)
+                if polled is None:
+                    return None
+                cursor, frames = polled
+                remaining = deadline - time.time()
+                if frames or remaining <= 0:
+                    return frames, cursor
+                arrived.wait(remaining)
+        finally:
+            self.multiplexer.close(subscriber)
+
+    def close(self, mailbox_id):
+        """Stop feeding a mailbox we opened"""
+        mailbox = self._mailboxes.pop(mailbox_id, None)
+        if mailbox is not None:
+            self.multiplexer.close(mailbox)
+
+    def _expire(self):
+        while True:
+            gevent.sleep(max(1, self.ttl / 2))
+            mailbox_ids = list(self._mailboxes)
+            if not mailbox_ids:
+                continue
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                for mailbox_id in mailbox_ids:
+                    pipe.exists(self._keys(mailbox_id)[1])
+                alive = pipe.execute()
+            except redis.exceptions.RedisError, message:
+                logging.error('Unable to check mailboxes: %s', message)
+                continue
+            for mailbox_id, exists in zip(mailbox_ids, alive):
+                if not exists:
+                    logging.debug('Mailbox %s expired', mailbox_id)
+                    self.close(mailbox_id)
+
+
+class Multiplexer(object):
+    """Shares one pub/sub connection between subscribers, keeping an index
+    of channel and pattern to subscribers. Only the listening greenlet
+    reads from the connection, subscription changes are written without
+    waiting for Redis to confirm them."""
+
+    def __init__(self, connection, json_helper=None):
+        self.redis = connection
+        self.json_helper = json_helper
+        self._channels = {}
+        self._patterns = {}
+        # our own connection rather than a PubSub, which reads replies to
+        # its commands and gives the connection up when nothing's left
+        self._connection = connection.connection_pool.get_connection(
+            'pubsub')
+        # commands from several greenlets go out one at a time
+        self._sending = gevent.coros.Semaphore()
+        # set once there is a subscription to listen to
+        self._active = gevent.event.Event()
+        self._greenlet = gevent.spawn(self._listen)
+
+    def subscribe(self, subscriber, channels=(), patterns=(), confirm=True):
+        """Add channels and patterns to a subscriber, only subscribing to
+        those nobody else has already"""
+        new_channels = self._add(self._channels, subscriber.channels,
+            subscriber, channels)
+        new_patterns = self._add(self._patterns, subscriber.patterns,
+            subscriber, patterns)
+        if new_channels:
+            self._send('SUBSCRIBE', new_channels)
+        if new_patterns:
+            self._send('PSUBSCRIBE', new_patterns)
+        if new_channels or new_patterns:
+            self._active.set()
+        if not confirm:
+            return
+        # confirm as Redis would if the client had its own connection
+        for kind, names in (('subscribe', channels),
+                ('psubscribe', patterns)):
+            for name in names:
+                subscriber.put(subscriber.codec.encode({
+                    'type' : kind,
+                    'pattern' : None,
+                    'channel' : name,
+                    'data' : len(subscriber.channels) +
+                        len(subscriber.patterns),
+                    }))
+
+    def unsubscribe(self, subscriber, channels=None, patterns=None):
+        """Remove channels and patterns from a subscriber, all of them if
+        None, unsubscribing from those nobody else wants"""
+        if channels is None:
+            channels = list(subscriber.channels)
+        if patterns is None:
+            patterns = list(subscriber.patterns)
+        old_channels = self._remove(self._channels, subscriber.channels,
+            subscriber, channels)
+        old_patterns = self._remove(self._patterns, subscriber.patterns,
+            subscriber, patterns)
+        if old_channels:
+            self._send('UNSUBSCRIBE', old_channels)
+        if old_patterns:
+            self._send('PUNSUBSCRIBE', old_patterns)
+
+    def close(self, subscriber):
+        """Remove a subscriber entirely"""
+        self.unsubscribe(subscriber)
+        subscriber.stop()
+
+    def _add(self, index, names, subscriber, wanted):
+        new = []
+        for name in wanted:
+            if name not in index:
+                index[name] = set()
+                new.append(name)
+            index[name].add(subscriber)
+            names.add(name)
+        return new
+
+    def _remove(self, index, names, subscriber, unwanted):
+        old = []
+        for name in unwanted:
+            names.discard(name)
+            subscribers = index.get(name)
+            if subscribers is None:
+                continue
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del index[name]
+                old.append(name)
+        return old
+
+    def _send(self, command, names):
+        with self._sending:
+            try:
+                self._connection.send_command(command, *names)
+            except redis.exceptions.ConnectionError, message:
+                # the listener resubscribes everything once it reconnects
+                logging.error('Unable to %s: %s', command.lower(), message)
+
+    def _listen(self):
+        # nothing to read until the first subscription
+        self._active.wait()
+        while True:
+            try:
+                response = self._connection.read_response()
+            except Exception, message:
+                logging.error('Pub/sub multiplexer lost Redis: %s', message)
+                gevent.sleep(1)
+                self._resubscribe()
+                continue
+            # confirmations of (un)subscribing are dropped
+            if response[0] == 'message':
+                self._deliver(self._channels, response[1], {
+                    'type' : 'message',
+                    'pattern' : None,
+                    'channel' : response[1],
+                    'data' : response[2],
+                    })
+            elif response[0] == 'pmessage':
+                self._deliver(self._patterns, response[1], {
+                    'type' : 'pmessage',
+                    'pattern' : response[1],
+                    'channel' : response[2],
+                    'data' : response[3],
+                    })
+
+    def _resubscribe(self):
+        """Reconnect with everything we had subscribed"""
+        with self._sending:
+            try:
+                self._connection.disconnect()
+                self._connection.connect()
+                if self._channels:
+                    self._connection.send_command('SUBSCRIBE',
+                        *self._channels)
+                if self._patterns:
+                    self._connection.send_command('PSUBSCRIBE',
+                        *self._patterns)
+            except redis.exceptions.ConnectionError, message:
+                logging.error('Unable to resubscribe: %s', message)
+
+    def _deliver(self, index, name, message):
+        # encode once for each codec our subscribers use
+        frames = {}
+        for subscriber in list(index.get(name, ())):
+            frame = frames.get(subscriber.codec.name)
+            if frame is None:
+                frame = frames[subscriber.codec.name] = \
+                    subscriber.codec.encode(message, self.json_helper)
+            subscriber.put(frame)
+
+
+_MULTIPLEXERS = {}
+
+def get_multiplexer(connection, json_helper=None):
+    """The multiplexer for this process and connection, started on first
+    use so that each forked front end worker gets its own"""
+    key = (os.getpid(), id(connection))
+    if key not in _MULTIPLEXERS:
+        _MULTIPLEXERS[key] = Multiplexer(connection, json_helper)
+    return _MULTIPLEXERS[key]
+
+_MAILBOXES = {}
+
+def get_mailboxes(connection, prefix, ttl, backlog, json_helper=None):
+    """Polling clients' mailboxes, as seen from this process"""
+    key = os.getpid()
+    if key not in _MAILBOXES:
+        _MAILBOXES[key] = Mailboxes(get_multiplexer(connection, json_helper),
+            prefix, ttl, backlog)
+    return _MAILBOXES[key]
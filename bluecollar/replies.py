@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Reply demultiplexer
+    One greenlet per front end process reads every reply addressed to that
+    process from a single Redis list and wakes the waiting request, so the
+    number of Redis connections no longer grows with requests in flight
+
+"""
+
+# builtin modules
+import os
+import re
+import logging
+import uuid
+
+# third party modules
+import gevent
+import gevent.event
+import redis
+
+# bluecollar modules
+
+# replies carrying a correlation ID are prefixed with it and this separator
+SEPARATOR = ':'
+# or with this one, when the payload names the list a streamed reply's
+# chunks are pushed to
+STREAM_SEPARATOR = '+'
+_TAG = re.compile(r'([0-9a-f]*)([%s%s])' % (SEPARATOR, STREAM_SEPARATOR))
+
+# each item on a stream's list starts with one of these
+CHUNK = '+'
+END = '.'
+ERROR = '!'
+
+def encode_reply(correlation_id, payload):
+    """Tag an encoded reply with the correlation ID it answers"""
+    if correlation_id is None:
+        return payload
+    return '%s%s%s' % (correlation_id, SEPARATOR, payload)
+
+def encode_stream(correlation_id, key):
+    """Tell the waiting request its reply is streamed on list key"""
+    return '%s%s%s' % (correlation_id, STREAM_SEPARATOR, key)
+
+def stream_key(reply_to, correlation_id):
+    """The list a streamed reply's chunks are pushed to"""
+    return '%s_%s' % (reply_to, correlation_id)
+
+def decode_reply(data):
+    """Split a tagged reply into (correlation ID, payload, streamed)"""
+    tag = _TAG.match(data)
+    if tag is None:
+        return '', data, False
+    return (tag.group(1), data[tag.end():],
+        tag.group(2) == STREAM_SEPARATOR)
+
+
+class StreamError(Exception):
+    """A streamed reply failed part way, payload is the encoded error"""
+
+    def __init__(self, payload):
+        super(StreamError, self).__init__(payload)
+        self.payload = payload
+
+
+class Stream(object):
+    """Chunks of a streamed reply. They are read from their own list as
+    they're consumed, so a slow client holds the worker back rather than
+    having chunks pile up in memory."""
+
+    def __init__(self, connection, key, timeout):
+        self.redis = connection
+        self.key = key
+        self.timeout = timeout
+
+    def __iter__(self):
+        """Encoded chunks until the end of the stream. Raises StreamError
+        if the method failed, or the next chunk took longer than timeout."""
+        while True:
+            item = self.redis.blpop(self.key, self.timeout)
+            if not item:
+                raise StreamError(None)
+            marker, chunk = item[1][:1], item[1][1:]
+            if marker == END:
+                return
+            if marker == ERROR:
+                raise StreamError(chunk)
+            yield chunk
+
+    def body(self, reply_codec):
+        """Pieces of one response body holding the whole stream. A failed
+        stream ends the body early, so the client sees it incomplete."""
+        try:
+            for piece in reply_codec.body(self):
+                yield piece
+        except StreamError, message:
+            logging.error('Streamed reply %s failed: %s', self.key, message)
+
+
+class ReplyListener(object):
+    """Collects replies for this process and hands them to waiting
+    requests through a table of futures keyed by correlation ID"""
+
+    # how many queued replies to drain per round trip once one arrives
+    BATCH = 100
+    # longest wait for the next chunk of a streamed reply
+    chunk_timeout = 60
+
+    def __init__(self, connection, prefix):
+        self.redis = connection
+        self.channel = '%s_%s' % (prefix, uuid.uuid1().hex)
+        self._futures = {}
+        self._greenlet = gevent.spawn(self._listen)
+        logging.debug('Reply listener on %s', self.channel)
+
+    def _listen(self):
+        while True:
+            try:
+                reply = self.redis.blpop(self.channel, 1)
+                if not reply:
+                    continue
+                replies = [reply[1]]
+                # drain anything else that arrived while we were waiting
+                pipe = self.redis.pipeline(transaction=True)
+                pipe.lrange(self.channel, 0, self.BATCH - 1)
+                pipe.ltrim(self.channel, self.BATCH, -1)
+                replies.extend(pipe.execute()[0])
+            except redis.exceptions.ConnectionError, message:
+                logging.error('Reply listener lost Redis: %s', message)
+                gevent.sleep(1)
+                continue
+            for data in replies:
+                correlation_id, payload, streamed = decode_reply(data)
+                future = self._futures.get(correlation_id)
+                if future is None:
+                    logging.debug('Discarding late reply %s', correlation_id)
+                    continue
+                if streamed:
+                    payload = Stream(self.redis, payload, self.chunk_timeout)
+                future.set(payload)
+
+    def expect(self):
+        """Register a new pending request, returns its correlation ID"""
+        correlation_id = uuid.uuid1().hex
+        self._futures[correlation_id] = gevent.event.AsyncResult()
+        return correlation_id
+
+    def wait(self, correlation_id, timeout):
+        """Wait for the reply payload, or None if none arrived in time.
+        Streamed replies are returned as a Stream of encoded chunks."""
+        future = self._futures.get(correlation_id)
+        if future is None:
+            return None
+        try:
+            return future.get(timeout=timeout)
+        except gevent.Timeout:
+            return None
+        finally:
+            self._futures.pop(correlation_id, None)
+
+    def cancel(self, correlation_id):
+        """Stop expecting a reply to a request that was never sent"""
+        self._futures.pop(correlation_id, None)
+
+    def pending(self):
+        """Number of requests waiting on a reply"""
+        return len(self._futures)
+
+
+_LISTENERS = {}
+
+def get_listener(connection, prefix):
+    """The reply listener for this process, started on first use so that
+    each forked front end worker gets its own"""
+    key = (os.getpid(), prefix)
+    if key not in _LISTENERS:
+        _LISTENERS[key] = ReplyListener(connection, prefix)
+    return _LISTENERS[key]
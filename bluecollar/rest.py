@@ -15,9 +15,9 @@ import json
 import logging
 import urlparse
 import sys
-import uuid
 import urllib
-import zlib
+import time
+import itertools
 
 # thid party modules
 import gevent
@@ -27,6 +27,11 @@ from gevent.pywsgi import WSGIServer
 
 # bluecollar modules
 import bluecollar.worker as bcenv
+from bluecollar import codec
+from bluecollar import batch
+from bluecollar import compress
+from bluecollar.replies import get_listener, Stream
+from bluecollar.routes import get_watcher
 
 # where shall we bind
 _REST_HOST = os.environ.get('BC_REST_HOST', '0.0.0.0')
@@ -40,6 +45,7 @@ _REQUEST_PREFIX = os.environ.get('BC_REST_PREFIX', '/')
 _REPLY_PREFIX = os.environ.get('BC_REST_REPLY_PREFIX', 'bc')
 _ERROR_DOC_URL = os.environ.get('BC_REST_ERROR_DOC_URL')
 _METHOD_CACHE = {}
+_COMPRESSOR = compress.Compressor()
 
 def app_error(http_code, verbose_message, env, start_response):
     """Handle application errors"""
@@ -56,10 +62,90 @@ def app_error(http_code, verbose_message, env, start_response):
         'application/json')])
     return json.dumps(error)
 
+def find_resource(replies, elements, http_method):
+    """Resolve path elements to a resource and its arguments. Resolves
+    locally from the manifest published by the workers if there is one,
+    otherwise checks cached methods and works forward through modules to
+    find a class with these methods. Returns (resource, args), resource is
+    None if nothing was found, raises gevent.Timeout if a worker didn't
+    answer."""
+    method_path = None
+    resource = None
+    args = []
+    routes = get_watcher(bcenv.REDIS, bcenv.ROUTE_MANIFEST)
+    if routes.trie.size:
+        route = routes.lookup(elements, http_method)
+        if route:
+            resource, used = route
+            args = elements[used:]
+        # the manifest is authoritative, skip probing through the queue
+        elements = []
+    for index, element in enumerate(elements):
+        if method_path:
+            method_path += '.%s' % element
+        else:
+            method_path = element
+        if _METHOD_CACHE.has_key(method_path):
+            if _METHOD_CACHE[method_path] is False:
+                continue
+            else:
+                resource = method_path
+                args = elements[_METHOD_CACHE[method_path]:]
+                break
+        correlation_id = replies.expect()
+        bcenv.TRANSPORT.push(bcenv.ENVELOPE_CODEC.encode({
+            'method' : '%s.http_%s' % (method_path, http_method),
+            'no_exec' : True,
+            'reply_channel' : replies.channel,
+            'correlation_id' : correlation_id,
+            'enqueued' : time.time(),
+            'deadline' : time.time() + _REQUEST_TIMEOUT,
+            }))
+        response = replies.wait(correlation_id, _REQUEST_TIMEOUT)
+        if response is None:
+            raise gevent.Timeout(_REQUEST_TIMEOUT)
+        response = json.loads(response)
+        if type(response) is dict and response.get('found'):
+            resource = method_path
+            args = elements[index+1:]
+            _METHOD_CACHE[method_path] = index+1
+            break
+        else:
+            _METHOD_CACHE[method_path] = False
+    return resource, args
+
+def batch_items(replies, requests):
+    """Batch items from REST requests, dicts of path, HTTP method (get by
+    default) and kwargs"""
+    items = []
+    for request in requests:
+        if type(request) is not dict or not isinstance(
+                request.get('path'), basestring):
+            items.append(batch.Failed(400, 'Expected a request with a path.'))
+            continue
+        http_method = str(request.get('method') or 'get').lower()
+        try:
+            resource, args = find_resource(replies,
+                request['path'].strip('/').split('/'), http_method)
+        except gevent.Timeout:
+            items.append(batch.Failed(504,
+                'Application did not respond in a timely fashion.'))
+            continue
+        if not resource:
+            items.append(batch.Failed(404,
+                'No supported server method found.'))
+            continue
+        items.append({
+            'method' : '%s.http_%s' % (resource, http_method),
+            'args' : args,
+            'kwargs' : request.get('kwargs') or {},
+            })
+    return items
+
 def application(env, start_response):
     """WSGI REST application"""
     callback = None
-    reply_channel = '%s_%s' % (_REPLY_PREFIX, uuid.uuid1().hex)
+    replies = get_listener(bcenv.REDIS, _REPLY_PREFIX)
     kwargs = urlparse.parse_qs(env['QUERY_STRING'])
     if kwargs.get('callback'):
         callback = kwargs['callback'][0]
@@ -75,6 +161,25 @@ def application(env, start_response):
         return []
     if http_method == 'post':
         post_data = env['wsgi.input'].read()
+        body_codec = codec.negotiate(env.get('CONTENT_TYPE'), None)
+        if env['PATH_INFO'] == _REQUEST_PREFIX and body_codec:
+            # a batch of requests posted to the prefix itself
+            try:
+                requests = body_codec.decode(post_data)
+            except ValueError:
+                requests = None
+            if type(requests) is not list:
+                return app_error(400,
+                    'Expected a list of requests to run as a batch.',
+                    env, start_response)
+            reply_codec = codec.negotiate(env.get('HTTP_ACCEPT'))
+            reply = batch.call(replies, batch_items(replies, requests),
+                reply_codec, _REQUEST_TIMEOUT)
+            reply, headers = _COMPRESSOR.apply(reply,
+                    env.get('HTTP_ACCEPT_ENCODING'))
+            start_response('200 OK', [('Access-Control-Allow-Origin', '*'),
+                ('Content-Type', reply_codec.content_type)] + headers)
+            return [reply]
         kwargs.update(urlparse.parse_qs(post_data))
     if not env['PATH_INFO'].startswith(_REQUEST_PREFIX):
         # doesn't look like this request is for us
@@ -83,76 +188,65 @@ def application(env, start_response):
             env, start_response)
     request = env['PATH_INFO'][len(_REQUEST_PREFIX):]
     elements = request.split('/')
+    # replies in whichever codec the client accepts, JSONP is always JSON
+    reply_codec = codec.negotiate(env.get('HTTP_ACCEPT'))
     if elements[-1].rfind('.') > 0:
         # strip the file extension from the last element
         extension = elements[-1][elements[-1].rfind('.'):]
         elements[-1] = elements[-1][:-len(extension)]
-        if extension != '.json':
+        if extension[1:] not in codec.CODECS:
             return app_error(406,
                 'Unsupported content type %s.' % extension[1:],
                 env, start_response)
-    # check cached methods, otherwise work forward through modules to find
-    # a class with these methods
-    method_path = None
-    resource = None
-    args = []
-    for index, element in enumerate(elements):
-        if method_path:
-            method_path += '.%s' % element
-        else:
-            method_path = element
-        if _METHOD_CACHE.has_key(method_path):
-            if _METHOD_CACHE[method_path] is False:
-                continue
-            else:
-                resource = method_path
-                args = elements[_METHOD_CACHE[method_path]:]
-                break
-        bcenv.REDIS.rpush(bcenv.WORKER_QUEUE, json.dumps({
-            'method' : '%s.http_%s' % (method_path, http_method),
-            'no_exec' : True,
-            'reply_channel' : reply_channel
-            }))
-        response = bcenv.REDIS.blpop(reply_channel, _REQUEST_TIMEOUT)
-        if not response:
-            return app_error(504,
-                'Application did not respond in a timely fashion.',
-                env, start_response)
-        response = json.loads(response[1])
-        if type(response) is dict and response.get('found'):
-            resource = method_path
-            args = elements[index+1:]
-            _METHOD_CACHE[method_path] = index+1
-            break
-        else:
-            _METHOD_CACHE[method_path] = False
+        reply_codec = codec.CODECS[extension[1:]]
+    if callback:
+        reply_codec = codec.JSON
+    try:
+        resource, args = find_resource(replies, elements, http_method)
+    except gevent.Timeout:
+        return app_error(504,
+            'Application did not respond in a timely fashion.',
+            env, start_response)
     if not resource:
         return app_error(404,
             'No supported server method found.',
             env, start_response)
-    bcenv.REDIS.rpush(bcenv.WORKER_QUEUE, json.dumps({
-        'method' : '%s.http_%s' % (resource, http_method),
+    correlation_id = replies.expect()
+    method = '%s.http_%s' % (resource, http_method)
+    bcenv.TRANSPORT.push(bcenv.ENVELOPE_CODEC.encode({
+        'method' : method,
         'args' : args,
         'kwargs' : kwargs,
-        'reply_channel' : reply_channel,
-        }))
-    response = bcenv.REDIS.blpop(reply_channel, _REQUEST_TIMEOUT)
-    if not response:
+        'reply_channel' : replies.channel,
+        'correlation_id' : correlation_id,
+        'enqueued' : time.time(),
+        'deadline' : time.time() + _REQUEST_TIMEOUT,
+        'codec' : reply_codec.name,
+        }), bcenv.queue_for(method))
+    reply = replies.wait(correlation_id, _REQUEST_TIMEOUT)
+    if reply is None:
         return app_error(504,
             'Application did not respond in a timely fashion.',
             env, start_response)
-    reply = response[1]
     headers = [('Access-Control-Allow-Origin', '*')]
     if callback:
-        reply = '%s(%s);' % (callback, response[1])
         headers.append(('Content-Type', 'text/javascript'))
     else:
-        headers.append(('Content-Type', 'application/json'))
-    if True or 'deflate' in env.get('HTTP_ACCEPT_ENCODING', '').split(','):
-        reply = zlib.compress(reply)
-        headers += [
-                ('Content-Encoding', 'deflate'),
-                ('Content-Length', len(reply))]
+        headers.append(('Content-Type', reply_codec.content_type))
+    if isinstance(reply, Stream):
+        # sent with chunked transfer encoding as the worker produces it
+        body = reply.body(reply_codec)
+        if callback:
+            body = itertools.chain(['%s(' % callback], body, [');'])
+        body, encoding_headers = _COMPRESSOR.apply_stream(body,
+                env.get('HTTP_ACCEPT_ENCODING'))
+        start_response('200 OK', headers + encoding_headers)
+        return body
+    if callback:
+        reply = '%s(%s);' % (callback, reply)
+    reply, encoding_headers = _COMPRESSOR.apply(reply,
+            env.get('HTTP_ACCEPT_ENCODING'))
+    headers += encoding_headers
     start_response('200 OK', headers)
     return [reply]
 
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Route manifest
+    Workers publish the http_<verb> handlers they expose to Redis, the REST
+    front end compiles them into a prefix trie so resolving a URL to a
+    resource is a local lookup. Each worker group, workers running the same
+    modules, owns its manifest and keeps it alive with its heartbeat, the
+    front end merges those still alive.
+
+"""
+
+# builtin modules
+import os
+import time
+import uuid
+import logging
+import importlib
+
+# third party modules
+import gevent
+import redis
+
+# bluecollar modules
+
+_HTTP_PREFIX = 'http_'
+
+def exposed(module_names, purpose):
+    """Import the named modules and find the public functions and classes
+    each defines itself. Yields (module name, name, item), modules that
+    fail to import are logged and skipped."""
+    for module_name in module_names:
+        try:
+            module = importlib.import_module(module_name)
+        except Exception, message:
+            logging.error('Unable to import %s for %s: %s', module_name,
+                    purpose, message)
+            continue
+        for name in dir(module):
+            if name.startswith('_'):
+                continue
+            item = getattr(module, name)
+            if (callable(item) and
+                    getattr(item, '__module__', None) == module.__name__):
+                yield module_name, name, item
+
+def discover(module_names):
+    """Find the http_<verb> handlers exposed by the named modules.
+    Returns a dict of dotted resource path to a list of verbs."""
+    manifest = {}
+    for module_name, name, item in exposed(module_names, 'route manifest'):
+        if name.startswith(_HTTP_PREFIX):
+            # module level handler, the module is the resource
+            manifest.setdefault(module_name, []).append(
+                    name[len(_HTTP_PREFIX):])
+        elif type(item) is type:
+            verbs = [attr[len(_HTTP_PREFIX):] for attr in dir(item)
+                    if attr.startswith(_HTTP_PREFIX) and
+                    callable(getattr(item, attr))]
+            if verbs:
+                manifest['%s.%s' % (module_name, name)] = verbs
+    return manifest
+
+def _group_key(key, group):
+    return '%s:%s' % (key, group)
+
+def publish(connection, key, manifest, group, ttl):
+    """Replace a worker group's manifest, kept for ttl seconds unless
+    refreshed, and announce a new version"""
+    version_key = '%s_version' % key
+    group_key = _group_key(key, group)
+    pipe = connection.pipeline(transaction=True)
+    if manifest:
+        # written aside then swapped in, so resources we no longer expose
+        # go with the old manifest
+        temp_key = '%s:%s' % (group_key, uuid.uuid4().hex)
+        pipe.hmset(temp_key, dict((resource, ','.join(sorted(verbs)))
+            for resource, verbs in manifest.items()))
+        pipe.rename(temp_key, group_key)
+        pipe.expire(group_key, ttl)
+    else:
+        pipe.delete(group_key)
+    pipe.execute_command('ZADD', '%s_groups' % key, time.time() + ttl, group)
+    pipe.incr(version_key)
+    version = pipe.execute()[-1]
+    connection.publish(version_key, version)
+    logging.info('Published route manifest version %s with %d resources',
+            version, len(manifest))
+
+def refresh(connection, key, manifest, group, ttl):
+    """Keep a worker group's manifest alive for another ttl seconds,
+    publishing it again if it had already expired"""
+    pipe = connection.pipeline(transaction=True)
+    pipe.expire(_group_key(key, group), ttl)
+    pipe.execute_command('ZADD', '%s_groups' % key, time.time() + ttl, group)
+    if not pipe.execute()[0] and manifest:
+        publish(connection, key, manifest, group, ttl)
+
+
+class _Node(object):
+    __slots__ = ('children', 'verbs')
+
+    def __init__(self):
+        self.children = {}
+        self.verbs = ()
+
+
+class RouteTrie(object):
+    """Prefix trie of resource path elements"""
+
+    def __init__(self, manifest=None):
+        self._root = _Node()
+        self.size = 0
+        for resource, verbs in (manifest or {}).items():
+            self.insert(resource.split('.'), verbs)
+
+    def insert(self, elements, verbs):
+        node = self._root
+        for element in elements:
+            node = node.children.setdefault(element, _Node())
+        node.verbs = frozenset(verbs)
+        self.size += 1
+
+    def lookup(self, elements, verb):
+        """Find the shortest prefix of elements exposing verb.
+        Returns (dotted resource path, count of elements used) or None."""
+        node = self._root
+        for index, element in enumerate(elements):
+            node = node.children.get(element)
+            if node is None:
+                return None
+            if verb in node.verbs:
+                return '.'.join(elements[:index+1]), index+1
+        return None
+
+
+class ManifestWatcher(object):
+    """Keeps a compiled route trie in step with the published manifest"""
+
+    def __init__(self, connection, key):
+        self.redis = connection
+        self.key = key
+        self.version_key = '%s_version' % key
+        self.trie = RouteTrie()
+        self.groups_key = '%s_groups' % key
+        self.version = None
+        self._expiry = None
+        self._greenlet = gevent.spawn(self._watch)
+
+    def reload(self):
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.get(self.version_key)
+        pipe.zrangebyscore(self.groups_key, now, '+inf', withscores=True)
+        pipe.zremrangebyscore(self.groups_key, '-inf', now)
+        version, groups = pipe.execute()[:2]
+        pipe = self.redis.pipeline(transaction=False)
+        for group, expires in groups:
+            pipe.hgetall(_group_key(self.key, group))
+        manifest = {}
+        for group_manifest in pipe.execute():
+            for resource, verbs in group_manifest.items():
+                manifest.setdefault(resource, set()).update(
+                    verbs.split(','))
+        self.trie = RouteTrie(manifest)
+        self.version = version
+        # groups expire without announcing it, look again when the next
+        # one is due
+        if self._expiry is not None:
+            self._expiry.kill(block=False)
+            self._expiry = None
+        if groups:
+            self._expiry = gevent.spawn_later(
+                min(expires for group, expires in groups) - now + 1,
+                self._expired)
+        logging.debug('Loaded route manifest version %s, %d resources',
+                version, self.trie.size)
+
+    def _expired(self):
+        self._expiry = None
+        try:
+            self.reload()
+        except redis.exceptions.ConnectionError, message:
+            logging.error('Unable to reload route manifest: %s', message)
+
+    def _watch(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub()
+                pubsub.subscribe(self.version_key)
+                # catch up on anything announced before we subscribed
+                self.reload()
+                for message in pubsub.listen():
+                    if (message['type'] == 'message' and
+                            message['data'] != self.version):
+                        self.reload()
+            except redis.exceptions.ConnectionError, message:
+                logging.error('Route manifest watcher lost Redis: %s',
+                        message)
+                gevent.sleep(5)
+
+    def lookup(self, elements, verb):
+        return self.trie.lookup(elements, verb)
+
+
+_WATCHERS = {}
+
+def get_watcher(connection, key):
+    """The manifest watcher for this process, started on first use"""
+    watcher_key = (os.getpid(), key)
+    if watcher_key not in _WATCHERS:
+        _WATCHERS[watcher_key] = ManifestWatcher(connection, key)
+        _WATCHERS[watcher_key].reload()
+    return _WATCHERS[watcher_key]
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    A throwaway redis-server for tests that need a real one. It's started
+    the first time a test asks for it and stopped when the tests exit.
+    Tests are skipped when there's no redis-server on the PATH.
+
+"""
+
+# builtin modules
+import os
+import atexit
+import unittest
+import subprocess
+
+# third party modules
+import redis
+
+# bluecollar modules
+from bluecollar import bench
+
+_SERVER = {}
+
+def _on_path(program):
+    return any(os.access(os.path.join(path, program), os.X_OK)
+        for path in os.environ.get('PATH', '').split(os.pathsep))
+
+def port():
+    """Port of the test redis-server, started on first use, or None if we
+    have no redis-server to start"""
+    if 'port' not in _SERVER:
+        if not _on_path('redis-server'):
+            _SERVER['port'] = None
+            return None
+        _SERVER['port'] = bench.free_port()
+        process = subprocess.Popen(['redis-server', '--port',
+            str(_SERVER['port']), '--save', '', '--appendonly', 'no'],
+            stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        atexit.register(process.terminate)
+        bench.wait_for(_SERVER['port'])
+        # workers imported by tests find it through their usual settings
+        os.environ['BC_REDISHOST'] = '127.0.0.1'
+        os.environ['BC_REDISPORT'] = str(_SERVER['port'])
+    return _SERVER['port']
+
+
+class RedisTestCase(unittest.TestCase):
+    """Tests with self.redis connected to an empty test database"""
+
+    @classmethod
+    def setUpClass(cls):
+        if port() is None:
+            raise unittest.SkipTest('no redis-server on the PATH')
+
+    def setUp(self):
+        self.redis = redis.StrictRedis('127.0.0.1', port())
+        self.redis.flushdb()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Codec and envelope tests
+"""
+
+# builtin modules
+import json
+import unittest
+
+# third party modules
+
+# bluecollar modules
+from bluecollar import codec
+
+
+class TestNegotiate(unittest.TestCase):
+
+    def test_default(self):
+        self.assertIs(codec.negotiate(None), codec.JSON)
+        self.assertIs(codec.negotiate(''), codec.JSON)
+        self.assertIs(codec.negotiate('text/html'), codec.JSON)
+
+    def test_parameters_and_case(self):
+        self.assertIs(codec.negotiate('Application/JSON; charset=utf-8'),
+            codec.JSON)
+
+    def test_unknown_default(self):
+        self.assertIsNone(codec.negotiate('text/html', None))
+
+    @unittest.skipIf(codec.msgpack is None, 'msgpack not installed')
+    def test_first_supported(self):
+        self.assertIs(codec.negotiate('text/html, application/x-msgpack, '
+            'application/json'), codec.CODECS['msgpack'])
+
+
+class TestStrip(unittest.TestCase):
+
+    def test_reserved_keys(self):
+        request = dict((key, 'client') for key in codec.RESERVED)
+        request['method'] = 'app.echo'
+        self.assertEqual(codec.strip(request), {'method' : 'app.echo'})
+
+    def test_copy(self):
+        request = {'method' : 'app.echo', 'reply_channel' : 'client'}
+        codec.strip(request)
+        self.assertEqual(request['reply_channel'], 'client')
+
+
+class TestEnvelope(unittest.TestCase):
+
+    def test_unframed(self):
+        envelope = {'method' : 'app.echo', 'args' : [1]}
+        self.assertEqual(codec.decode_envelope(json.dumps(envelope)),
+            envelope)
+
+    def test_framed(self):
+        data = codec.frame({'reply_channel' : 'front'},
+            json.dumps({'method' : 'app.echo', 'args' : [1]}))
+        self.assertTrue(data.startswith(codec.FRAME_MARK))
+        self.assertEqual(codec.decode_envelope(data), {
+            'method' : 'app.echo',
+            'args' : [1],
+            'reply_channel' : 'front',
+            })
+
+    def test_framed_unicode(self):
+        data = codec.frame({}, u'{"method": "app.echo", "args": ["\xe9"]}')
+        self.assertEqual(codec.decode_envelope(data)['args'], [u'\xe9'])
+
+    def test_newline_in_header(self):
+        data = codec.frame({'reply_channel' : 'a\nb'},
+            '{"method": "app.echo"}')
+        self.assertEqual(codec.decode_envelope(data)['reply_channel'],
+            'a\nb')
+
+    def test_strips_client_keys(self):
+        payload = dict((key, 'client') for key in codec.RESERVED)
+        payload['method'] = 'app.echo'
+        request = codec.decode_envelope(codec.frame(
+            {'correlation_id' : 'front'}, json.dumps(payload)))
+        self.assertEqual(request['correlation_id'], 'front')
+        for key in codec.RESERVED:
+            if key != 'correlation_id':
+                self.assertNotIn(key, request)
+
+    def test_undecodable_payload(self):
+        header = {'reply_channel' : 'front', 'correlation_id' : 'abc'}
+        try:
+            codec.decode_envelope(codec.frame(header, '{"method": '))
+        except codec.EnvelopeError, error:
+            self.assertEqual(error.header, header)
+        else:
+            self.fail('EnvelopeError not raised')
+
+    def test_payload_not_a_map(self):
+        self.assertRaises(codec.EnvelopeError, codec.decode_envelope,
+            codec.frame({}, '[1, 2]'))
+
+    @unittest.skipIf(codec.msgpack is None, 'msgpack not installed')
+    def test_framed_msgpack(self):
+        msgpack_codec = codec.CODECS['msgpack']
+        data = codec.frame({'reply_channel' : 'front'},
+            msgpack_codec.encode({'method' : 'app.echo', 'batch' : []}),
+            msgpack_codec)
+        self.assertEqual(codec.decode_envelope(data), {
+            'method' : 'app.echo',
+            'reply_channel' : 'front',
+            })
+
+
+class TestJSONCodec(unittest.TestCase):
+
+    def test_wrap(self):
+        self.assertEqual(json.loads(codec.JSON.tag('abc', '[1, 2]')),
+            {'id' : 'abc', 'result' : [1, 2]})
+        self.assertEqual(json.loads(codec.JSON.wrap({}, 'result', 'null')),
+            {'result' : None})
+
+    def test_chunks(self):
+        chunks = [codec.JSON.join(['1', '2']), codec.JSON.join(['3'])]
+        self.assertEqual(json.loads(''.join(codec.JSON.body(chunks))),
+            [1, 2, 3])
+        self.assertEqual(json.loads(codec.JSON.frame(chunks[0])), [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Response compression tests
+"""
+
+# builtin modules
+import zlib
+import unittest
+
+# third party modules
+
+# bluecollar modules
+from bluecollar import compress
+
+
+class TestNegotiate(unittest.TestCase):
+
+    def test_identity(self):
+        self.assertIsNone(compress.negotiate(None))
+        self.assertIsNone(compress.negotiate(''))
+        self.assertIsNone(compress.negotiate('identity'))
+        self.assertIsNone(compress.negotiate('br'))
+
+    def test_preference(self):
+        self.assertEqual(compress.negotiate('deflate, gzip'), 'gzip')
+        self.assertEqual(compress.negotiate('deflate'), 'deflate')
+        self.assertEqual(compress.negotiate('GZip'), 'gzip')
+
+    def test_quality(self):
+        self.assertEqual(compress.negotiate('gzip;q=0.5, deflate'),
+            'deflate')
+        self.assertEqual(compress.negotiate('gzip; q=0.9, deflate;q=0.1'),
+            'gzip')
+        self.assertIsNone(compress.negotiate('gzip;q=0'))
+        self.assertIsNone(compress.negotiate('gzip;q=high'))
+
+    def test_wildcard(self):
+        self.assertEqual(compress.negotiate('*'), 'gzip')
+        self.assertEqual(compress.negotiate('gzip;q=0, *'), 'deflate')
+        self.assertIsNone(compress.negotiate('*;q=0'))
+
+
+class TestCompressor(unittest.TestCase):
+
+    def test_small_body(self):
+        body, headers = compress.Compressor(minimum=100).apply('small',
+            'gzip')
+        self.assertEqual(body, 'small')
+        self.assertNotIn('Content-Encoding', dict(headers))
+
+    def test_gzip(self):
+        original = 'x' * 2000
+        body, headers = compress.Compressor().apply(original, 'gzip')
+        headers = dict(headers)
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Content-Length'], str(len(body)))
+        self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS),
+            original)
+
+    def test_cache(self):
+        compressor = compress.Compressor(cache_size=1)
+        first = compressor.compress('x' * 2000, 'deflate')
+        self.assertIs(compressor.compress('x' * 2000, 'deflate'), first)
+        compressor.compress('y' * 2000, 'deflate')
+        self.assertEqual(len(compressor._cache), 1)
+
+    def test_stream(self):
+        pieces, headers = compress.Compressor(minimum=3).apply_stream(
+            ['ab', 'cd'], 'deflate')
+        self.assertEqual(dict(headers)['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(''.join(pieces)), 'abcd')
+
+    def test_short_stream(self):
+        pieces, headers = compress.Compressor(minimum=100).apply_stream(
+            iter(['ab', 'cd']), 'gzip')
+        self.assertNotIn('Content-Encoding', dict(headers))
+        self.assertEqual(''.join(pieces), 'abcd')
+
+    def test_stream_read_to_minimum(self):
+        read = []
+        def stream():
+            for piece in ('ab', 'cd', 'ef'):
+                read.append(piece)
+                yield piece
+        pieces, headers = compress.Compressor(minimum=3).apply_stream(
+            stream(), 'gzip')
+        # only what it took to decide, the rest as it is sent
+        self.assertEqual(read, ['ab', 'cd'])
+        self.assertEqual(zlib.decompress(''.join(pieces),
+            16 + zlib.MAX_WBITS), 'abcdef')
+
+    def test_stream_identity(self):
+        stream = iter(['ab'])
+        pieces, headers = compress.Compressor().apply_stream(stream, None)
+        self.assertIs(pieces, stream)
+        self.assertNotIn('Content-Encoding', dict(headers))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Adaptive concurrency tests
+"""
+
+# builtin modules
+import unittest
+
+# third party modules
+
+# bluecollar modules
+from bluecollar import concurrency
+
+
+class TestAdaptiveLimit(unittest.TestCase):
+
+    def run_requests(self, limit, latencies, method='app.method'):
+        """Start and finish one request per latency, one at a time"""
+        for latency in latencies:
+            limit.acquire()
+            limit.release(method, latency)
+
+    def test_bounds(self):
+        limit = concurrency.AdaptiveLimit(0, -1)
+        self.assertEqual((limit.minimum, limit.maximum), (1, 1))
+        self.assertEqual(limit.limit, 1)
+
+    def test_capacity(self):
+        limit = concurrency.AdaptiveLimit(2, 2)
+        self.assertEqual(limit.capacity(), 2)
+        limit.acquire()
+        self.assertEqual(limit.capacity(), 1)
+        self.assertTrue(limit.wait(0))
+        limit.acquire()
+        self.assertEqual(limit.capacity(), 0)
+        self.assertFalse(limit.wait(0))
+        limit.release('app.method', 0.1)
+        self.assertEqual(limit.capacity(), 1)
+        self.assertTrue(limit.wait(0))
+
+    def test_static(self):
+        limit = concurrency.AdaptiveLimit(5, 5)
+        self.run_requests(limit, [0.01] * 5 + [10.0] * 50)
+        self.assertEqual(limit.limit, 5)
+
+    def test_grows_when_saturated(self):
+        limit = concurrency.AdaptiveLimit(2, 10)
+        for _ in range(20):
+            limit.acquire()
+            limit.acquire()
+            limit.release('app.method', 0.1)
+            limit.release('app.method', 0.1)
+        self.assertTrue(2 < limit.limit <= 10)
+
+    def test_idle_does_not_grow(self):
+        limit = concurrency.AdaptiveLimit(2, 10)
+        self.run_requests(limit, [0.1] * 50)
+        self.assertEqual(limit.limit, 2)
+
+    def test_backs_off_on_inflation(self):
+        limit = concurrency.AdaptiveLimit(2, 10)
+        limit.limit = 8.0
+        self.run_requests(limit, [0.1] * 10 + [5.0] * 50)
+        self.assertTrue(2 <= limit.limit < 8)
+
+    def test_backs_off_to_minimum(self):
+        limit = concurrency.AdaptiveLimit(2, 10)
+        limit.limit = 3.0
+        self.run_requests(limit, [0.1] * 10 + [5.0 * n for n in
+            range(1, 500)])
+        self.assertEqual(limit.limit, 2)
+
+    def test_release_without_latency(self):
+        limit = concurrency.AdaptiveLimit(1, 10)
+        limit.acquire()
+        self.assertFalse(limit.wait(0))
+        limit.release('app.method', None, 0.5)
+        self.assertEqual(limit.in_flight, 0)
+        self.assertTrue(limit.wait(0))
+        self.assertEqual(limit.latencies(), {})
+        self.assertTrue(limit.wait_time > 0)
+
+    def test_latencies(self):
+        limit = concurrency.AdaptiveLimit(1, 1)
+        self.run_requests(limit, [1.0], 'app.one')
+        self.run_requests(limit, [2.0], 'app.two')
+        self.assertEqual(limit.latencies(),
+            {'app.one' : 1.0, 'app.two' : 2.0})
+
+
+if __name__ == '__main__':
+    unittest.main()
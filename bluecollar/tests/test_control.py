@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Worker control plane tests, against a throwaway redis-server
+"""
+
+# builtin modules
+import json
+import unittest
+
+# third party modules
+import gevent
+
+# bluecollar modules
+from bluecollar import control
+from bluecollar.tests import server
+
+
+class TestWorkerControl(server.RedisTestCase):
+
+    def setUp(self):
+        super(TestWorkerControl, self).setUp()
+        self.control = control.WorkerControl(self.redis, 'test_control',
+            'test_workers', 'host:1', 0.01)
+        self.control.status = lambda: {'in_flight' : 2}
+
+    def tearDown(self):
+        gevent.killall(self.control._greenlets)
+
+    def test_heartbeat(self):
+        self.control.heartbeat()
+        status = control.workers(self.redis, 'test_workers')['host:1']
+        self.assertEqual(status['state'], 'running')
+        self.assertEqual(status['in_flight'], 2)
+
+    def test_handle(self):
+        self.control.handle({'command' : 'pause'})
+        self.assertFalse(self.control.resumed.is_set())
+        self.assertEqual(json.loads(self.redis.hget('test_workers',
+            'host:1'))['state'], 'paused')
+        self.control.handle({'command' : 'resume'})
+        self.assertTrue(self.control.resumed.is_set())
+
+    def test_stop(self):
+        self.control.start()
+        self.control.stop()
+        self.assertEqual(control.workers(self.redis, 'test_workers'), {})
+
+    def test_registry_of_another_type(self):
+        # a set of PIDs, as older workers keep
+        self.redis.sadd('test_workers', 1234)
+        beat = gevent.spawn(self.control._beat)
+        gevent.sleep(0.05)
+        self.assertFalse(beat.dead)
+        beat.kill()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    HTTP front end tests, with a worker dispatching against a throwaway
+    redis-server
+"""
+
+# builtin modules
+import json
+import unittest
+import StringIO
+
+# third party modules
+import gevent
+import gevent.pool
+
+# bluecollar modules
+from bluecollar import codec
+from bluecollar.tests import server
+
+_PATH = __name__
+
+def add(a, b):
+    return a + b
+
+
+class TestStatus(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        if server.port() is None:
+            raise unittest.SkipTest('no redis-server on the PATH')
+        global http
+        from bluecollar import http
+
+    def test_ok(self):
+        self.assertEqual(http.status('3', codec.JSON), '200 OK')
+        self.assertEqual(http.status('{"response_code": 400}', codec.JSON),
+            '200 OK')
+
+    def test_error(self):
+        self.assertEqual(http.status(json.dumps({'message' : 'Nope',
+            'response_code' : 404, 'error' : True}), codec.JSON),
+            '404 Not Found')
+
+    def test_unknown_code(self):
+        self.assertEqual(http.status(json.dumps({'response_code' : 999,
+            'error' : True}), codec.JSON), '200 OK')
+
+
+class TestApplication(server.RedisTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestApplication, cls).setUpClass()
+        global http, worker
+        from bluecollar import http
+        from bluecollar import worker
+
+    def work(self):
+        """Run whatever the front end queued, as a worker would"""
+        pool = gevent.pool.Pool(10)
+        while True:
+            for ref, request in worker.TRANSPORT.fetch(1, 1):
+                worker.dispatch(request, pool, worker._JSON_HELPER)
+                worker.TRANSPORT.done(ref)
+
+    def request(self, method, path, body=''):
+        self.status = None
+        def start_response(status, headers):
+            self.status = status
+        env = {
+            'REQUEST_METHOD' : method,
+            'PATH_INFO' : path,
+            'QUERY_STRING' : '',
+            'CONTENT_TYPE' : 'application/json',
+            'wsgi.input' : StringIO.StringIO(body),
+            }
+        working = gevent.spawn(self.work)
+        try:
+            with gevent.Timeout(5):
+                return ''.join(http.application(env, start_response))
+        finally:
+            working.kill()
+
+    def test_get(self):
+        self.assertEqual(self.request('GET', '/%s.add/1/2' % _PATH), '"12"')
+        self.assertEqual(self.status, '200 OK')
+
+    def test_post(self):
+        self.assertEqual(self.request('POST', '/', json.dumps({
+            'method' : '%s.add' % _PATH, 'args' : [1, 2]})), '3')
+        self.assertEqual(self.status, '200 OK')
+
+    def test_post_undecodable(self):
+        response = json.loads(self.request('POST', '/', '{bad'))
+        self.assertEqual(self.status, '400 Bad Request')
+        self.assertEqual(response['response_code'], 400)
+
+    def test_not_found(self):
+        self.request('GET', '/%s.subtract/1/2' % _PATH)
+        self.assertEqual(self.status, '404 Not Found')
+
+
+if __name__ == '__main__':
+    unittest.main()
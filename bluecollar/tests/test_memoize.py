@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Memoization tests
+"""
+
+# builtin modules
+import unittest
+
+# third party modules
+
+# bluecollar modules
+from bluecollar import memoize
+from bluecollar import control
+from bluecollar.tests import server
+
+
+class TestCallKey(unittest.TestCase):
+
+    def test_stable(self):
+        self.assertEqual(
+            memoize.call_key('memo', 'app.add', [1, 2], {'a' : 1, 'b' : 2}),
+            memoize.call_key('memo', 'app.add', (1, 2), {'b' : 2, 'a' : 1}))
+
+    def test_arguments(self):
+        keys = set(memoize.call_key('memo', method, args, kwargs)
+            for method, args, kwargs in (
+                ('app.add', [1, 2], {}),
+                ('app.add', [2, 1], {}),
+                ('app.add', [1], {'b' : 2}),
+                ('app.sub', [1, 2], {}),
+                ))
+        self.assertEqual(len(keys), 4)
+        for key in keys:
+            self.assertTrue(key.startswith('memo:app.'))
+
+    def test_unkeyable(self):
+        # the worker runs these calls uncached, so it must catch each of
+        # these errors
+        self.assertRaises(TypeError, memoize.call_key, 'memo', 'app.add',
+            [object()], {})
+        self.assertRaises(UnicodeError, memoize.call_key, 'memo',
+            'app.add', ['\xff\xfe'], {})
+        circular = []
+        circular.append(circular)
+        self.assertRaises(ValueError, memoize.call_key, 'memo', 'app.add',
+            [circular], {})
+
+
+
+class TestInvalidate(server.RedisTestCase):
+    """Two workers' caches sharing Redis, the first invalidating"""
+
+    def setUp(self):
+        super(TestInvalidate, self).setUp()
+        self.first = memoize.MemoCache(self.redis, 'memo', 10)
+        self.second = memoize.MemoCache(self.redis, 'memo', 10)
+        self.broadcasts = []
+        self.first.broadcast = self.broadcasts.append
+        self.first.set('app.add', self.first.key('app.add', [1, 2], {}),
+            '3', 60)
+        # the second worker has read it, so has a copy of its own
+        self.assertEqual(self.second.get(self.second.key('app.add', [1, 2],
+            {})), '3')
+
+    def forget(self):
+        """Deliver the broadcasts to the second worker"""
+        for settings in self.broadcasts:
+            self.second.forget(settings.get('keys'), settings.get('method'))
+
+    def test_method(self):
+        control.invalidate(self.first, {'method' : 'app.add'})
+        self.assertEqual(self.broadcasts, [{'method' : 'app.add'}])
+        self.forget()
+        self.assertIsNone(self.second.get(self.second.key('app.add', [1, 2],
+            {})))
+        self.assertIsNone(self.first.get(self.first.key('app.add', [1, 2],
+            {})))
+
+    def test_call(self):
+        self.first.set('app.add', self.first.key('app.add', [2, 2], {}),
+            '4', 60)
+        control.invalidate(self.first, {'method' : 'app.add',
+            'args' : [1, 2]})
+        self.forget()
+        self.assertIsNone(self.second.get(self.second.key('app.add', [1, 2],
+            {})))
+        self.assertEqual(self.second.get(self.second.key('app.add', [2, 2],
+            {})), '4')
+
+    def test_needs_method(self):
+        self.assertRaises(ValueError, control.invalidate, self.first, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
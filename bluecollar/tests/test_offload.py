@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Process pool tests
+"""
+
+# builtin modules
+import os
+import time
+import unittest
+
+# third party modules
+import gevent
+
+# bluecollar modules
+from bluecollar import offload
+
+def pid():
+    return os.getpid()
+
+def divide(a, b):
+    return a / b
+
+def count(n):
+    return (i for i in range(n))
+
+def nap(seconds):
+    time.sleep(seconds)
+    return seconds
+
+def die():
+    os._exit(1)
+
+_METHODS = {
+    'app.pid' : pid,
+    'app.divide' : divide,
+    'app.count' : count,
+    'app.nap' : nap,
+    'app.die' : die,
+    }
+
+
+class TestProcessPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = offload.ProcessPool(2, _METHODS.get)
+        self.pool.start()
+        self.addCleanup(self.pool.stop)
+
+    def pids(self):
+        return set(member.pid for member in self.pool._members)
+
+    def test_result(self):
+        self.assertEqual(self.pool.apply('app.divide', 6, b=3), 2)
+        self.assertIn(self.pool.apply('app.pid'), self.pids())
+        self.assertNotEqual(self.pool.apply('app.pid'), os.getpid())
+
+    def test_concurrent(self):
+        started = time.time()
+        calls = [gevent.spawn(self.pool.apply, 'app.nap', 0.2)
+            for _ in range(2)]
+        gevent.joinall(calls, raise_error=True)
+        self.assertEqual([call.value for call in calls], [0.2, 0.2])
+        self.assertTrue(time.time() - started < 0.35)
+
+    def test_error(self):
+        self.assertRaises(offload.OffloadError, self.pool.apply,
+            'app.divide', 1, 0)
+        self.assertEqual(self.pool.apply('app.divide', 4, 2), 2)
+
+    def test_missing(self):
+        self.assertRaises(offload.OffloadError, self.pool.apply,
+            'app.subtract', 1, 2)
+
+    def test_unpicklable_call(self):
+        pids = self.pids()
+        self.assertRaises(offload.OffloadError, self.pool.apply,
+            'app.divide', lambda: 1, 2)
+        self.assertEqual(self.pids(), pids)
+
+    def test_unpicklable_result(self):
+        pids = self.pids()
+        self.assertRaises(offload.OffloadError, self.pool.apply,
+            'app.count', 3)
+        # the member is still good
+        self.assertEqual(self.pids(), pids)
+        self.assertEqual(self.pool.apply('app.divide', 4, 2), 2)
+
+    def test_member_died(self):
+        pids = self.pids()
+        self.assertRaises(offload.OffloadError, self.pool.apply, 'app.die')
+        self.assertEqual(len(self.pool._members), 2)
+        self.assertNotEqual(self.pids(), pids)
+        self.assertEqual(self.pool.apply('app.divide', 4, 2), 2)
+
+    def test_killed_caller(self):
+        caller = gevent.spawn(self.pool.apply, 'app.nap', 5)
+        gevent.sleep(0.1)
+        pids = self.pids()
+        caller.kill()
+        # a reply is outstanding, so the member is replaced
+        self.assertEqual(len(self.pids() & pids), 1)
+        self.assertEqual(self.pool.apply('app.nap', 0), 0)
+
+    def test_stop(self):
+        path = self.pool._zygote.path
+        self.pool.stop()
+        self.assertEqual(self.pool._members, [])
+        self.assertFalse(os.path.exists(os.path.dirname(path)))
+
+
+if __name__ == '__main__':
+    unittest.main()
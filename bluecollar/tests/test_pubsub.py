@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Pub/sub multiplexer and mailbox tests
+"""
+
+# builtin modules
+import json
+import unittest
+
+# third party modules
+import gevent
+import gevent.queue
+import redis
+
+# bluecollar modules
+from bluecollar import codec
+from bluecollar import pubsub
+from bluecollar.tests import server
+
+
+class FakeConnection(object):
+    """Redis connection recording the commands sent, and replying with
+    whatever the test puts in responses"""
+
+    def __init__(self):
+        self.commands = []
+        self.connects = 0
+        self.responses = gevent.queue.Queue()
+
+    def send_command(self, *args):
+        self.commands.append(args)
+
+    def read_response(self):
+        response = self.responses.get()
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def connect(self):
+        self.connects += 1
+
+    def disconnect(self):
+        pass
+
+
+class FakeRedis(object):
+    """Client whose pool hands out a single fake connection"""
+
+    def __init__(self):
+        self.connection = FakeConnection()
+        self.connection_pool = self
+
+    def get_connection(self, command_name, *keys):
+        return self.connection
+
+
+class CountingCodec(codec.JSONCodec):
+    name = 'counting'
+
+    def __init__(self):
+        self.encoded = 0
+
+    def encode(self, data, default=None):
+        self.encoded += 1
+        return super(CountingCodec, self).encode(data, default)
+
+
+class TestMultiplexer(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.commands = self.redis.connection.commands
+        self.multiplexer = pubsub.Multiplexer(self.redis)
+
+    def tearDown(self):
+        self.multiplexer._greenlet.kill()
+
+    def subscriber(self, frame_codec=codec.JSON):
+        frames = []
+        subscriber = pubsub.Subscriber(frames.append, frame_codec)
+        self.addCleanup(subscriber.stop)
+        return subscriber, frames
+
+    def respond(self, *response):
+        self.redis.connection.responses.put(list(response))
+        # let the listener and subscribers run
+        gevent.sleep(0.01)
+
+    def test_subscribe_once(self):
+        first, _ = self.subscriber()
+        second, _ = self.subscriber()
+        self.multiplexer.subscribe(first, ['news', 'sport'])
+        self.multiplexer.subscribe(second, ['news'])
+        self.assertEqual(self.commands, [('SUBSCRIBE', 'news', 'sport')])
+
+    def test_unsubscribe_last(self):
+        first, _ = self.subscriber()
+        second, _ = self.subscriber()
+        self.multiplexer.subscribe(first, ['news'])
+        self.multiplexer.subscribe(second, ['news'])
+        self.multiplexer.unsubscribe(first, ['news'])
+        self.assertEqual(self.commands, [('SUBSCRIBE', 'news')])
+        self.multiplexer.unsubscribe(second, ['news'])
+        self.assertEqual(self.commands[-1], ('UNSUBSCRIBE', 'news'))
+        self.assertEqual(second.channels, set())
+
+    def test_unsubscribe_unknown(self):
+        subscriber, _ = self.subscriber()
+        self.multiplexer.unsubscribe(subscriber, ['news'], ['news.*'])
+        self.assertEqual(self.commands, [])
+
+    def test_patterns(self):
+        first, _ = self.subscriber()
+        second, _ = self.subscriber()
+        self.multiplexer.subscribe(first, patterns=['news.*'])
+        self.multiplexer.subscribe(second, ['news.*'], ['news.*'])
+        self.assertEqual(self.commands, [('PSUBSCRIBE', 'news.*'),
+            ('SUBSCRIBE', 'news.*')])
+        self.multiplexer.close(first)
+        self.multiplexer.close(second)
+        self.assertEqual(self.commands[2:], [('UNSUBSCRIBE', 'news.*'),
+            ('PUNSUBSCRIBE', 'news.*')])
+
+    def test_close(self):
+        subscriber, _ = self.subscriber()
+        self.multiplexer.subscribe(subscriber, ['news', 'sport'], ['a.*'])
+        self.multiplexer.close(subscriber)
+        self.assertEqual(sorted(self.commands[2:]), [
+            ('PUNSUBSCRIBE', 'a.*'), ('UNSUBSCRIBE', 'news', 'sport')])
+        self.assertTrue(subscriber._greenlet.dead)
+
+    def test_confirm(self):
+        subscriber, frames = self.subscriber()
+        self.multiplexer.subscribe(subscriber, ['news'], ['sport.*'])
+        gevent.sleep(0.01)
+        self.assertEqual([json.loads(frame) for frame in frames], [
+            {'type' : 'subscribe', 'pattern' : None, 'channel' : 'news',
+                'data' : 2},
+            {'type' : 'psubscribe', 'pattern' : None, 'channel' : 'sport.*',
+                'data' : 2},
+            ])
+
+    def test_deliver(self):
+        subscriber, frames = self.subscriber()
+        other, other_frames = self.subscriber()
+        self.multiplexer.subscribe(subscriber, ['news'], confirm=False)
+        self.multiplexer.subscribe(other, patterns=['new*'], confirm=False)
+        self.respond('subscribe', 'news', 1)
+        self.respond('message', 'news', 'hello')
+        self.respond('pmessage', 'new*', 'news', 'hello')
+        self.assertEqual([json.loads(frame) for frame in frames], [
+            {'type' : 'message', 'pattern' : None, 'channel' : 'news',
+                'data' : 'hello'}])
+        self.assertEqual([json.loads(frame) for frame in other_frames], [
+            {'type' : 'pmessage', 'pattern' : 'new*', 'channel' : 'news',
+                'data' : 'hello'}])
+
+    def test_encode_once(self):
+        counting = CountingCodec()
+        subscribers = [self.subscriber(counting) for _ in range(3)]
+        for subscriber, _ in subscribers:
+            self.multiplexer.subscribe(subscriber, ['news'], confirm=False)
+        self.respond('message', 'news', 'hello')
+        self.assertEqual(counting.encoded, 1)
+        for _, frames in subscribers:
+            self.assertEqual(len(frames), 1)
+
+    def test_resubscribe(self):
+        subscriber, _ = self.subscriber()
+        self.multiplexer.subscribe(subscriber, ['news'], ['sport.*'])
+        self.redis.connection.responses.put(
+            redis.exceptions.ConnectionError('gone'))
+        gevent.sleep(1.1)
+        self.assertEqual(self.redis.connection.connects, 1)
+        self.assertEqual(self.commands[2:], [('SUBSCRIBE', 'news'),
+            ('PSUBSCRIBE', 'sport.*')])
+
+
+class TestMailboxes(server.RedisTestCase):
+    """Mailboxes opened in one process and polled from another"""
+
+    def setUp(self):
+        super(TestMailboxes, self).setUp()
+        self.mailboxes = self.process(backlog=3)
+        self.other = self.process(backlog=3)
+
+    def process(self, ttl=60, backlog=1000):
+        """A front end process's multiplexer and mailboxes"""
+        multiplexer = pubsub.Multiplexer(redis.Redis('127.0.0.1',
+            server.port()))
+        mailboxes = pubsub.Mailboxes(multiplexer, 'test_mailbox', ttl,
+            backlog)
+        self.addCleanup(multiplexer._greenlet.kill)
+        self.addCleanup(mailboxes._greenlet.kill)
+        return mailboxes
+
+    def test_poll(self):
+        mailbox = self.mailboxes.open()
+        self.mailboxes.put(mailbox.id, 'a')
+        self.mailboxes.put(mailbox.id, 'b')
+        self.assertEqual(self.other.poll(mailbox.id, 0, 0), (['a', 'b'], 2))
+        self.assertEqual(self.other.poll(mailbox.id, 1, 0), (['b'], 2))
+        self.assertEqual(self.mailboxes.poll(mailbox.id, 2, 0), ([], 2))
+        # frames before the cursor are gone
+        self.assertEqual(self.other.poll(mailbox.id, 0, 0), ([], 2))
+
+    def test_first_poll(self):
+        mailbox = self.mailboxes.open()
+        self.mailboxes.put(mailbox.id, 'a')
+        self.assertEqual(self.other.poll(mailbox.id, None, 0), ([], 1))
+
+    def test_cursor_ahead(self):
+        mailbox = self.mailboxes.open()
+        self.mailboxes.put(mailbox.id, 'a')
+        self.assertEqual(self.other.poll(mailbox.id, 10, 0), ([], 1))
+        self.mailboxes.put(mailbox.id, 'b')
+        self.assertEqual(self.other.poll(mailbox.id, 1, 0), (['b'], 2))
+
+    def test_backlog(self):
+        mailbox = self.mailboxes.open()
+        for frame in 'abcd':
+            self.mailboxes.put(mailbox.id, frame)
+        self.assertEqual(self.other.poll(mailbox.id, 0, 0),
+            (['b', 'c', 'd'], 4))
+
+    def test_published(self):
+        mailbox = self.mailboxes.open(['news'])
+        gevent.sleep(0.05)
+        self.redis.publish('news', 'hello')
+        with gevent.Timeout(1):
+            frames, cursor = self.other.poll(mailbox.id, 0, 1)
+        self.assertEqual(cursor, 1)
+        self.assertEqual(json.loads(frames[0])['data'], 'hello')
+
+    def test_wait(self):
+        mailbox = self.mailboxes.open()
+        gevent.spawn_later(0.05, self.mailboxes.put, mailbox.id, 'a')
+        with gevent.Timeout(1):
+            self.assertEqual(self.other.poll(mailbox.id, 0, 5), (['a'], 1))
+
+    def test_timeout(self):
+        mailbox = self.mailboxes.open()
+        self.assertEqual(self.other.poll(mailbox.id, 0, 0.05), ([], 0))
+
+    def test_missing(self):
+        self.assertIsNone(self.other.poll('nosuchmailbox', 0, 0))
+
+    def test_expired(self):
+        mailboxes = self.process(ttl=1)
+        mailbox = mailboxes.open(['news'])
+        gevent.sleep(2.1)
+        self.assertIsNone(self.other.poll(mailbox.id, 0, 0))
+        # the process that opened it stops feeding it
+        self.assertNotIn(mailbox.id, mailboxes._mailboxes)
+        self.assertNotIn('news', mailboxes.multiplexer._channels)
+
+    def test_put_expired(self):
+        mailbox = self.mailboxes.open(['news'])
+        self.redis.delete('test_mailbox:%s:next' % mailbox.id)
+        self.mailboxes.put(mailbox.id, 'a')
+        gevent.sleep(0.01)
+        self.assertFalse(self.redis.exists('test_mailbox:%s' % mailbox.id))
+        self.assertNotIn(mailbox.id, self.mailboxes._mailboxes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Reply tagging tests
+"""
+
+# builtin modules
+import unittest
+
+# third party modules
+
+# bluecollar modules
+from bluecollar import replies
+
+
+class TestDecodeReply(unittest.TestCase):
+
+    def test_tagged(self):
+        self.assertEqual(replies.decode_reply('0af3:{"a": "b:c"}'),
+            ('0af3', '{"a": "b:c"}', False))
+
+    def test_streamed(self):
+        self.assertEqual(replies.decode_reply('0af3+front_0af3'),
+            ('0af3', 'front_0af3', True))
+
+    def test_untagged(self):
+        for data in ('{"a": 1}', '[1, 2]', '1234', '', 'null'):
+            self.assertEqual(replies.decode_reply(data), ('', data, False))
+
+    def test_round_trip(self):
+        self.assertEqual(replies.decode_reply(
+            replies.encode_reply('beef', '"x+y:z"')),
+            ('beef', '"x+y:z"', False))
+        self.assertEqual(replies.decode_reply(replies.encode_stream('beef',
+            replies.stream_key('front', 'beef'))),
+            ('beef', 'front_beef', True))
+
+    def test_no_correlation_id(self):
+        self.assertEqual(replies.encode_reply(None, '{"a": 1}'), '{"a": 1}')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Route trie tests
+"""
+
+# builtin modules
+import sys
+import types
+import unittest
+
+# third party modules
+
+# bluecollar modules
+from bluecollar import routes
+
+
+class TestRouteTrie(unittest.TestCase):
+
+    def setUp(self):
+        self.trie = routes.RouteTrie({
+            'shop' : ['get'],
+            'shop.orders' : ['get', 'post'],
+            'shop.orders.Refund' : ['post'],
+            'admin.Users' : ['delete'],
+            })
+
+    def test_size(self):
+        self.assertEqual(self.trie.size, 4)
+
+    def test_exact(self):
+        self.assertEqual(self.trie.lookup(['shop', 'orders'], 'post'),
+            ('shop.orders', 2))
+
+    def test_remaining_elements(self):
+        self.assertEqual(self.trie.lookup(['admin', 'Users', '42'],
+            'delete'), ('admin.Users', 2))
+
+    def test_shortest_prefix(self):
+        self.assertEqual(self.trie.lookup(['shop', 'orders', '42'], 'get'),
+            ('shop', 1))
+        self.assertEqual(self.trie.lookup(['shop', 'orders', 'Refund'],
+            'post'), ('shop.orders', 2))
+
+    def test_missing(self):
+        self.assertIsNone(self.trie.lookup(['shop', 'orders'], 'delete'))
+        self.assertIsNone(self.trie.lookup(['admin'], 'delete'))
+        self.assertIsNone(self.trie.lookup(['blog'], 'get'))
+        self.assertIsNone(self.trie.lookup([], 'get'))
+
+    def test_empty(self):
+        self.assertIsNone(routes.RouteTrie().lookup(['shop'], 'get'))
+
+
+def _make_module(name):
+    """A module with handlers and classes of its own, and imported ones"""
+    module = types.ModuleType(name)
+    source = """
+from bluecollar.routes import RouteTrie
+
+def http_get():
+    pass
+
+def helper():
+    pass
+
+def _private():
+    pass
+
+class Orders(object):
+    def http_get(self):
+        pass
+    def http_post(self):
+        pass
+    def total(self):
+        pass
+
+class Plain(object):
+    def run(self):
+        pass
+"""
+    exec compile(source, name, 'exec') in module.__dict__
+    return module
+
+
+class TestDiscover(unittest.TestCase):
+
+    def setUp(self):
+        sys.modules['bctest_shop'] = _make_module('bctest_shop')
+
+    def tearDown(self):
+        del sys.modules['bctest_shop']
+
+    def test_exposed(self):
+        self.assertEqual(sorted(name for _, name, _ in routes.exposed(
+            ['bctest_shop'], 'tests')),
+            ['Orders', 'Plain', 'helper', 'http_get'])
+
+    def test_unimportable(self):
+        self.assertEqual(list(routes.exposed(['bctest_missing'], 'tests')),
+            [])
+
+    def test_discover(self):
+        manifest = routes.discover(['bctest_missing', 'bctest_shop'])
+        self.assertEqual(manifest, {
+            'bctest_shop' : ['get'],
+            'bctest_shop.Orders' : ['get', 'post'],
+            })
+
+
+if __name__ == '__main__':
+    unittest.main()
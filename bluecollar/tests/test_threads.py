@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Native thread execution tests
+"""
+
+# builtin modules
+import os
+import unittest
+
+# third party modules
+import gevent
+
+# bluecollar modules
+from bluecollar import threads
+
+
+class TestGreenletFallback(unittest.TestCase):
+
+    def test_not_started(self):
+        executor = threads.ThreadExecutor(2)
+        self.assertEqual(executor.apply('app.add', 1, lambda a, b: a + b,
+            1, b=2), 3)
+        self.assertEqual(executor.in_flight, 0)
+
+
+@unittest.skipIf(threads.ThreadPool is None, 'gevent has no thread pool')
+class TestThreadExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = threads.ThreadExecutor(2)
+        self.executor.start()
+        self.completed = []
+        self.executor.on_complete = lambda method, wait: \
+            self.completed.append(method)
+        self.reader, self.writer = os.pipe()
+
+    def tearDown(self):
+        self.executor.stop()
+        os.close(self.reader)
+        os.close(self.writer)
+
+    def wait_idle(self):
+        with gevent.Timeout(5):
+            while self.executor.in_flight:
+                gevent.sleep(0.01)
+
+    def test_result(self):
+        self.assertEqual(self.executor.apply('app.add', 0,
+            lambda a, b: a + b, 1, b=2), 3)
+        self.wait_idle()
+        self.assertEqual(self.completed, ['app.add'])
+        self.assertIn('app.add', self.executor.wait_time)
+
+    def test_error(self):
+        self.assertRaises(ZeroDivisionError, self.executor.apply,
+            'app.divide', 1, lambda: 1 / 0)
+        self.wait_idle()
+        self.assertEqual(self.executor._limits['app.divide'].counter, 1)
+
+    def test_limit_released_once(self):
+        for _ in range(3):
+            self.executor.apply('app.add', 1, lambda: 1)
+        self.wait_idle()
+        self.assertEqual(self.executor._limits['app.add'].counter, 1)
+
+    def test_killed_caller(self):
+        # os.read blocks the native thread until we write
+        caller = gevent.spawn(self.executor.apply, 'app.read', 1, os.read,
+            self.reader, 1)
+        gevent.sleep(0.05)
+        semaphore = self.executor._limits['app.read']
+        self.assertTrue(semaphore.locked())
+        caller.kill()
+        # the thread still runs, so it keeps the method's only place
+        self.assertTrue(semaphore.locked())
+        self.assertEqual(self.executor.in_flight, 1)
+        os.write(self.writer, 'x')
+        self.wait_idle()
+        self.assertEqual(semaphore.counter, 1)
+        self.assertEqual(self.completed, ['app.read'])
+
+
+if __name__ == '__main__':
+    unittest.main()
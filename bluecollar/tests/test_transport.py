@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Queue transport tests, against a throwaway redis-server
+"""
+
+# builtin modules
+import time
+import unittest
+
+# third party modules
+
+# bluecollar modules
+from bluecollar import transport
+from bluecollar.tests import server
+
+
+class ArriveWhileBlocked(object):
+    """Client adding entries just before a blocking read, so the read finds
+    them waiting on several streams at once"""
+
+    def __init__(self, client, entries):
+        self.client = client
+        self.entries = entries
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def execute_command(self, *args):
+        if 'BLOCK' in args:
+            for stream, envelope in self.entries:
+                self.client.execute_command('XADD', stream, '*',
+                    'envelope', envelope)
+        return self.client.execute_command(*args)
+
+
+class TestListTransport(server.RedisTestCase):
+
+    def setUp(self):
+        super(TestListTransport, self).setUp()
+        self.transport = transport.ListTransport(self.redis,
+            ['test_high', 'test_low'])
+
+    def test_priority(self):
+        self.transport.push('a', 'test_low')
+        self.transport.push('b')
+        self.assertEqual(self.transport.fetch(1, 1), [('test_high', 'b')])
+        self.assertEqual(self.transport.fetch(1, 1), [('test_low', 'a')])
+        self.assertEqual(self.transport.fetch(1, 1), [])
+
+    def test_batch(self):
+        self.transport.push_many([('a', None), ('b', None), ('c', None)])
+        self.assertEqual(self.transport.fetch(2, 1), [('test_high', 'a'),
+            ('test_high', 'b')])
+        self.assertEqual(self.transport.depth(), {'test_high' : 1,
+            'test_low' : 0})
+
+    def test_requeue(self):
+        self.transport.push_many([('a', None), ('b', None), ('c', None)])
+        self.transport.requeue(self.transport.fetch(2, 1))
+        self.assertEqual(self.redis.lrange('test_high', 0, -1),
+            ['a', 'b', 'c'])
+
+
+class TestStreamTransport(server.RedisTestCase):
+
+    def setUp(self):
+        super(TestStreamTransport, self).setUp()
+        self.transport = self.consumer('live')
+
+    def consumer(self, name, reclaim=0):
+        return transport.StreamTransport(self.redis,
+            ['test_high', 'test_low'], 'test_group', name, reclaim)
+
+    def envelopes(self, batch):
+        return [envelope for ref, envelope in batch]
+
+    def pending(self, stream):
+        return self.redis.execute_command('XPENDING', stream,
+            'test_group')[0]
+
+    def test_priority(self):
+        self.transport.push('a', 'test_low')
+        self.transport.push_many([('b', None), ('c', None)])
+        batch = self.transport.fetch(2, 1)
+        self.assertEqual(self.envelopes(batch), ['b', 'c'])
+        self.assertEqual([self.transport.queue_of(ref) for ref, _ in batch],
+            ['test_high', 'test_high'])
+        self.assertEqual(self.envelopes(self.transport.fetch(2, 1)), ['a'])
+
+    def test_fill_from_next_stream(self):
+        self.transport.push('a', 'test_low')
+        self.transport.push('b')
+        self.assertEqual(self.envelopes(self.transport.fetch(5, 1)),
+            ['b', 'a'])
+
+    def test_timeout(self):
+        started = time.time()
+        self.assertEqual(self.transport.fetch(1, 0.1), [])
+        self.assertTrue(time.time() - started >= 0.1)
+
+    def hold(self):
+        """Fetch one entry as entries arrive on both streams while we
+        block, holding the other"""
+        self.transport.redis = ArriveWhileBlocked(self.redis, [
+            ('test_high', 'a'), ('test_low', 'b')])
+        try:
+            return self.transport.fetch(1, 1)
+        finally:
+            self.transport.redis = self.redis
+
+    def test_held(self):
+        self.assertEqual(self.envelopes(self.hold()), ['a'])
+        self.assertEqual(self.envelopes(self.transport._held), ['b'])
+        # handed out next time, before anything new
+        self.transport.push('c')
+        self.assertEqual(self.envelopes(self.transport.fetch(2, 1)),
+            ['b', 'c'])
+
+    def test_requeue_held(self):
+        self.hold()
+        self.transport.requeue_held()
+        self.assertEqual(self.transport._held, [])
+        # the original is acknowledged and deleted, a copy waits
+        self.assertEqual(self.pending('test_low'), 0)
+        self.assertEqual(self.redis.execute_command('XLEN', 'test_low'), 1)
+        self.assertEqual(self.envelopes(self.transport.fetch(1, 1)), ['b'])
+
+    def test_done(self):
+        self.transport.push_many([('a', None), ('b', None)])
+        batch = self.transport.fetch(2, 1)
+        for ref, _ in batch:
+            self.transport.done(ref)
+        self.assertEqual(self.pending('test_high'), 2)
+        self.transport.flush_acks()
+        self.assertEqual(self.pending('test_high'), 0)
+        self.assertEqual(self.transport.depth(), {'test_high' : 0,
+            'test_low' : 0})
+
+    def test_requeue(self):
+        self.transport.push_many([('a', None), ('b', None)])
+        self.transport.requeue(self.transport.fetch(1, 1))
+        self.assertEqual(self.pending('test_high'), 0)
+        self.assertEqual(self.envelopes(self.transport.fetch(2, 1)),
+            ['b', 'a'])
+
+    def test_reclaim(self):
+        dead = self.consumer('dead')
+        self.transport.push('a')
+        # our own pending entry comes first and mustn't hide theirs
+        self.transport.fetch(1, 1)
+        self.transport.push_many([('b', None), ('c', None)])
+        dead.fetch(2, 1)
+        live = self.consumer('live', reclaim=0.05)
+        time.sleep(0.1)
+        self.assertEqual(self.envelopes(live._reclaim(1)), ['b'])
+        self.assertEqual(self.envelopes(live._reclaim(5)), ['c'])
+        self.assertEqual(live._consumers('test_high')[0][:2], ('dead', 0))
+        # nothing left pending, the dead consumer is removed
+        time.sleep(0.1)
+        self.assertEqual(live._reclaim(5), [])
+        self.assertEqual([name for name, _, _ in
+            live._consumers('test_high')], ['live'])
+
+    def test_reclaim_not_idle(self):
+        other = self.consumer('other')
+        self.transport.push('a')
+        other.fetch(1, 1)
+        live = self.consumer('live', reclaim=60)
+        self.assertEqual(live._reclaim(5), [])
+        self.assertEqual([name for name, _, _ in
+            live._consumers('test_high')], ['other'])
+
+    def test_poison(self):
+        dead = self.consumer('dead')
+        self.transport.push('a')
+        dead.fetch(1, 1)
+        live = self.consumer('live', reclaim=0.05)
+        live.MAX_DELIVERIES = 1
+        time.sleep(0.1)
+        self.assertEqual(live._reclaim(5), [])
+        live.flush_acks()
+        self.assertEqual(self.pending('test_high'), 0)
+
+    def test_reclaim_on_fetch(self):
+        dead = self.consumer('dead')
+        self.transport.push('a')
+        dead.fetch(1, 1)
+        live = self.consumer('live', reclaim=0.05)
+        time.sleep(0.1)
+        self.assertEqual(self.envelopes(live.fetch(1, 1)), ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
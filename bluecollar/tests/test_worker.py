@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Worker dispatch tests, against a throwaway redis-server
+"""
+
+# builtin modules
+import json
+import unittest
+
+# third party modules
+import gevent.pool
+
+# bluecollar modules
+from bluecollar import codec
+from bluecollar import replies
+from bluecollar.tests import server
+
+# methods the tests call through the worker
+_PATH = __name__
+
+def add(a, b):
+    return a + b
+
+def count(n):
+    return (i for i in range(n))
+
+def fail():
+    raise ValueError('nope')
+
+
+class WorkerTestCase(server.RedisTestCase):
+    """The worker module, imported once the test redis-server is up so it
+    connects there"""
+
+    @classmethod
+    def setUpClass(cls):
+        super(WorkerTestCase, cls).setUpClass()
+        global worker
+        from bluecollar import worker
+
+    def setUp(self):
+        super(WorkerTestCase, self).setUp()
+        self.pool = gevent.pool.Pool(10)
+
+    def dispatch(self, request, header=None):
+        """Dispatch an encoded request framed with header, waiting for
+        anything it spawned"""
+        data = codec.frame(dict({'reply_channel' : 'test_replies',
+            'correlation_id' : 'abc'}, **(header or {})), request)
+        thread = worker.dispatch(data, self.pool, worker._JSON_HELPER)
+        self.pool.join()
+        return thread
+
+    def replies(self):
+        """Decoded replies pushed to the test's reply channel"""
+        return [json.loads(replies.decode_reply(reply)[1])
+            for reply in self.redis.lrange('test_replies', 0, -1)]
+
+
+class TestJobs(WorkerTestCase):
+
+    def submit(self, request):
+        job_id = worker.JOBS.create('json')
+        self.dispatch(request, {'job_id' : job_id})
+        return worker.JOBS.get(job_id)
+
+    def test_done(self):
+        job = self.submit(json.dumps({'method' : '%s.add' % _PATH,
+            'args' : [1, 2]}))
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(json.loads(job['result']), 3)
+        self.assertEqual(self.replies(), [3])
+
+    def test_undecodable(self):
+        job = self.submit('{bad')
+        self.assertEqual(job['status'], 'failed')
+        self.assertEqual(json.loads(job['result'])['response_code'], 400)
+        self.assertEqual(self.replies()[0]['response_code'], 400)
+
+    def test_invalid_method(self):
+        job = self.submit(json.dumps({'args' : [1, 2]}))
+        self.assertEqual(job['status'], 'failed')
+        self.assertEqual(json.loads(job['result'])['response_code'], 400)
+
+    def test_missing_method(self):
+        job = self.submit(json.dumps({'method' : '%s.subtract' % _PATH}))
+        self.assertEqual(job['status'], 'failed')
+        self.assertEqual(json.loads(job['result'])['response_code'], 404)
+        self.assertEqual(self.replies()[0]['response_code'], 404)
+
+    def test_deadline_passed(self):
+        job = self.submit(json.dumps({'method' : '%s.add' % _PATH,
+            'args' : [1, 2], 'deadline' : 1}))
+        self.assertEqual(job['status'], 'failed')
+        self.assertEqual(json.loads(job['result'])['response_code'], 504)
+        self.assertEqual(self.replies(), [])
+
+    def test_uncreated(self):
+        self.dispatch(json.dumps({'method' : '%s.add' % _PATH,
+            'args' : [1, 2]}), {'job_id' : 'nosuchjob'})
+        self.assertIsNone(worker.JOBS.get('nosuchjob'))
+        self.assertEqual(self.replies(), [3])
+
+
+class TestChild(WorkerTestCase):
+
+    def call(self, method, *args):
+        self.dispatch(json.dumps({'method' : '%s.%s' % (_PATH, method),
+            'args' : args}))
+
+    def test_stream(self):
+        self.call('count', 3)
+        correlation_id, key, streamed = replies.decode_reply(
+            self.redis.lpop('test_replies'))
+        self.assertEqual((correlation_id, streamed), ('abc', True))
+        stream = replies.Stream(self.redis, key, 1)
+        self.assertEqual(json.loads(''.join(codec.JSON.body(stream))),
+            [0, 1, 2])
+
+    def test_stream_job(self):
+        job_id = worker.JOBS.create('json')
+        self.dispatch(json.dumps({'method' : '%s.count' % _PATH,
+            'args' : [3]}), {'job_id' : job_id})
+        # jobs keep their whole result, so it isn't streamed
+        self.assertEqual(json.loads(worker.JOBS.get(job_id)['result']),
+            [0, 1, 2])
+        self.assertEqual(self.replies(), [[0, 1, 2]])
+
+    def test_error(self):
+        self.call('fail')
+        self.assertEqual(self.replies(), ['nope'])
+
+
+class TestBatch(WorkerTestCase):
+
+    def setUp(self):
+        super(TestBatch, self).setUp()
+        self.addCleanup(worker._BATCHED.clear)
+        self.done = []
+        self.addCleanup(setattr, worker.TRANSPORT, 'done',
+            worker.TRANSPORT.done)
+        worker.TRANSPORT.done = lambda ref, *args: self.done.append(ref)
+
+    def dispatch_batch(self, items):
+        """Dispatch a batch envelope as a front end enqueues it"""
+        return worker.dispatch(json.dumps({'batch' : [dict(item,
+            correlation_id=str(index)) if type(item) is dict else item
+            for index, item in enumerate(items)],
+            'reply_channel' : 'test_replies'}), self.pool,
+            worker._JSON_HELPER, ref=worker.WORKER_QUEUE)
+
+    def add(self, a, b):
+        return {'method' : '%s.add' % _PATH, 'args' : [a, b]}
+
+    def run_batched(self):
+        while worker._BATCHED:
+            worker.start_batched(self.pool, worker._JSON_HELPER)
+        self.pool.join()
+
+    def test_items(self):
+        batch = self.dispatch_batch([self.add(1, 2), self.add(3, 4)])
+        self.assertIsInstance(batch, worker._Batch)
+        # nothing runs until the main loop has capacity
+        self.assertEqual(len(worker._BATCHED), 2)
+        self.assertEqual(self.replies(), [])
+        self.run_batched()
+        self.assertEqual(sorted(self.replies()), [3, 7])
+        self.assertEqual(batch.left, 0)
+        self.assertEqual(self.done, [worker.WORKER_QUEUE])
+
+    def test_item_not_run(self):
+        batch = self.dispatch_batch([self.add(1, 2),
+            {'method' : '%s.subtract' % _PATH}, {'args' : [1]}, 'junk'])
+        self.assertEqual(len(worker._BATCHED), 3)
+        self.run_batched()
+        self.assertEqual(batch.left, 0)
+        self.assertEqual(self.done, [worker.WORKER_QUEUE])
+        self.assertEqual(sorted(reply.get('response_code') if
+            type(reply) is dict else reply for reply in self.replies()),
+            [3, 400, 404])
+
+    def test_empty(self):
+        self.assertIsNone(self.dispatch_batch([]))
+        self.assertEqual(len(worker._BATCHED), 0)
+
+    def test_requeue(self):
+        batch = self.dispatch_batch([self.add(1, 2), self.add(3, 4),
+            self.add(5, 6)])
+        worker.start_batched(self.pool, worker._JSON_HELPER)
+        worker.requeue_prefetched()
+        self.assertEqual(len(worker._BATCHED), 0)
+        # what's left goes back as a smaller batch
+        requeued = json.loads(self.redis.lpop(worker.WORKER_QUEUE))
+        self.assertEqual([item['args'] for item in requeued['batch']],
+            [[3, 4], [5, 6]])
+        self.assertEqual(requeued['reply_channel'], 'test_replies')
+        self.pool.join()
+        self.assertEqual(batch.left, 0)
+        self.assertEqual(self.replies(), [3])
+
+
+if __name__ == '__main__':
+    unittest.main()
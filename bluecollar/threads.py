@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Native thread execution
+    Runs blocking calls that gevent can't make cooperative (C extensions,
+    native drivers) on a bounded pool of real threads, so the worker's hub
+    keeps serving other greenlets while they run
+
+"""
+
+# builtin modules
+import time
+import logging
+
+# third party modules
+import gevent.coros
+try:
+    from gevent.threadpool import ThreadPool
+except ImportError:
+    # gevent before 1.0 has no native thread pool
+    ThreadPool = None
+
+# bluecollar modules
+
+# weight of the newest sample in the smoothed queue wait
+_SMOOTHING = 0.2
+
+
+class ThreadExecutor(object):
+    """Runs callables on native threads with optional per-method limits,
+    keeping a smoothed queue wait per method"""
+
+    def __init__(self, size):
+        self.size = size
+        self.in_flight = 0
+        # smoothed seconds between submission and a thread picking it up
+        self.wait_time = {}
+        # called with (method, wait) as each call finishes
+        self.on_complete = None
+        self._pool = None
+        self._limits = {}
+
+    def start(self):
+        if ThreadPool is None:
+            logging.error('Native thread pool needs gevent 1.0 or later, '
+                    'thread bound methods will run on greenlets.')
+            return
+        self._pool = ThreadPool(self.size)
+        logging.info('Started native thread pool of %d', self.size)
+
+    def _limit(self, method, limit):
+        if not limit:
+            return None
+        if method not in self._limits:
+            self._limits[method] = gevent.coros.Semaphore(limit)
+        return self._limits[method]
+
+    def apply(self, method, limit, func, *args, **kwargs):
+        """Run func on a native thread, at most limit at once for this
+        method, waiting cooperatively for the result"""
+        if self._pool is None:
+            return func(*args, **kwargs)
+        submitted = time.time()
+        semaphore = self._limit(method, limit)
+        if semaphore is not None:
+            semaphore.acquire()
+        self.in_flight += 1
+        started = []
+        def run():
+            started.append(time.time())
+            return func(*args, **kwargs)
+        def finished(result):
+            # a thread can't be killed, if the caller is it runs on and
+            # holds its place until it returns
+            self.in_flight -= 1
+            if semaphore is not None:
+                semaphore.release()
+            if started:
+                wait = started[0] - submitted
+                smoothed = self.wait_time.get(method, wait)
+                self.wait_time[method] = smoothed + _SMOOTHING * (
+                        wait - smoothed)
+                if self.on_complete:
+                    self.on_complete(method, wait)
+        try:
+            result = self._pool.spawn(run)
+        except Exception:
+            finished(None)
+            raise
+        result.rawlink(finished)
+        return result.get()
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.kill()
+            self._pool = None
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+    BlueCollar
+
+    Worker queue transports
+    Carry request envelopes from the front ends to the workers, either on
+    Redis lists (RPUSH/BLPOP) or Redis streams with a consumer group
+    (XADD/XREADGROUP/XACK). Workers consume several queues in priority
+    order, strictly or weighted.
+
+"""
+
+# builtin modules
+import time
+import random
+import logging
+
+# third party modules
+import redis
+
+# bluecollar modules
+
+
+class _Queues(object):
+    """Priority ordering shared by the transports"""
+
+    def __init__(self, queues, weights=None, default=None):
+        self.queues = list(queues)
+        self.weights = list(weights or [])
+        # where pushes go when no queue is given
+        self.default = default or self.queues[0]
+
+    def _order(self):
+        """Queues in the order to consume them this time. Strict priority
+        without weights, otherwise the first queue is picked in proportion
+        to its weight and the rest follow in priority order."""
+        if not self.weights or len(self.queues) == 1:
+            return self.queues
+        pick = random.random() * sum(self.weights)
+        for index, weight in enumerate(self.weights):
+            pick -= weight
+            if pick < 0:
+                break
+        return ([self.queues[index]] + self.queues[:index] +
+                self.queues[index+1:])
+
+
+class ListTransport(_Queues):
+    """Request queues held in Redis lists"""
+
+    def __init__(self, connection, queues, weights=None, default=None):
+        super(ListTransport, self).__init__(queues, weights, default)
+        self.redis = connection
+
+    def push(self, envelope, queue=None):
+        """Enqueue an encoded request envelope"""
+        self.redis.rpush(queue or self.default, envelope)
+
+    def push_many(self, items):
+        """Enqueue (envelope, queue) pairs in one round trip"""
+        pipe = self.redis.pipeline(transaction=False)
+        for envelope, queue in items:
+            pipe.rpush(queue or self.default, envelope)
+        pipe.execute()
+
+    def fetch(self, count, timeout):
+        """Take up to count envelopes, blocking for up to timeout seconds
+        when nothing is waiting. Returns a list of (ref, envelope) pairs."""
+        order = self._order()
+        if count > 1:
+            # atomically take a batch from the first queue with work waiting
+            for queue in order:
+                pipe = self.redis.pipeline(transaction=True)
+                pipe.lrange(queue, 0, count - 1)
+                pipe.ltrim(queue, count, -1)
+                batch = pipe.execute()[0]
+                if batch:
+                    return [(queue, envelope) for envelope in batch]
+        request = self.redis.blpop(order, timeout)
+        if not request:
+            return []
+        return [(request[0], request[1])]
+
+    def queue_of(self, ref):
+        """The queue an envelope was taken from"""
+        return ref
+
+    def done(self, ref, *args):
+        """Lists keep no record of in-flight work, nothing to do"""
+        pass
+
+    def requeue(self, items):
+        """Return unprocessed (ref, envelope) pairs to the head of their
+        queues, in order"""
+        for queue in self.queues:
+            envelopes = [envelope for ref, envelope in items if ref == queue]
+            if envelopes:
+                self.redis.lpush(queue, *reversed(envelopes))
+
+    def depth(self):
+        """Number of envelopes waiting in each queue"""
+        pipe = self.redis.pipeline(transaction=False)
+        for queue in self.queues:
+            pipe.llen(queue)
+        return dict(zip(self.queues, pipe.execute()))
+
+
+class StreamTransport(_Queues):
+    """Request queues held in Redis streams, read through a consumer group
+    so many workers can share them and in-flight work stays pending until
+    acknowledged. Acknowledged entries are deleted, so streams only hold
+    work waiting or in flight. Entries left pending by a consumer that
+    has gone quiet for reclaim seconds are claimed by another."""
+
+    FIELD = 'envelope'
+    # entries delivered this many times are dropped as poison
+    MAX_DELIVERIES = 5
+
+    def __init__(self, connection, streams, group, consumer, reclaim=0,
+            weights=None, default=None):
+        super(StreamTransport, self).__init__(streams, weights, default)
+        self.redis = connection
+        self.group = group
+        self.consumer = consumer
+        self.reclaim = reclaim
+        # completed (stream, entry ID) refs waiting to be acknowledged
+        self._acks = []
+        # entries read beyond what was asked for, handed out next time
+        self._held = []
+        self._next_sweep = 0
+        self._group_ready = False
+
+    def _ensure_group(self):
+        if self._group_ready:
+            return
+        for stream in self.queues:
+            if self._has_group(stream):
+                continue
+            try:
+                # from the start, so nothing enqueued before the first
+                # worker is missed
+                self.redis.execute_command('XGROUP', 'CREATE', stream,
+                        self.group, '0', 'MKSTREAM')
+                logging.info('Created consumer group %s on %s',
+                        self.group, stream)
+            except redis.exceptions.RedisError:
+                # another worker created it first, the BUSYGROUP error
+                # isn't one redis-py's own parser understands
+                if not self._has_group(stream):
+                    raise
+        self._group_ready = True
+
+    def _has_group(self, stream):
+        if not self.redis.exists(stream):
+            return False
+        return any(dict(zip(info[::2], info[1::2]))['name'] == self.group
+            for info in self.redis.execute_command('XINFO', 'GROUPS',
+                stream))
+
+    def _add(self, client, stream, envelope):
+        client.execute_command('XADD', stream, '*', self.FIELD, envelope)
+
+    def push(self, envelope, queue=None):
+        """Enqueue an encoded request envelope"""
+        self._add(self.redis, queue or self.default, envelope)
+
+    def push_many(self, items):
+        """Enqueue (envelope, stream) pairs in one round trip"""
+        pipe = self.redis.pipeline(transaction=False)
+        for envelope, queue in items:
+            self._add(pipe, queue or self.default, envelope)
+        pipe.execute()
+
+    def flush_acks(self, client=None):
+        """Acknowledge all completed entries and delete them, one XACK and
+        XDEL per stream, so trimming only ever costs what was handled"""
+        if not self._acks:
+            return
+        acks, self._acks = self._acks, []
+        pipe = client or self.redis.pipeline(transaction=False)
+        for stream in self.queues:
+            entry_ids = [entry_id for ref_stream, entry_id in acks
+                if ref_stream == stream]
+            if entry_ids:
+                pipe.execute_command('XACK', stream, self.group, *entry_ids)
+                pipe.execute_command('XDEL', stream, *entry_ids)
+        if client is None:
+            pipe.execute()
+
+    def fetch(self, count, timeout):
+        """Take up to count new entries for this consumer, blocking for up
+        to timeout seconds. Streams are read in priority order, each asked
+        for only what the ones before it didn't fill. Returns a list of
+        ((stream, entry id), envelope) pairs in priority order."""
+        self._ensure_group()
+        if self._acks:
+            self.flush_acks()
+        batch, self._held = self._held[:count], self._held[count:]
+        if self.reclaim and time.time() >= self._next_sweep:
+            self._next_sweep = time.time() + max(1, self.reclaim / 4)
+            batch.extend(self._reclaim(count - len(batch)))
+        order = self._order()
+        for stream in order:
+            if len(batch) >= count:
+                return batch
+            batch.extend(self._entries(stream, self.redis.execute_command(
+                'XREADGROUP', 'GROUP', self.group, self.consumer,
+                'COUNT', count - len(batch), 'STREAMS', stream, '>')))
+        if batch:
+            return batch
+        # nothing waiting anywhere, block until something arrives
+        response = self.redis.execute_command('XREADGROUP', 'GROUP',
+                self.group, self.consumer, 'COUNT', count,
+                'BLOCK', int(timeout * 1000), 'STREAMS',
+                *(order + ['>'] * len(order)))
+        entries = dict(response or [])
+        for stream in order:
+            batch.extend(self._entries(stream, [[stream,
+                entries.get(stream, [])]]))
+        # each stream may have returned up to count, the rest stay pending
+        # for us and go out first next time
+        batch, self._held = batch[:count], batch[count:]
+        return batch
+
+    def _entries(self, stream, response):
+        """(ref, envelope) pairs from an XREADGROUP or XCLAIM reply"""
+        entries = []
+        for _, stream_entries in response or []:
+            for entry in stream_entries:
+                if not entry or entry[1] is None:
+                    # deleted while pending
+                    continue
+                entry_id, fields = entry
+                fields = dict(zip(fields[::2], fields[1::2]))
+                if self.FIELD not in fields:
+                    logging.error('Stream entry %s has no envelope',
+                            entry_id)
+                    self._acks.append((stream, entry_id))
+                    continue
+                entries.append(((stream, entry_id), fields[self.FIELD]))
+        return entries
+
+    def _consumers(self, stream):
+        """Name, pending count and idle milliseconds of each consumer in
+        our group on a stream"""
+        consumers = []
+        for info in self.redis.execute_command('XINFO', 'CONSUMERS', stream,
+                self.group):
+            info = dict(zip(info[::2], info[1::2]))
+            consumers.append((info['name'], int(info['pending']),
+                int(info['idle'])))
+        return consumers
+
+    def _reclaim(self, count):
+        """Claim up to count entries other consumers have left pending for
+        longer than reclaim seconds. Pending entries are looked up by
+        consumer, so our own can't hide theirs, and consumers quiet for that
+        long with nothing pending are removed from the group. Looking up a
+        consumer's entries counts as hearing from it before Redis 7, so
+        only entries' own idle time decides what is claimed."""
+        claimed = []
+        idle = int(self.reclaim * 1000)
+        for stream in self.queues:
+            for consumer, pending, quiet in self._consumers(stream):
+                if consumer == self.consumer:
+                    continue
+                if not pending:
+                    if quiet < idle:
+                        continue
+                    # recreated if it ever reads again
+                    self.redis.execute_command('XGROUP', 'DELCONSUMER',
+                        stream, self.group, consumer)
+                    logging.info('Removed consumer %s from %s', consumer,
+                        stream)
+                    continue
+                if len(claimed) >= count:
+                    continue
+                claimed.extend(self._claim(stream, consumer, idle,
+                    count - len(claimed)))
+        return claimed
+
+    def _claim(self, stream, consumer, idle, count):
+        """Claim up to count of a consumer's entries pending for longer than
+        idle milliseconds, dropping those delivered too often"""
+        entry_ids = []
+        for entry_id, _, pending_for, deliveries in self.redis.execute_command(
+                'XPENDING', stream, self.group, '-', '+', count, consumer):
+            if pending_for < idle:
+                continue
+            if deliveries >= self.MAX_DELIVERIES:
+                logging.error('Dropping stream entry %s, delivered %d '
+                    'times', entry_id, deliveries)
+                self._acks.append((stream, entry_id))
+                continue
+            entry_ids.append(entry_id)
+        if not entry_ids:
+            return []
+        entries = self._entries(stream, [[stream,
+            self.redis.execute_command('XCLAIM', stream, self.group,
+                self.consumer, idle, *entry_ids)]])
+        if entries:
+            logging.info('Reclaimed %d entries from %s on %s',
+                len(entries), consumer, stream)
+        return entries
+
+    def queue_of(self, ref):
+        """The stream an entry was read from"""
+        return ref[0]
+
+    def done(self, ref, *args):
+        """Mark an entry as handled, it will be acknowledged in the next
+        batch. Extra arguments allow use as a greenlet link callback."""
+        if ref is not None:
+            self._acks.append(ref)
+
+    def requeue(self, items):
+        """Re-add unprocessed entries to their streams and acknowledge the
+        originals so another consumer can pick them up"""
+        if not items:
+            return
+        pipe = self.redis.pipeline(transaction=True)
+        for ref, envelope in items:
+            self._add(pipe, ref[0], envelope)
+            self._acks.append(ref)
+        self.flush_acks(pipe)
+        pipe.execute()
+
+    def requeue_held(self):
+        """Give back entries read but not yet handed out"""
+        held, self._held = self._held, []
+        self.requeue(held)
+
+    def depth(self):
+        """Number of entries waiting or in flight in each stream"""
+        pipe = self.redis.pipeline(transaction=False)
+        for stream in self.queues:
+            pipe.execute_command('XLEN', stream)
+        return dict(zip(self.queues, pipe.execute()))
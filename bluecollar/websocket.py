@@ -18,9 +18,13 @@ import logging
 import sys
 import uuid
 import urlparse
+import time
+import weakref
 
 # third party modules
 import gevent
+import gevent.coros
+import gevent.pool
 import gevent.monkey
 gevent.monkey.patch_all()
 from gevent.pywsgi import WSGIServer
@@ -30,6 +34,11 @@ import redis
 
 # bluecollar things
 import bluecollar.worker as bcenv
+from bluecollar import codec
+from bluecollar import batch
+from bluecollar import jobs
+from bluecollar.pubsub import Subscriber, get_multiplexer, get_mailboxes
+from bluecollar.replies import get_listener, Stream, StreamError
 from bluecollar.http import application as http_fallback
 from bluecollar.rest import application as rest_fallback
 
@@ -41,6 +50,15 @@ try:
     _WS_REDISPORT = abs(int(os.environ.get('BC_WS_REDISPORT',
         bcenv.REDIS_PORT)))
     _WS_REDISDB = abs(int(os.environ.get('BC_WS_REDISDB', bcenv.REDIS_DB)))
+    # pub/sub frames waiting for each client before we start dropping them
+    _WS_BACKLOG = abs(int(os.environ.get('BC_WS_BACKLOG', 1000)))
+    # long polls wait this long for a message, and their mailboxes expire
+    # once they haven't polled for the TTL
+    _WS_POLL_TIMEOUT = abs(int(os.environ.get('BC_WS_POLL_TIMEOUT', 25)))
+    _WS_MAILBOX_TTL = abs(int(os.environ.get('BC_WS_MAILBOX_TTL', 60)))
+    # calls carrying a request ID run concurrently, up to this many at once
+    # on each connection
+    _WS_INFLIGHT = max(1, abs(int(os.environ.get('BC_WS_INFLIGHT', 16))))
 except ValueError, err:
     logging.error(err)
     sys.exit(1)
@@ -48,6 +66,7 @@ _WS_FALLBACK = os.environ.get('BC_WS_FALLBACK')
 _REPLY_PREFIX = os.environ.get('BC_WS_REPLY_PREFIX', 'bc')
 _WS_REDISHOST = os.environ.get('BC_WS_REDISHOST', bcenv.REDIS_HOST)
 _WS_SKIP_LONGPOLLING = os.environ.get('BC_WS_SKIP_LONGPOLLING', False)
+_WS_MAILBOX_PREFIX = os.environ.get('BC_WS_MAILBOX_PREFIX', 'bc_mailbox')
 
 class WebSocketStats(mmstats.MmStats):
     connections_handled = mmstats.CounterField(label='connections_handled')
@@ -56,6 +75,21 @@ class WebSocketStats(mmstats.MmStats):
     pubsub_events = mmstats.CounterField(label='pubsub_events')
 WS_STATS = WebSocketStats(label_prefix='me.s-n.bluecollar.websocket.')
 
+# several greenlets write to each socket, one frame at a time
+_SEND_LOCKS = weakref.WeakKeyDictionary()
+
+def send_frame(websocket, data, frame_codec=codec.JSON):
+    """Send encoded data, as a binary frame for binary codecs where the
+    websocket supports them"""
+    lock = _SEND_LOCKS.get(websocket)
+    if lock is None:
+        lock = _SEND_LOCKS[websocket] = gevent.coros.Semaphore()
+    with lock:
+        if frame_codec.binary and hasattr(websocket, 'send_frame'):
+            websocket.send_frame(data, websocket.OPCODE_BINARY)
+        else:
+            websocket.send(data)
+
 class WebSocketApplication(object):
     """
     BlueCollar Generic web socket handler process
@@ -76,60 +110,157 @@ class WebSocketApplication(object):
     def authenticate_subscribe_xhr(self, start_response, kwargs, channels):
         return True
 
-    def piper(self, websocket, client_id):
-        logging.debug('Subscribe pipe started for %s', client_id)
-        pubsub = self.clients[client_id]['pubsub']
-        WS_STATS.pubsub_connections += 1
-        while client_id in self.clients:
-            for message in pubsub.listen():
-                logging.debug('Message for %s', client_id)
-                WS_STATS.pubsub_events.inc()
-                websocket.send(json.dumps(message, self.json_helper))
-            gevent.sleep()
-        logging.debug('Leaving pipe for %s', client_id)
-        pubsub.reset()
-
-    def subscribe(self, websocket, client_id, channels):
-        if self.authenticate_subscribe(websocket, client_id, channels):
-            if self.clients.get(client_id):
-                pubsub = self.clients[client_id]['pubsub']
-            else:
-                logging.debug('New PubSub connection for %s', client_id)
-                pubsub = self._REDIS.pubsub()
-                self.clients[client_id] = {
-                        'pubsub' : pubsub,
-                        'channels' : [],
-                        'worker' : None,
-                        }
-            if self.clients[client_id].get('worker'):
-                # have to kill any existing greenlet to avoid socket error
-                self.clients[client_id]['worker'].kill()
-            pubsub.subscribe(channels)
-            self.clients[client_id]['worker'] = gevent.Greenlet.spawn(
-                    self.piper, websocket, client_id)
-            self.clients[client_id]['channels'] = pubsub.channels
+    @property
+    def pubsub(self):
+        """This process's shared pub/sub connection"""
+        return get_multiplexer(self._REDIS, self.json_helper)
+
+    def call(self, websocket, replies, message, frame_codec,
+            request_id=None, watchers=None):
+        """Send an RPC request to the workers and write back the reply,
+        tagged with the client's request ID if it gave one. message is a
+        decoded dict, or list for a batch, or the client's bytes to forward
+        undecoded. Greenlets watching the connection's jobs join the
+        watchers group."""
+        tag = lambda data: data if request_id is None else frame_codec.tag(
+                request_id, data)
+        if type(message) is list:
+            # a batch, answered with an array of replies in order
+            send_frame(websocket, tag(batch.call(replies, message,
+                frame_codec, _REQUEST_TIMEOUT)), frame_codec)
+            return
+        if type(message) is dict and message.pop('async', None):
+            self.submit_job(websocket, message, frame_codec, tag, watchers)
+            return
+        correlation_id = replies.expect()
+        header = {
+            'reply_channel' : replies.channel,
+            'correlation_id' : correlation_id,
+            'enqueued' : time.time(),
+            'deadline' : time.time() + _REQUEST_TIMEOUT,
+            'codec' : frame_codec.name,
+            }
+        if type(message) is dict:
+            message = codec.strip(message)
+            message.update(header)
+            bcenv.TRANSPORT.push(bcenv.ENVELOPE_CODEC.encode(message),
+                    bcenv.queue_for(message.get('method')))
+        elif not bcenv.forward(header, message, frame_codec):
+            # it has to be decoded after all
+            replies.cancel(correlation_id)
+            try:
+                message = frame_codec.decode(message)
+            except ValueError:
+                send_frame(websocket, frame_codec.encode(
+                    'Unable to %s decode request.' % frame_codec.name),
+                    frame_codec)
+                return
+            if type(message) in (dict, list):
+                self.call(websocket, replies, message, frame_codec,
+                        request_id, watchers)
+            return
+        # replies are already encoded for the client
+        response = replies.wait(correlation_id, _REQUEST_TIMEOUT)
+        if response is None:
+            send_frame(websocket, tag(frame_codec.encode(
+                'Requested timed out.')), frame_codec)
+        elif isinstance(response, Stream):
+            self.send_stream(websocket, response, frame_codec, tag)
+        else:
+            send_frame(websocket, tag(response), frame_codec)
+
+    def submit_job(self, websocket, message, frame_codec, tag,
+            watchers=None):
+        """Submit a call as an asynchronous job. Its status is sent at once
+        and again, with its result, when it finishes."""
+        job_id = bcenv.JOBS.create(frame_codec.name)
+        message = codec.strip(message)
+        message.update({
+            'job_id' : job_id,
+            'enqueued' : time.time(),
+            'codec' : frame_codec.name,
+            })
+        bcenv.TRANSPORT.push(bcenv.ENVELOPE_CODEC.encode(message),
+                bcenv.queue_for(message.get('method')))
+        send_frame(websocket, tag(jobs.render(job_id,
+            bcenv.JOBS.get(job_id))[1]), frame_codec)
+
+        def push_result():
+            job = bcenv.JOBS.wait(job_id, bcenv.JOB_TTL)
+            if job:
+                send_frame(websocket, tag(jobs.render(job_id, job)[1]),
+                        frame_codec)
+        if watchers is None:
+            gevent.spawn(push_result)
+        else:
+            watchers.spawn(push_result)
+
+    def send_stream(self, websocket, stream, frame_codec, tag=None):
+        """Send a streamed reply as a frame per chunk, ending with an empty
+        array frame. tag wraps each frame with its request ID."""
+        tag = tag or (lambda data: data)
+        try:
+            for chunk in stream:
+                send_frame(websocket, tag(frame_codec.frame(chunk)),
+                        frame_codec)
+        except StreamError, message:
+            send_frame(websocket, tag(message.payload or frame_codec.encode(
+                'Requested timed out.')), frame_codec)
+            return
+        send_frame(websocket, tag(frame_codec.frame(frame_codec.join([]))),
+                frame_codec)
+
+    def subscribe(self, websocket, client_id, channels,
+            frame_codec=codec.JSON, patterns=()):
+        if self.authenticate_subscribe(websocket, client_id,
+                list(channels) + list(patterns)):
+            subscriber = self.clients.get(client_id)
+            if subscriber is None:
+                logging.debug('New subscriber %s', client_id)
+                subscriber = self.clients[client_id] = Subscriber(
+                        lambda frame: send_frame(websocket, frame,
+                            frame_codec),
+                        frame_codec, _WS_BACKLOG)
+                WS_STATS.pubsub_connections += 1
+            self.pubsub.subscribe(subscriber, channels, patterns)
             logging.debug('Client %s now subscribed to %s',
-                    client_id, pubsub.channels)
+                    client_id, subscriber.channels | subscriber.patterns)
 
-    def unsubscribe(self, websocket, client_id, channels):
-        client = self.clients.get(client_id)
-        if not client:
+    def unsubscribe(self, websocket, client_id, channels, patterns=()):
+        subscriber = self.clients.get(client_id)
+        if not subscriber:
             logging.error('Non-existent client tried to unsubscribe: %s',
                     client_id)
             return False
-        client['worker'].kill()
-        if channels == []:
-            del self.clients[client_id]
+        if channels == [] and not patterns:
+            # an empty list drops every subscription
+            self.close_subscriber(client_id)
             return True
-        client['pubsub'].unsubscribe(channels)
-        client['worker'] = gevent.Greenlet.spawn(
-                self.piper, websocket, client_id)
-        client['channels'] = client['pubsub'].channels
+        self.pubsub.unsubscribe(subscriber, channels, patterns)
         logging.debug('Client %s now subscribed to %s',
-                client_id, client['pubsub'].channels)
+                client_id, subscriber.channels | subscriber.patterns)
         return True
 
+    def close_subscriber(self, client_id):
+        """Drop all of a client's subscriptions"""
+        subscriber = self.clients.pop(client_id, None)
+        if subscriber is not None:
+            self.pubsub.close(subscriber)
+            WS_STATS.pubsub_connections -= 1
+
+    @property
+    def mailboxes(self):
+        """Long polling mailboxes, kept in Redis for every process"""
+        return get_mailboxes(self._REDIS, _WS_MAILBOX_PREFIX,
+                _WS_MAILBOX_TTL, _WS_BACKLOG, self.json_helper)
+
     def xhr_long_polling(self, env, start_response):
+        """Long polling for pub/sub. The first poll subscribes and opens a
+        mailbox, later polls pass its ID and the cursor from the previous
+        response to receive every message published since. A poll for a
+        mailbox that has expired opens a new one if it has a subscribe list
+        and is marked "reset", or gets 410 Gone so the client can
+        subscribe again."""
         if env['REQUEST_METHOD'] == 'POST':
             try:
                 kwargs = json.loads(env['wsgi.input'].read())
@@ -138,32 +269,52 @@ class WebSocketApplication(object):
                 return ['POST request must contain JSON data.']
         else:
             kwargs = urlparse.parse_qs(env['QUERY_STRING'])
-        if not kwargs.get('subscribe'):
-            start_response('400 Bad Request', [])
-            return ['Long polling requests are only suppoered for PubSub.']
-        client_id = '%s_%s' % (_REPLY_PREFIX, uuid.uuid1().hex)
-        channels = kwargs['subscribe']
-        if self.authenticate_subscribe_xhr(start_response, kwargs, channels):
-            pubsub = bcenv.REDIS.pubsub()
-            pubsub.subscribe(channels)
-            logging.debug('Long polling client %s subscribed to %s',
-                    client_id, channels)
-            if kwargs.get('callback'):
-                start_response('200 OK', [('Content-Type', 'text/javascript')])
-            else:
-                start_response('200 OK', [('Content-Type',
-                    'application/json')])
-            while True:
-                for message in pubsub.listen():
-                    if message['type'] != 'message':
-                        continue
-                    logging.debug('Message for %s', client_id)
-                    if kwargs.get('callback'):
-                        return ['%s(%s);' % (kwargs['callback'][0],
-                            json.dumps(message, self.json_helper))]
-                    else:
-                        return [json.dumps(message, self.json_heler)]
-            pubsub.reset()
+        # query string values come as lists
+        single = lambda value: value[0] if type(value) is list else value
+        try:
+            cursor = int(single(kwargs.get('cursor')))
+        except (TypeError, ValueError):
+            cursor = None
+        mailbox_id = single(kwargs.get('mailbox'))
+        polled = None
+        if mailbox_id:
+            polled = self.mailboxes.poll(mailbox_id, cursor,
+                    _WS_POLL_TIMEOUT)
+        # a mailbox that expired, the client has to subscribe again
+        reset = bool(mailbox_id) and polled is None
+        if polled is None:
+            if not kwargs.get('subscribe'):
+                if reset:
+                    start_response('410 Gone',
+                            [('Content-Type', 'application/json')])
+                    return [json.dumps({'mailbox' : mailbox_id,
+                            'reset' : True})]
+                start_response('400 Bad Request', [])
+                return ['Long polling requests are only supported for '
+                        'PubSub, with a subscribe list or an open mailbox.']
+            channels = kwargs['subscribe']
+            if isinstance(channels, basestring):
+                channels = [channels]
+            if not self.authenticate_subscribe_xhr(start_response, kwargs,
+                    channels):
+                return []
+            mailbox_id = self.mailboxes.open(channels).id
+            logging.debug('Long polling mailbox %s subscribed to %s',
+                    mailbox_id, channels)
+            polled = self.mailboxes.poll(mailbox_id, None,
+                    _WS_POLL_TIMEOUT) or ([], 0)
+        frames, cursor = polled
+        # the frames are already encoded, so the response is put together
+        # rather than encoded again
+        response = '{"mailbox": "%s", "cursor": %d,%s "messages": [%s]}' % (
+                mailbox_id, cursor, ' "reset": true,' if reset else '',
+                ','.join(frames))
+        callback = single(kwargs.get('callback'))
+        if callback:
+            start_response('200 OK', [('Content-Type', 'text/javascript')])
+            return ['%s(%s);' % (callback, response)]
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [response]
 
     def __call__(self, env, start_response):
         """WSGI WS Application"""
@@ -178,48 +329,77 @@ class WebSocketApplication(object):
             start_response('400 Bad Request', [])
             return ['WebSocket connection is expected here.']
         reply_channel = '%s_%s' % (_REPLY_PREFIX, uuid.uuid1().hex)
+        replies = get_listener(bcenv.REDIS, _REPLY_PREFIX)
         logging.debug('Open socket for client %s', reply_channel)
         WS_STATS.connections_open += 1
+        in_flight = gevent.pool.Pool(_WS_INFLIGHT)
+        watchers = gevent.pool.Group()
 
         try:
             while True:
                 message = websocket.receive()
                 if message is None:
                     break
-                try:
-                    message = json.loads(message)
-                except ValueError:
-                    websocket.send(
-                            json.dumps('Unable to JSON decode request.'))
-                    continue
-                if type(message) is dict:
+                # binary frames carry msgpack, replies go back the same way
+                frame_codec = codec.sniff(message)
+                # pub/sub commands and calls with a request ID have to be
+                # read here, other calls go to the workers undecoded
+                request_id = None
+                if ('subscribe' in message or
+                        frame_codec.mentions(message, 'id') or
+                        frame_codec.mentions(message, 'async')):
+                    try:
+                        message = frame_codec.decode(message)
+                    except ValueError:
+                        send_frame(websocket, frame_codec.encode(
+                            'Unable to %s decode request.' % (
+                                frame_codec.name)), frame_codec)
+                        continue
+                    if type(message) is list:
+                        self.call(websocket, replies, message, frame_codec,
+                                watchers=watchers)
+                        continue
+                    if type(message) is not dict:
+                        continue
                     if type(message.get('subscribe')) is list:
                         self.subscribe(websocket, reply_channel,
-                                message['subscribe'])
+                                message['subscribe'], frame_codec)
+                        continue
+                    elif type(message.get('psubscribe')) is list:
+                        self.subscribe(websocket, reply_channel, [],
+                                frame_codec, message['psubscribe'])
+                        continue
                     elif type(message.get('unsubscribe')) is list:
                         self.unsubscribe(websocket, reply_channel,
                                 message['unsubscribe'])
-                    else:
-                        message['reply_channel'] = reply_channel
-                        bcenv.REDIS.rpush(bcenv.WORKER_QUEUE,
-                                json.dumps(message))
-                        response = bcenv.REDIS.blpop(reply_channel,
-                                _REQUEST_TIMEOUT)
-                        if not response:
-                            websocket.send(
-                                    json.dumps('Requested timed out.'))
-                            continue
-                        websocket.send(response[1])
+                        continue
+                    elif type(message.get('punsubscribe')) is list:
+                        # an empty list drops every pattern
+                        self.unsubscribe(websocket, reply_channel, (),
+                                message['punsubscribe'] or None)
+                        continue
+                    request_id = message.pop('id', None)
+                if request_id is None:
+                    # one call at a time, replies in order
+                    self.call(websocket, replies, message, frame_codec,
+                            watchers=watchers)
+                else:
+                    # replies as they complete, waits here once the
+                    # connection has too many calls in flight
+                    in_flight.spawn(self.call, websocket, replies, message,
+                            frame_codec, request_id, watchers)
+            in_flight.kill()
+            watchers.kill()
             websocket.close()
-            if self.clients.get(reply_channel):
-                self.clients[reply_channel]['worker'].kill()
-                del self.clients[reply_channel]
-                WS_STATS.pubsub_connections -= 1
+            self.close_subscriber(reply_channel)
             WS_STATS.connections_open -= 1
             WS_STATS.connections_handled.inc()
             logging.debug('Closed socket for client %s', reply_channel)
 
         except geventwebsocket.WebSocketError, message:
+            in_flight.kill()
+            watchers.kill()
+            self.close_subscriber(reply_channel)
             WS_STATS.connections_open -= 1
             WS_STATS.connections_handled.inc()
             logging.error('%s: %s', message.__class__.__name__, message)
@@ -13,8 +13,12 @@ import sys
 import os
 import logging
 import time
-import json
 import signal
+import collections
+import functools
+import socket
+import fnmatch
+import tempfile
 
 # thid party modules
 import gevent
@@ -27,8 +31,22 @@ from gevent.backdoor import BackdoorServer
 
 # bluecollar modules
 from bluecollar import prototype
+from bluecollar import transport
+from bluecollar import routes
+from bluecollar import control
+from bluecollar import concurrency
+from bluecollar import offload
+from bluecollar import threads
+from bluecollar import memoize
+from bluecollar import coalesce
+from bluecollar import codec
+from bluecollar import jobs
+from bluecollar import replies
+from bluecollar import metrics
+from bluecollar import profiling
+from bluecollar.replies import encode_reply
 
-# our PID will be checked in redis to see if we should die
+# our PID identifies us in the worker registry and control channel
 _PID = os.getpid()
 
 # logging level and format
@@ -47,38 +65,304 @@ try:
     if REDIS_DB < 0 or REDIS_DB > 15:
         raise ValueError("Redis DBs must be 0-15.")
     WORKER_THREADS = abs(int(os.environ.get('BC_WORKER_THREADS', 10)))
+    # the adaptive concurrency limit moves between these, equal by default
+    WORKER_THREADS_MIN = min(WORKER_THREADS,
+        abs(int(os.environ.get('BC_WORKER_THREADS_MIN', WORKER_THREADS))))
+    LATENCY_TOLERANCE = abs(float(
+        os.environ.get('BC_WORKER_LATENCY_TOLERANCE', 2.0)))
+    # prefetch is capped by pool size so we never hoard work others could do
+    WORKER_PREFETCH = min(WORKER_THREADS,
+        abs(int(os.environ.get('BC_WORKER_PREFETCH', 0))))
+    # stream entries pending this long with a quiet consumer are claimed
+    # by another, 0 never reclaims
+    STREAM_RECLAIM = abs(int(os.environ.get('BC_STREAM_RECLAIM', 600)))
+    HEARTBEAT_INTERVAL = max(1,
+        abs(int(os.environ.get('BC_HEARTBEAT_INTERVAL', 5))))
+    # subprocesses for CPU-bound methods, none by default
+    WORKER_PROCESSES = abs(int(os.environ.get('BC_WORKER_PROCESSES', 0)))
+    # native threads for blocking calls, none by default
+    WORKER_NATIVE_THREADS = abs(int(
+        os.environ.get('BC_WORKER_NATIVE_THREADS', 0)))
+    # results held in each worker's local memo tier
+    MEMO_SIZE = abs(int(os.environ.get('BC_MEMO_SIZE', 1000)))
     BACKDOOR_PORT = abs(int(os.environ.get('BC_BACKDOOR_PORT', 0)))
+    # streamed replies are pushed in chunks of about this many bytes, with
+    # at most this many unread before the method is held back
+    STREAM_CHUNK = abs(int(os.environ.get('BC_STREAM_CHUNK', 65536)))
+    STREAM_WINDOW = max(1, abs(int(os.environ.get('BC_STREAM_WINDOW', 8))))
+    # a stream whose client reads nothing for this long is abandoned
+    STREAM_TIMEOUT = abs(int(os.environ.get('BC_STREAM_TIMEOUT', 60)))
+    # how long the status and result of asynchronous jobs are kept
+    JOB_TTL = max(1, abs(int(os.environ.get('BC_JOB_TTL', 3600))))
+    # reply lists expire if nobody reads them for this long
+    REPLY_TTL = max(1, abs(int(os.environ.get('BC_REPLY_TTL', 600))))
+    # relative weights of BC_QUEUES, strict priority order if not given
+    QUEUE_WEIGHTS = [abs(float(weight)) for weight in
+        os.environ.get('BC_QUEUE_WEIGHTS', '').split(',') if weight]
+    # methods given their own latency histograms, 0 turns them off
+    METRICS_METHODS = abs(int(os.environ.get('BC_METRICS_METHODS', 200)))
+    # profiling windows last this long unless told otherwise, and never
+    # longer than the max
+    PROFILE_DURATION = abs(int(os.environ.get('BC_PROFILE_DURATION', 60)))
+    PROFILE_MAX = abs(int(os.environ.get('BC_PROFILE_MAX', 300)))
+    # method paths remembered as not found, the oldest are forgotten first
+    DISPATCH_MISSES = abs(int(os.environ.get('BC_DISPATCH_MISSES', 1000)))
 except ValueError, message:
     logging.error(message)
     sys.exit(1)
 REDIS = redis.StrictRedis(REDIS_HOST, REDIS_PORT, REDIS_DB)
 WORKER_QUEUE = os.environ.get('BC_QUEUE', 'list_bcqueue')
-WORKER_LIST = os.environ.get('BC_WORKERLIST', 'list_bcworkers')
+# queues this worker consumes, highest priority first
+WORKER_QUEUES = [queue for queue in
+    os.environ.get('BC_QUEUES', WORKER_QUEUE).split(',') if queue]
+if QUEUE_WEIGHTS and len(QUEUE_WEIGHTS) != len(WORKER_QUEUES):
+    logging.error('BC_QUEUE_WEIGHTS needs one weight for each of BC_QUEUES.')
+    sys.exit(1)
+# pattern=queue pairs, front ends send matching methods to that queue
+# instead of BC_QUEUE, first match wins
+QUEUE_ROUTES = [route.split('=', 1) for route in
+    os.environ.get('BC_QUEUE_ROUTES', '').split(',') if '=' in route]
+# hash of worker ID to last heartbeat, not the set of PIDs older workers
+# keep in list_bcworkers, so both can run during a rolling deploy
+WORKER_LIST = os.environ.get('BC_WORKERLIST', 'hash_bcworkers')
+WORKER_ID = os.environ.get('BC_WORKER_ID',
+    '%s:%d' % (socket.gethostname(), _PID))
+CONTROL_CHANNEL = os.environ.get('BC_CONTROL_CHANNEL', 'bc_control')
+# 'list' (RPUSH/BLPOP) or 'stream' (XADD/XREADGROUP consumer group)
+WORKER_TRANSPORT = os.environ.get('BC_TRANSPORT', 'list')
+STREAM_GROUP = os.environ.get('BC_STREAM_GROUP', 'bcworkers')
+STREAM_CONSUMER = os.environ.get('BC_STREAM_CONSUMER', WORKER_ID)
+if WORKER_TRANSPORT == 'stream':
+    TRANSPORT = transport.StreamTransport(REDIS, WORKER_QUEUES, STREAM_GROUP,
+        STREAM_CONSUMER, STREAM_RECLAIM, QUEUE_WEIGHTS, WORKER_QUEUE)
+elif WORKER_TRANSPORT == 'list':
+    TRANSPORT = transport.ListTransport(REDIS, WORKER_QUEUES, QUEUE_WEIGHTS,
+        WORKER_QUEUE)
+else:
+    logging.error('Unknown transport %s, expected list or stream.',
+        WORKER_TRANSPORT)
+    sys.exit(1)
+# modules whose http_<verb> handlers are published for the REST front end,
+# their methods are resolved at start up
+WORKER_MODULES = [module for module in
+    os.environ.get('BC_WORKER_MODULES', '').split(',') if module]
+# only serve methods of BC_WORKER_MODULES, nothing else is looked up
+DISPATCH_STRICT = os.environ.get('BC_DISPATCH_STRICT', False)
+ROUTE_MANIFEST = os.environ.get('BC_ROUTE_MANIFEST', 'hash_bcroutes')
+MEMO_PREFIX = os.environ.get('BC_MEMO_PREFIX', 'bc_memo')
+COALESCE_PREFIX = os.environ.get('BC_COALESCE_PREFIX', 'bc_flight')
+JOB_PREFIX = os.environ.get('BC_JOB_PREFIX', 'bc_job')
+# codec the front ends write envelopes with, workers accept any
+ENVELOPE_CODEC = os.environ.get('BC_CODEC', 'json')
+if ENVELOPE_CODEC not in codec.CODECS:
+    logging.error('Codec %s is unavailable, expected one of %s.',
+        ENVELOPE_CODEC, ', '.join(codec.CODECS))
+    sys.exit(1)
+ENVELOPE_CODEC = codec.CODECS[ENVELOPE_CODEC]
+# front ends forward request bodies undecoded behind a routing header,
+# set this while older workers that can't read them are still running
+FRAME_DISABLED = os.environ.get('BC_FRAME_DISABLED', False)
+# kill requests still running at their deadline, rather than let them
+# finish for nobody
+DEADLINE_KILL = os.environ.get('BC_DEADLINE_KILL', False)
+# where profiles are written
+PROFILE_PATH = os.environ.get('BC_PROFILE_PATH', tempfile.gettempdir())
 WORKER_STATS_LABEL = os.environ.get('BC_WORKER_STATSLABEL',
     'me.s-n.bluecollar.worker.')
 
 # instance cache for reusable classes
 _INST_CACHE = {}
-# cache of executable things
+# dispatch table of method path to its callable, or to (class, name) for
+# classes instantiated each call
 _EXEC_CACHE = {}
-# greenlet threads
-_THREADS = []
+# method paths we found nothing at, oldest first
+_MISSES = collections.OrderedDict()
+# requests taken from the queue but not yet handed to the pool
+_PREFETCH = collections.deque()
+# items of batches waiting for capacity, as (batch, item, fetched, queue)
+_BATCHED = collections.deque()
 
 _JSON_HELPER = lambda data: data
 
+
+class _Batch(object):
+    """A batch envelope taken from a queue, done once all of its items
+    are"""
+
+    def __init__(self, ref, header, size):
+        self.ref = ref
+        self.header = header
+        self.left = size
+
+    def item_done(self, *args):
+        """Extra arguments allow use as a greenlet link callback"""
+        self.left -= 1
+        if not self.left:
+            TRANSPORT.done(self.ref)
+
+
 class WorkerStats(mmstats.MmStats):
     gthreads = mmstats.UInt64Field(label='gthreads')
+    concurrency_limit = mmstats.UInt64Field(label='concurrency_limit')
+    native_calls = mmstats.CounterField(label='native_calls')
+    native_in_flight = mmstats.UInt64Field(label='native_in_flight')
+    native_wait = mmstats.DoubleField(label='native_queue_wait')
+    memo_hits = mmstats.CounterField(label='memo_hits')
+    memo_misses = mmstats.CounterField(label='memo_misses')
+    coalesced = mmstats.CounterField(label='executions_coalesced')
     requests = mmstats.CounterField(label='requests_processed')
+    shed = mmstats.CounterField(label='requests_shed')
+    late = mmstats.CounterField(label='requests_late')
     errors = mmstats.CounterField(label='errors_raised')
 WORKER_STATS = WorkerStats(label_prefix=WORKER_STATS_LABEL)
 
+def queue_stats(queues):
+    """mmstats for each queue we consume, fields are numbered in the
+    order of queues"""
+    fields = {}
+    for index, queue in enumerate(queues):
+        fields['depth_%d' % index] = mmstats.UInt64Field(
+            label='%s.depth' % queue)
+        fields['wait_%d' % index] = mmstats.DoubleField(
+            label='%s.wait' % queue)
+        fields['requests_%d' % index] = mmstats.CounterField(
+            label='%s.requests' % queue)
+    # a file of their own, the default one is WORKER_STATS'
+    return type('QueueStats', (mmstats.MmStats,), fields)(
+        label_prefix='%squeue.' % WORKER_STATS_LABEL,
+        filename='mmstats-%PID%-%TID%-queues')
+QUEUE_STATS = queue_stats(WORKER_QUEUES)
+METRICS = metrics.MethodMetrics(WORKER_STATS_LABEL, METRICS_METHODS)
+_QUEUE_INDEX = dict((queue, index) for index, queue in
+    enumerate(WORKER_QUEUES))
+# smoothed seconds between enqueue and dequeue, per queue
+_QUEUE_WAIT = {}
+
+CONCURRENCY = concurrency.AdaptiveLimit(WORKER_THREADS_MIN, WORKER_THREADS,
+    LATENCY_TOLERANCE)
+
+CONTROL = control.WorkerControl(REDIS, CONTROL_CHANNEL, WORKER_LIST,
+    WORKER_ID, HEARTBEAT_INTERVAL)
+
 def clean_exit(*args):
     """Clean up on exit"""
     logging.info('User exited: %s', args)
-    REDIS.srem(WORKER_LIST, _PID)
+    CONTROL.stop()
+    requeue_prefetched()
+    PROCESS_POOL.stop()
     sys.exit(0)
 signal.signal(signal.SIGTERM, clean_exit)
 
+def requeue_prefetched():
+    """Return any buffered requests to the queue, in order, and
+    acknowledge anything already handled"""
+    if _PREFETCH:
+        TRANSPORT.requeue([(ref, request) for ref, request, fetched in
+            _PREFETCH])
+        logging.info('Returned %d prefetched requests to the queue',
+                len(_PREFETCH))
+        _PREFETCH.clear()
+    if _BATCHED:
+        # what's left of each batch goes back as a smaller batch
+        batches = collections.OrderedDict()
+        for batch, item, fetched, queue in _BATCHED:
+            batches.setdefault(batch, []).append(item)
+        TRANSPORT.requeue([(batch.ref, ENVELOPE_CODEC.encode(
+            dict(batch.header, batch=items)))
+            for batch, items in batches.items()])
+        for batch, items in batches.items():
+            batch.left -= len(items)
+        logging.info('Returned %d batched requests to the queue',
+                len(_BATCHED))
+        _BATCHED.clear()
+    if hasattr(TRANSPORT, 'requeue_held'):
+        TRANSPORT.requeue_held()
+    if hasattr(TRANSPORT, 'flush_acks'):
+        TRANSPORT.flush_acks()
+
+def reconfigure(settings):
+    """Apply settings pushed over the control channel"""
+    global WORKER_PREFETCH
+    if 'prefetch' in settings:
+        WORKER_PREFETCH = min(WORKER_THREADS, abs(int(settings['prefetch'])))
+    if 'debug' in settings:
+        logging.getLogger().setLevel(
+            logging.DEBUG if settings['debug'] else logging.INFO)
+    logging.info('Reconfigured: %s', settings)
+CONTROL.on_reconfigure(reconfigure)
+
+MEMO = memoize.MemoCache(REDIS, MEMO_PREFIX, MEMO_SIZE)
+# tell the other workers to drop local copies of anything we invalidate
+MEMO.broadcast = lambda settings: control.send(REDIS, CONTROL_CHANNEL,
+    'forget', settings=settings)
+FLIGHTS = coalesce.Flights(REDIS, WORKER_ID)
+JOBS = jobs.JobStore(REDIS, JOB_PREFIX, JOB_TTL)
+
+CONTROL.on_command('forget', lambda settings: MEMO.forget(
+    settings.get('keys'), settings.get('method')))
+
+PROFILER = profiling.Profiler(PROFILE_PATH, WORKER_ID, PROFILE_MAX)
+
+def profile(settings):
+    """Start profiling the methods matching settings' methods patterns,
+    all of them by default, or stop if settings has stop"""
+    if settings.get('stop'):
+        PROFILER.stop()
+        return
+    patterns = settings.get('methods') or ['*']
+    if isinstance(patterns, basestring):
+        patterns = patterns.split(',')
+    try:
+        PROFILER.start(patterns,
+            abs(int(settings.get('duration', PROFILE_DURATION))),
+            min(1.0, abs(float(settings.get('sample', 1.0)))))
+    except (TypeError, ValueError), message:
+        logging.error('Invalid profile settings %s: %s', settings, message)
+CONTROL.on_command('profile', profile)
+
+def queue_for(method):
+    """The queue front ends should send a method to"""
+    if isinstance(method, basestring):
+        for pattern, queue in QUEUE_ROUTES:
+            if fnmatch.fnmatchcase(method, pattern):
+                return queue
+    return WORKER_QUEUE
+
+def forward(header, payload, payload_codec, method=None, accepted=None):
+    """Enqueue a client's encoded request without decoding it. Returns
+    False if it has to be decoded first: framing is disabled, it doesn't
+    look like a map, or queue routes need a method we weren't given.
+    accepted is called once it's going to be enqueued."""
+    if (FRAME_DISABLED or not payload_codec.looks_like_map(payload) or
+            (QUEUE_ROUTES and method is None)):
+        return False
+    if accepted:
+        accepted()
+    if method is not None:
+        header = dict(header, method=method)
+    TRANSPORT.push(codec.frame(header, payload, payload_codec),
+        queue_for(method))
+    return True
+
+def record_queue(queue, enqueued):
+    """Account for a request taken from queue"""
+    index = _QUEUE_INDEX.get(queue)
+    if index is None:
+        return
+    getattr(QUEUE_STATS, 'requests_%d' % index).inc()
+    if enqueued:
+        wait = max(0.0, time.time() - enqueued)
+        smoothed = _QUEUE_WAIT.get(queue, wait)
+        _QUEUE_WAIT[queue] = smoothed + 0.2 * (wait - smoothed)
+        setattr(QUEUE_STATS, 'wait_%d' % index, _QUEUE_WAIT[queue])
+
+def sample_queues():
+    """Record the depth of each queue, returns them by name"""
+    depths = TRANSPORT.depth()
+    for queue, depth in depths.items():
+        setattr(QUEUE_STATS, 'depth_%d' % _QUEUE_INDEX[queue], depth)
+    return depths
+
 def route_to_class_or_function(path, module=None):
     """Follow the dot-notation string to find the class or function"""
     # maintain route to module for submodule imports
@@ -121,161 +405,552 @@ def route_to_class_or_function(path, module=None):
                 submodule)
     return False
 
-def child(func, args, kwargs, reply_to, json_helper):
-    """Child function performs request function and handles response"""
-    logging.debug('%s %s %s', func, args, kwargs)
-    time_before = time.time()
+def compile_method(method):
+    """What the dispatch table holds for a method path: its callable, or
+    (class, name) for a class instantiated each call. None if there's
+    nothing there."""
+    executable = route_to_class_or_function(method)
+    if not executable:
+        return None
+    if type(executable) is type:
+        name = method.split('.')[-1]
+        if issubclass(executable, prototype.Cacheable):
+            # inherits cacheable, we only need one
+            if not _INST_CACHE.has_key(method):
+                _INST_CACHE[method] = executable()
+                logging.debug('New cacheable instance: %s',
+                        _INST_CACHE[method])
+            return getattr(_INST_CACHE[method], name, None)
+        return (executable, name)
+    # a normal function (outside a class)
+    return executable
+
+def resolve(method):
+    """Find the callable for a method path, instantiating its class if it
+    has one, or None if there's nothing there"""
+    executable = _EXEC_CACHE.get(method)
+    if executable is None:
+        if method in _MISSES or (DISPATCH_STRICT and WORKER_MODULES):
+            return None
+        # looking it up may import modules, blocking everything else
+        executable = compile_method(method)
+        if executable is None:
+            _MISSES[method] = True
+            while len(_MISSES) > DISPATCH_MISSES:
+                _MISSES.popitem(last=False)
+            return None
+        _EXEC_CACHE[method] = executable
+    if type(executable) is tuple:
+        # instantiate a regular class every call
+        instance = executable[0]()
+        logging.debug('New instance: %s', instance)
+        return getattr(instance, executable[1], None)
+    return executable
+
+def warm_up(module_names):
+    """Import modules and fill the dispatch table with their public
+    functions and the public methods of their classes. Returns how many
+    methods were added."""
+    added = 0
+    for module_name, name, item in routes.exposed(module_names, 'dispatch'):
+        if type(item) is type:
+            methods = ['%s.%s.%s' % (module_name, name, attr)
+                for attr in dir(item) if not attr.startswith('_') and
+                callable(getattr(item, attr))]
+        else:
+            methods = ['%s.%s' % (module_name, name)]
+        for method in methods:
+            try:
+                executable = compile_method(method)
+            except Exception:
+                # most likely a cacheable class that can't be created, the
+                # rest of its methods would fail the same way
+                logging.exception('Unable to resolve %s, skipping %s.%s',
+                    method, module_name, name)
+                break
+            if executable is not None:
+                _EXEC_CACHE[method] = executable
+                added += 1
+    return added
+
+PROCESS_POOL = offload.ProcessPool(WORKER_PROCESSES, resolve)
+THREAD_POOL = threads.ThreadExecutor(WORKER_NATIVE_THREADS)
+
+def native_complete(method, wait):
+    """Account for a call that ran on a native thread"""
+    WORKER_STATS.native_calls.inc()
+    WORKER_STATS.native_in_flight = THREAD_POOL.in_flight
+    WORKER_STATS.native_wait = wait
+THREAD_POOL.on_complete = native_complete
+
+def marked(func, flag, base):
+    """Whether func is flagged, or is a method of a base subclass"""
+    return (getattr(func, flag, False) or
+        isinstance(getattr(func, 'im_self', None), base))
+
+def send_reply(recipients, payload):
+    """Push an encoded reply to each (reply_to, correlation_id) pair. Reply
+    lists expire, so those nobody is reading any more don't linger."""
+    recipients = [recipient for recipient in recipients if recipient[0]]
+    if recipients:
+        pipe = REDIS.pipeline(transaction=False)
+        for reply_to, correlation_id in recipients:
+            pipe.rpush(reply_to, encode_reply(correlation_id, payload))
+            pipe.expire(reply_to, REPLY_TTL)
+        pipe.execute()
+
+def send_stream(recipients, items, encoder, json_helper):
+    """Push the items of an iterator to each recipient's stream list in
+    chunks of about STREAM_CHUNK bytes, so no more than STREAM_WINDOW
+    chunks are ever held in memory or Redis"""
+    keys = [replies.stream_key(reply_to, correlation_id)
+        for reply_to, correlation_id in recipients]
+    pipe = REDIS.pipeline(transaction=False)
+    for key, (reply_to, correlation_id) in zip(keys, recipients):
+        pipe.delete(key)
+        pipe.rpush(reply_to, replies.encode_stream(correlation_id, key))
+        pipe.expire(reply_to, REPLY_TTL)
+    pipe.execute()
+
+    def push(marker, data):
+        pipe = REDIS.pipeline(transaction=False)
+        for key in keys:
+            pipe.rpush(key, marker + data)
+            # abandoned streams clean themselves up
+            pipe.expire(key, STREAM_TIMEOUT or 60)
+        unread = max(pipe.execute()[::2])
+        # hold the method back until the slowest client catches up
+        stalled = time.time()
+        while unread >= STREAM_WINDOW:
+            if STREAM_TIMEOUT and time.time() - stalled > STREAM_TIMEOUT:
+                raise gevent.Timeout(STREAM_TIMEOUT)
+            gevent.sleep(0.05)
+            pipe = REDIS.pipeline(transaction=False)
+            for key in keys:
+                pipe.llen(key)
+            unread = max(pipe.execute())
+
     try:
-        response = func(*args, **kwargs)
+        batch, size = [], 0
+        for item in items:
+            item = encoder.encode(item, default=json_helper)
+            batch.append(item)
+            size += len(item)
+            if size >= STREAM_CHUNK:
+                push(replies.CHUNK, encoder.join(batch))
+                batch, size = [], 0
+        if batch:
+            push(replies.CHUNK, encoder.join(batch))
+    except gevent.Timeout:
+        logging.error('Stream abandoned by %s', recipients)
+        return
     except Exception, message:
-        # pass any exceptions from the function call to the reply channel
-        if reply_to:
-            REDIS.rpush(
-                reply_to,
-                json.dumps(str(message)))
+        push(replies.ERROR, encoder.encode(str(message)))
         raise
-    time_after = time.time()
-    if reply_to:
+    push(replies.END, '')
+
+def child(func, args, kwargs, reply_to, json_helper, correlation_id=None,
+        memo=None, flight=None, encoder=codec.JSON, job=None,
+        histograms=None, profiled=None):
+    """Child function performs request function and handles response.
+    memo is (method, key, ttl, shared) for memoized methods, flight is
+    (key, cluster, ttl) for coalesced ones, encoder is the reply codec,
+    job the ID of an asynchronous job to store the result for,
+    histograms the method's metrics and profiled the method's name if the
+    call is to be profiled. Returns False if the function didn't run, the
+    reply came from the memo cache or another call."""
+    logging.debug('%s %s %s', func, args, kwargs)
+    if memo:
+        payload = MEMO.get(memo[1], memo[3])
+        if payload is not None:
+            WORKER_STATS.memo_hits.inc()
+            send_reply([(reply_to, correlation_id)], payload)
+            if job:
+                JOBS.finish(job, payload)
+            return False
+        WORKER_STATS.memo_misses.inc()
+    if flight:
+        key, cluster, ttl = flight
+        if not FLIGHTS.board(key, cluster, ttl, reply_to, correlation_id):
+            # an identical call is running, its reply will come to us
+            WORKER_STATS.coalesced.inc()
+            return False
+    # everyone waiting on this call, followers are added when it finishes
+    recipients = lambda: [(reply_to, correlation_id)] + (
+        FLIGHTS.land(flight[0], flight[1]) if flight else [])
+    if job:
+        JOBS.start(job)
+    try:
+        time_before = time.time()
         try:
-            REDIS.rpush(reply_to, json.dumps(response, default=json_helper))
-        except TypeError:
-            logging.error('Unable to JSON encode response %s from %s',
-                    response, func)
-        except redis.exceptions.ConnectionError, message:
-            logging.error('Lost Redis connection, not sending %s from %s',
+            if profiled:
+                response = PROFILER.call(profiled, func, args, kwargs)
+            else:
+                response = func(*args, **kwargs)
+        except Exception, message:
+            if histograms:
+                histograms.record('exec', time.time() - time_before)
+            # pass any exceptions from the function call to the reply channel
+            send_reply(recipients(), encoder.encode(str(message)))
+            if job:
+                JOBS.finish(job, encoder.encode(str(message)), failed=True)
+            raise
+        if job and isinstance(response, collections.Iterator):
+            # jobs keep their whole result
+            response = list(response)
+        if isinstance(response, collections.Iterator):
+            # generators stream their items as they are produced, their
+            # results aren't memoized
+            targets = [target for target in recipients() if target[0]]
+            if not targets:
+                for _ in response:
+                    pass
+                return
+            if all(correlation for _, correlation in targets):
+                send_stream(targets, response, encoder, json_helper)
+                if histograms:
+                    histograms.record('exec', time.time() - time_before)
+                logging.debug('%s streamed in %s', func,
+                        time.time()-time_before)
+                return
+            # untagged replies can't be streamed, send them everything
+            response = list(response)
+        time_after = time.time()
+        if histograms:
+            histograms.record('exec', time_after - time_before)
+        if reply_to or memo or flight or job:
+            try:
+                payload = encoder.encode(response, default=json_helper)
+            except TypeError:
+                logging.error('Unable to encode response %s from %s',
+                        response, func)
+                if job:
+                    JOBS.finish(job, encoder.encode(
+                        'Unable to encode response.'), failed=True)
+                return
+            if histograms:
+                histograms.record('encode', time.time() - time_after)
+                histograms.record('size', len(payload))
+            if job:
+                JOBS.finish(job, payload)
+            if memo:
+                method, key, ttl, shared = memo
+                MEMO.set(method, key, payload, ttl, shared)
+            try:
+                send_reply(recipients(), payload)
+            except redis.exceptions.ConnectionError, message:
+                logging.error('Lost Redis connection, not sending %s from %s',
+                        response, func)
+        elif response:
+            logging.debug('No response path for reply: %s from %s',
                     response, func)
-    elif response:
-        logging.debug('No response path for reply: %s from %s',
-                response, func)
-    logging.debug('%s executed in %s', func, time_after-time_before)
+        logging.debug('%s executed in %s', func, time_after-time_before)
+    finally:
+        if flight:
+            # anyone still waiting if we failed to reply, or were killed
+            followers = FLIGHTS.land(flight[0], flight[1])
+            if followers:
+                send_reply(followers, encoder.encode('Request failed.'))
+
+
+def reply_error(request, message, response_code):
+    """Reply to a request we can't run, and fail its job if it's one"""
+    payload = codec.get(request.get('codec')).encode({
+        'message' : message,
+        'response_code' : response_code,
+        'error' : True})
+    send_reply([(request.get('reply_channel'),
+        request.get('correlation_id'))], payload)
+    if request.get('job_id'):
+        JOBS.finish(request['job_id'], payload, failed=True)
+
+def reply_not_found(method, reply_to, correlation_id=None,
+        encoder=codec.JSON, job=None):
+    """Log and reply to a request for something we can't find"""
+    logging.error('Failed to find class or function at %s', method)
+    payload = encoder.encode({
+        'message' : 'Failed to find class or function at %s' % (method),
+        'response_code' : 404,
+        'error' : True})
+    send_reply([(reply_to, correlation_id)], payload)
+    if job:
+        JOBS.finish(job, payload, failed=True)
+
+def finished(method, started, waited, deadline, killer, thread):
+    """Account for a completed greenlet, killer is its deadline timer"""
+    if killer is not None:
+        killer.kill(block=False)
+    WORKER_STATS.gthreads -= 1
+    if deadline and time.time() > deadline:
+        WORKER_STATS.late.inc()
+    # answers that didn't run the function say nothing about its latency
+    CONCURRENCY.release(method, None if thread.value is False else
+        time.time() - started, waited)
+    WORKER_STATS.concurrency_limit = int(CONCURRENCY.limit)
+    logging.debug('GC: %s', thread)
+
+def dispatch(request, worker_pool, json_helper, fetched=None, queue=None,
+        ref=None):
+    """Decode a request envelope, resolve its method and spawn it in the
+    worker pool. Returns the greenlet, or None if nothing was spawned.
+    The items of a batch are put in _BATCHED for the main loop to start
+    as it has capacity, and the batch is returned, done once its items
+    are."""
+    # request should be JSON, or msgpack, possibly framed by a front end
+    try:
+        request = codec.decode_envelope(request)
+    except codec.EnvelopeError, message:
+        # the front end didn't decode it, so tell the client
+        logging.error('Invalid request payload: %s', message)
+        reply_error(message.header, 'Unable to decode request: %s' % message,
+            400)
+        return None
+    except ValueError:
+        logging.error('Invalid encoding for request: %r', request)
+        return None
+
+    # a batch runs its items concurrently, sharing its reply channel
+    if type(request) is dict and type(request.get('batch')) is list:
+        header = dict((key, request[key]) for key in
+            ('reply_channel', 'codec', 'enqueued', 'deadline')
+            if key in request)
+        items = [item for item in request['batch'] if type(item) is dict]
+        if not items:
+            return None
+        batch = _Batch(ref, header, len(items))
+        _BATCHED.extend((batch, dict(item, **header), fetched, queue)
+            for item in items)
+        return batch
+    return execute(request, worker_pool, json_helper, fetched, queue)
+
+def start_batched(worker_pool, json_helper):
+    """Start the next item waiting in _BATCHED, its batch is done once all
+    of its items are"""
+    batch, item, fetched, queue = _BATCHED.popleft()
+    thread = execute(item, worker_pool, json_helper, fetched, queue)
+    if thread is None:
+        batch.item_done()
+    else:
+        thread.link(batch.item_done)
+
+def execute(request, worker_pool, json_helper, fetched=None, queue=None):
+    """Resolve a decoded request's method and spawn it in the worker pool.
+    Returns the greenlet, or None if nothing was spawned."""
+    WORKER_STATS.requests.inc()
+
+    # request should be a dict and have a request key with list val
+    if (type(request) is not dict or
+            not request.has_key('method') or
+            type(request['method']) not in [unicode, str]):
+        logging.error('Missing or invalid method: %s', request)
+        if type(request) is dict:
+            reply_error(request, 'Missing or invalid method', 400)
+        return None
+    method = request['method']
+    record_queue(queue, request.get('enqueued'))
+
+    # nobody is waiting for requests past their deadline
+    deadline = request.get('deadline')
+    if deadline and time.time() > deadline:
+        logging.debug('Shedding %s, %.3fs past its deadline', method,
+            time.time() - deadline)
+        WORKER_STATS.shed.inc()
+        if request.get('job_id'):
+            # nobody is waiting on the reply, but the job is still polled
+            JOBS.finish(request['job_id'], codec.get(
+                request.get('codec')).encode({
+                    'message' : 'Deadline passed before the job ran',
+                    'response_code' : 504,
+                    'error' : True}), failed=True)
+        return None
+
+    # decode the arguments
+    args = request.get('args', [])
+    kwargs = request.get('kwargs', {})
+    reply_to = request.get('reply_channel', None)
+    correlation_id = request.get('correlation_id', None)
+    no_exec = request.get('no_exec', None)
+    encoder = codec.get(request.get('codec'))
+    job = request.get('job_id', None)
+
+    # attempt to resolve the requested function
+    func = resolve(method)
+    if func is None:
+        reply_not_found(method, reply_to, correlation_id, encoder, job)
+        return None
+    histograms = METRICS.get(method)
+    if histograms and request.get('enqueued'):
+        histograms.record('wait', max(0.0,
+            time.time() - request['enqueued']))
 
+    # if no_exec, return just reference to object
+    if no_exec:
+        if reply_to:
+            send_reply([(reply_to, correlation_id)], encoder.encode({
+                'found' : True,
+                'ref' : str(func)}))
+            return None
+
+    # memoized methods may be answered from the cache
+    # arguments that can't be keyed, say bytes that aren't UTF-8, run
+    # uncached
+    memo = None
+    flight = None
+    try:
+        if getattr(func, 'memoize_ttl', None):
+            memo = (method, MEMO.key(method, args, kwargs, encoder.name),
+                func.memoize_ttl,
+                getattr(func, 'memoize_shared', True))
+
+        # coalesced methods share one execution between identical calls
+        if getattr(func, 'coalesce', None) and not job:
+            flight = (memoize.call_key('%s:%s' % (COALESCE_PREFIX,
+                encoder.name), method, args, kwargs),
+                func.coalesce == 'cluster',
+                getattr(func, 'coalesce_ttl', 300))
+    except (TypeError, ValueError, UnicodeError), message:
+        logging.debug('Unable to key %s, running uncached: %s', method,
+            message)
+        memo = flight = None
+
+    # CPU-bound methods run in the process pool, blocking native calls on
+    # native threads, when we have them
+    if PROCESS_POOL.size and marked(func, 'process_bound',
+            prototype.ProcessBound):
+        func = functools.partial(PROCESS_POOL.apply, method)
+    elif THREAD_POOL.size and marked(func, 'thread_bound',
+            prototype.ThreadBound):
+        limit = (getattr(func, 'thread_limit', 0) or
+            getattr(getattr(func, 'im_self', None), 'thread_limit', 0))
+        func = functools.partial(THREAD_POOL.apply, method, limit, func)
+
+    # profiling costs nothing unless it's on
+    profiled = PROFILER.active and PROFILER.wants(method) and method
+
+    # execute the function in a greenlet
+    started = time.time()
+    CONCURRENCY.acquire()
+    thread = worker_pool.spawn(
+            child, func, args, kwargs, reply_to, json_helper, correlation_id,
+            memo, flight, encoder, job, histograms, profiled)
+    killer = None
+    if deadline and DEADLINE_KILL:
+        killer = gevent.spawn_later(max(0, deadline - started), thread.kill,
+            block=False)
+    thread.link(functools.partial(finished, method, started,
+        started - (fetched or started), deadline, killer))
+    WORKER_STATS.gthreads += 1
+    return thread
 
 def main(json_helper = _JSON_HELPER):
     """main event loop"""
     # catch redis errors and keyboard interrupts
     logging.info('Worker started')
+    # pool members are forked from a copy of us made before anything runs
+    if WORKER_PROCESSES:
+        PROCESS_POOL.start()
+    # SIGUSR1 profiles everything for the default window, or stops early,
+    # set here so front ends importing us keep their own handlers
+    gevent.signal(signal.SIGUSR1, lambda: profile({'stop' : PROFILER.active}))
     if BACKDOOR_PORT:
         backdoor = BackdoorServer(('127.0.0.1', BACKDOOR_PORT),
                 dict(globals()))
         logging.info('Backdoor server at 127.0.0.1:%d', BACKDOOR_PORT)
         backdoor.start()
     try:
-        REDIS.sadd(WORKER_LIST, _PID)
+        if WORKER_MODULES:
+            started = time.time()
+            logging.info('Resolved %d methods in %.3fs',
+                warm_up(WORKER_MODULES), time.time() - started)
+            manifest = routes.discover(WORKER_MODULES)
+            group = ','.join(sorted(WORKER_MODULES))
+            routes.publish(REDIS, ROUTE_MANIFEST, manifest, group,
+                HEARTBEAT_INTERVAL * 3)
+            CONTROL.refresh = functools.partial(routes.refresh, REDIS,
+                ROUTE_MANIFEST, manifest, group, HEARTBEAT_INTERVAL * 3)
         # main loop
         worker_pool = gevent.pool.Pool(WORKER_THREADS)
+        if WORKER_NATIVE_THREADS:
+            THREAD_POOL.start()
+        WORKER_STATS.concurrency_limit = int(CONCURRENCY.limit)
+        CONTROL.status = lambda: {
+            'in_flight' : len(worker_pool),
+            'buffered' : len(_PREFETCH) + len(_BATCHED),
+            'limit' : int(CONCURRENCY.limit),
+            'native_in_flight' : THREAD_POOL.in_flight,
+            'native_wait' : THREAD_POOL.wait_time,
+            'threads' : WORKER_THREADS,
+            'requests' : WORKER_STATS.requests.value,
+            'shed' : WORKER_STATS.shed.value,
+            'late' : WORKER_STATS.late.value,
+            'queues' : sample_queues(),
+            }
+        CONTROL.start()
         while True:
-            # if we're no longer welcome, break out of the main loop
-            if not REDIS.sismember(WORKER_LIST, _PID):
-                logging.info(
-                    'Worker PID released, waiting for threads, then exiting.')
-                for thread in _THREADS:
-                    thread.join()
+            # if we're no longer welcome, or have drained our buffer,
+            # break out of the main loop
+            if (CONTROL.state == 'released' or
+                    (CONTROL.state == 'draining' and not _PREFETCH and
+                        not _BATCHED)):
+                logging.info('Worker %s, waiting for threads, then exiting.',
+                    CONTROL.state)
+                requeue_prefetched()
+                worker_pool.join()
+                if hasattr(TRANSPORT, 'flush_acks'):
+                    TRANSPORT.flush_acks()
+                CONTROL.stop()
+                PROCESS_POOL.stop()
+                THREAD_POOL.stop()
                 break
 
-            # clean up completed tasks
-            for thread in _THREADS:
-                if thread.ready():
-                    _THREADS.remove(thread)
-                    WORKER_STATS.gthreads -= 1
-                    logging.debug('GC: %s', thread)
+            # while paused, hand back buffered work and wait to resume
+            if CONTROL.state == 'paused':
+                requeue_prefetched()
+                CONTROL.resumed.wait(5)
+                continue
 
             # yield for outstanding threads
             gevent.sleep()
 
-            # grab the next request from the worker queue, or wait
-            request = REDIS.blpop(WORKER_QUEUE, 5)
-            if not request:
-                # timeout waiting for request, lets us run the loop
-                # again and check if we should still be here
+            # only take work off the queue when we can start it
+            if not CONCURRENCY.capacity():
+                CONCURRENCY.wait(5)
                 continue
 
-            # request should be JSON
-            try:
-                request = json.loads(request[1])
-            except ValueError:
-                logging.error('Invalid JSON for request: %s', request[1])
+            # items of batches we've started go first
+            if _BATCHED:
+                start_batched(worker_pool, json_helper)
                 continue
-            WORKER_STATS.requests.inc()
 
-            # request should be a dict and have a request key with list val
-            if (type(request) is not dict or
-                    not request.has_key('method') or
-                    type(request['method']) not in [unicode, str]):
-                logging.error('Missing or invalid method: %s', request)
-                continue
-            method = request['method']
-
-            # decode the arguments
-            args = request.get('args', [])
-            kwargs = request.get('kwargs', {})
-            reply_to = request.get('reply_channel', None)
-            no_exec = request.get('no_exec', None)
-
-            # attempt to resolve the requested function
-            # keeping a cache of them along the way
-            if _EXEC_CACHE.has_key(method):
-                executable = _EXEC_CACHE[method]
-            else:
-                executable = route_to_class_or_function(
-                    method)
-                _EXEC_CACHE[method] = executable
-            if not executable:
-                logging.error('Failed to find class or function at %s',
-                    method)
-                if reply_to:
-                    REDIS.rpush(reply_to, json.dumps({
-                        'message' : \
-                            'Failed to find class or function at %s' % (
-                                method),
-                        'response_code' : 404,
-                        'error' : True}))
-                continue
-
-            # instantiate if we're dealing with a class
-            if type(executable) is type:
-                if issubclass(executable, prototype.Cacheable):
-                    # inherits cacheable, we only need one
-                    if not _INST_CACHE.has_key(method):
-                        # we don't have one yet, so make one
-                        _INST_CACHE[method] = executable()
-                        logging.debug('New cacheable instance: %s',
-                                _INST_CACHE[method])
-                    instance = _INST_CACHE[method]
-                else:
-                    # instantiate a regular class every call
-                    instance = executable()
-                    logging.debug('New instance: %s', instance)
-                # get the instance method we care about
-                if hasattr(instance, method.split('.')[-1]):
-                    func = getattr(instance, method.split('.')[-1])
-                else:
-                    logging.error('Failed to find class or function at %s',
-                        method)
-                    if reply_to:
-                        REDIS.rpush(reply_to, json.dumps({
-                            'message' : \
-                                'Failed to find class or function at %s' % (
-                                    method),
-                            'response_code' : 404,
-                            'error' : True}))
-                    continue
-            else:
-                # a normal function (outside a class)
-                func = executable
-
-            # if no_exec, return just reference to object
-            if no_exec:
-                if reply_to:
-                    REDIS.rpush(reply_to, json.dumps({
-                        'found' : True,
-                        'ref' : str(func)}))
+            # refill the local buffer with as much waiting work as we have
+            # capacity for, in a single round trip, or wait for some
+            if not _PREFETCH and CONTROL.state == 'running':
+                fetched = time.time()
+                _PREFETCH.extend((ref, request, fetched) for ref, request in
+                    TRANSPORT.fetch(
+                        max(1, min(WORKER_PREFETCH, CONCURRENCY.capacity())),
+                        5))
+                if not _PREFETCH:
+                    # timeout waiting for request, lets us run the loop
+                    # again and check if we should still be here
                     continue
 
-            # execute the function in a greenlet
-            _THREADS.append(
-                worker_pool.spawn(
-                    child, func, args, kwargs, reply_to, json_helper))
-            WORKER_STATS.gthreads += 1
+            # grab the next request from the buffer
+            ref, request, fetched = _PREFETCH.popleft()
+            try:
+                thread = dispatch(request, worker_pool, json_helper,
+                    fetched, TRANSPORT.queue_of(ref), ref)
+            except redis.exceptions.ConnectionError:
+                raise
+            except Exception:
+                # one bad request mustn't take the worker down
+                logging.exception('Unable to dispatch %r', request)
+                thread = None
+            if thread is None:
+                TRANSPORT.done(ref)
+            elif not isinstance(thread, _Batch):
+                # acknowledge once the work is actually done
+                thread.link(functools.partial(TRANSPORT.done, ref))
 
     except redis.exceptions.ConnectionError, message:
         # redis isn't there or went away
@@ -284,6 +959,12 @@ def main(json_helper = _JSON_HELPER):
         time.sleep(5)
         sys.exit(1)
 
+    except redis.exceptions.ResponseError, message:
+        # most likely a key of ours holding another type, such as a
+        # BC_WORKERLIST shared with older workers
+        logging.error('Redis refused a command: %s', message)
+        sys.exit(1)
+
     except KeyboardInterrupt:
         # user interrupted
         clean_exit()
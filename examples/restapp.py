@@ -10,7 +10,8 @@ class Resource(object):
             item = int(args[0])
             return Item(item).http_get(*args, **kwargs)
         else:
-            return [item['id'] for item in DATA]
+            # generators are streamed to the client as they run
+            return (item['id'] for item in DATA)
 
 class Item(object):
     def __init__(self, item_id):